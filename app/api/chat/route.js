@@ -20,63 +20,9 @@ export async function POST(request) {
   const stream = new ReadableStream({
     async start(controller) {
       try {
-        // Preparar contexto das tarefas para a IA
-        let contextMessage = message;
-        
-        // Sempre enviar system message com contexto completo
-        const weekdayTasks = tasks ? tasks.filter(task => !task.isWeekend) : [];
-        const weekendTasks = tasks ? tasks.filter(task => task.isWeekend) : [];
-        
-        const weekdayContext = weekdayTasks.length > 0 
-          ? weekdayTasks.map(task => 
-              `- ${task.text}${task.time ? ` (${task.time})` : ''}${task.description ? ` - ${task.description}` : ''} - ${task.completed ? 'Concluída' : 'Pendente'}`
-            ).join('\n')
-          : 'Nenhuma tarefa cadastrada para dias da semana';
-          
-        const weekendContext = weekendTasks.length > 0
-          ? weekendTasks.map(task => 
-              `- ${task.text}${task.time ? ` (${task.time})` : ''}${task.description ? ` - ${task.description}` : ''} - ${task.completed ? 'Concluída' : 'Pendente'}`
-            ).join('\n')
-          : 'Nenhuma tarefa cadastrada para fim de semana';
-        
-        contextMessage = `INSTRUÇÕES DO SISTEMA:
-Você é um assistente especializado em produtividade pessoal e organização de rotinas. Sua função é ajudar o usuário com suas tarefas diárias de forma prática e objetiva.
-
-DIRETRIZES OBRIGATÓRIAS:
-1. SEMPRE responda em português brasileiro
-2. Seja direto, claro e conciso - evite textos longos
-3. Foque apenas em produtividade, organização e gestão de tarefas
-4. NUNCA faça pesquisas na internet - use APENAS o contexto fornecido
-5. NÃO acesse dados externos - trabalhe apenas com as informações das tarefas do usuário
-6. Se não souber algo específico, seja honesto e ofereça alternativas práticas
-7. Mantenha tom amigável mas profissional
-8. Dê respostas acionáveis - sempre inclua próximos passos ou sugestões práticas
-9. IMPORTANTE: Responda APENAS com base nas tarefas cadastradas pelo usuário
-
-CONTEXTO COMPLETO DO USUÁRIO:
-
- TAREFAS DOS DIAS DA SEMANA (Segunda a Sexta):
-${weekdayContext}
-
- TAREFAS DO FIM DE SEMANA (Sábado e Domingo):
-${weekendContext}
-
- RESUMO ESTATÍSTICO:
-- Total de tarefas: ${tasks ? tasks.length : 0}
-- Tarefas concluídas: ${tasks ? tasks.filter(t => t.completed).length : 0}
-- Tarefas pendentes: ${tasks ? tasks.filter(t => !t.completed).length : 0}
-- Tarefas com horário: ${tasks ? tasks.filter(t => t.time).length : 0}
-
- ESTRUTURA DA ROTINA:
-O usuário organiza suas tarefas em dois modelos:
-1. Rotina de dias úteis (segunda a sexta-feira)
-2. Rotina de fim de semana (sábado e domingo)
-
-PERGUNTA DO USUÁRIO: ${message}
-
-Responda considerando EXCLUSIVAMENTE o contexto das tarefas acima. NÃO faça pesquisas externas.`;
-
-        console.log('Enviando para servidor Python:', contextMessage);
+        // O servidor Python monta o prompt da rotina a partir das tarefas e só reenvia
+        // o contexto completo quando ele muda na conversa (perplexity/routine_context.py)
+        console.log('Enviando para servidor Python:', message);
 
         // Detectar IP do servidor Python automaticamente
         const pythonServerUrl = process.env.PYTHON_API_URL || await detectPythonServer();
@@ -91,7 +37,8 @@ Responda considerando EXCLUSIVAMENTE o contexto das tarefas acima. NÃO faça pe
           },
           body: JSON.stringify({
             model: 'gpt-4o',
-            input: contextMessage,
+            input: message,
+            tasks: tasks || [],
             stream: true,
             conversation_id: conversationId || 'default'
           })
@@ -148,7 +95,8 @@ async function detectPythonServer() {
     'http://192.168.15.7:8000'
   ];
 
-  // Testar cada URL possível
+  // Testar cada URL possível; prefere um servidor já aquecido ("ready" em /health)
+  let warming = null;
   for (const url of possibleUrls) {
     try {
       const testResponse = await fetch(`${url}/health`, { 
@@ -157,6 +105,12 @@ async function detectPythonServer() {
       });
       
       if (testResponse.ok) {
+        const health = await testResponse.json().catch(() => ({}));
+        if (health.ready === false) {
+          // responde, mas ainda aquecendo as sessões com o Perplexity (primeira resposta mais lenta)
+          warming = warming || url;
+          continue;
+        }
         console.log(`Servidor Python encontrado em: ${url}`);
         return url;
       }
@@ -165,6 +119,11 @@ async function detectPythonServer() {
     }
   }
 
+  if (warming) {
+    console.warn(`Servidor Python em ${warming} ainda aquecendo; usando mesmo assim`);
+    return warming;
+  }
+
   console.warn('Servidor Python não encontrado, usando fallback: http://localhost:8000');
   return 'http://localhost:8000';
 }
@@ -0,0 +1,240 @@
+# account_pool.py
+"""Rodízio de contas (perfis de cookies) do Perplexity entre as conversas.
+
+O upstream limita cada conta: acima de certo ritmo, as requisições da conta
+começam a receber 403/429 ou o desafio do Cloudflare, e o servidor inteiro
+fica preso a esse teto. Com várias contas configuradas, cada conversa nova é
+atribuída a uma conta (rodízio entre as disponíveis), com sessões aquecidas
+próprias (um SessionPool por conta).
+
+A conversa fica presa à conta em que começou: o read_write_token e a thread
+pertencem a ela, e trocar de conta no meio quebraria a continuidade. Por isso
+a conta de cada conversa é gravada junto com o contexto (context_persistence).
+
+Uma conta com ``threshold`` bloqueios seguidos entra em quarentena: deixa de
+receber conversas novas por ``quarantine_s`` segundos (dobrando a cada
+quarentena seguida sem nenhuma resposta normal, até ``max_quarantine_s``) e
+volta sozinha ao rodízio quando o prazo acaba. Conversas já presas a ela
+continuam usando a conta.
+
+Enquanto outra conta segue recebendo conversas novas, o bloqueio de uma conta
+em quarentena é problema dela e não do upstream inteiro (``isolated``): o
+servidor não o conta no circuit breaker nem no limite adaptativo, que valem
+para todas as contas.
+
+Formato do arquivo de contas (JSON), lista ou objeto nome -> cookies; os
+cookies podem vir como objeto ou como o header Cookie copiado do navegador:
+
+    [{"name": "pessoal", "cookies": {"__Secure-next-auth.session-token": "..."}},
+     {"name": "trabalho", "cookies": "__Secure-next-auth.session-token=...; pplx.visitor-id=..."}]
+"""
+import asyncio
+import json
+import time
+from collections import deque
+
+from upstream_limiter import THROTTLE_OUTCOMES
+
+__all__ = ["Account", "AccountPool", "load_accounts"]
+
+
+def _parse_cookies(cookies) -> dict:
+    if cookies is None:
+        return {}
+    if isinstance(cookies, str):
+        # header Cookie: "a=1; b=2"
+        parsed = {}
+        for part in cookies.split(";"):
+            name, sep, value = part.strip().partition("=")
+            if sep and name:
+                parsed[name] = value
+        return parsed
+    if isinstance(cookies, dict):
+        return {str(k): str(v) for k, v in cookies.items()}
+    raise ValueError("cookies da conta devem ser um objeto ou o header Cookie")
+
+
+def load_accounts(path: str) -> list:
+    """Lê o arquivo de contas; devolve [(nome, cookies), ...].
+
+    Raises:
+        ValueError: formato inválido ou nomes repetidos
+    """
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = [{"name": name, "cookies": cookies} for name, cookies in data.items()]
+    if not isinstance(data, list) or not data:
+        raise ValueError(f"{path}: esperada uma lista de contas não vazia")
+    accounts = []
+    for i, item in enumerate(data):
+        if not isinstance(item, dict):
+            raise ValueError(f"{path}: conta {i} não é um objeto")
+        name = str(item.get("name") or f"conta{i + 1}")
+        accounts.append((name, _parse_cookies(item.get("cookies"))))
+    names = [name for name, _ in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"{path}: nomes de conta repetidos")
+    return accounts
+
+
+class Account:
+    """Uma conta do upstream: cookies, sessões próprias, quarentena e contadores."""
+
+    def __init__(self, name: str, cookies: dict, pool=None, window: float = 60.0):
+        self.name = name
+        self.cookies = cookies
+        self.pool = pool
+        self.window = window
+        self.quarantined_until = 0.0
+        self.quarantine_s = 0.0
+        self._strikes = 0
+        self._ok_times: deque = deque()
+        self.assigned = 0
+        self.requests = 0
+        self.ok = 0
+        self.throttled = 0
+        self.errors = 0
+        self.quarantines = 0
+
+    def available(self, now: float | None = None) -> bool:
+        return (now if now is not None else time.monotonic()) >= self.quarantined_until
+
+    def ok_per_min(self, now: float | None = None) -> float:
+        edge = (now if now is not None else time.monotonic()) - self.window
+        while self._ok_times and self._ok_times[0] < edge:
+            self._ok_times.popleft()
+        return len(self._ok_times) * 60.0 / self.window
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "available": self.available(now),
+            "quarantine_left_s": round(max(0.0, self.quarantined_until - now), 1),
+            "quarantines": self.quarantines,
+            "assigned": self.assigned,
+            "requests": self.requests,
+            "ok": self.ok,
+            "throttled": self.throttled,
+            "errors": self.errors,
+            "ok_per_min": round(self.ok_per_min(now), 1),
+            "session_pool": self.pool.stats() if self.pool is not None else None,
+        }
+
+
+class AccountPool:
+    """Distribui conversas novas entre as contas e põe em quarentena as bloqueadas.
+
+    Args:
+        accounts: [(nome, cookies), ...]
+        pool_factory: callable(cookies) -> SessionPool (ou None para uma sessão por conversa)
+        threshold: bloqueios seguidos (403/429/HTML) que põem a conta em quarentena (0 desativa)
+        quarantine_s: duração da primeira quarentena; dobra a cada quarentena seguida
+        max_quarantine_s: teto da quarentena
+    """
+
+    def __init__(self, accounts, pool_factory=None, threshold: int = 3, quarantine_s: float = 60.0,
+                 max_quarantine_s: float = 900.0):
+        self.threshold = max(0, int(threshold))
+        self.base_quarantine_s = max(1.0, float(quarantine_s))
+        self.max_quarantine_s = max(self.base_quarantine_s, float(max_quarantine_s))
+        self.accounts = [
+            Account(name, cookies, pool_factory(cookies) if pool_factory is not None else None)
+            for name, cookies in accounts
+        ]
+        if not self.accounts:
+            raise ValueError("nenhuma conta configurada")
+        self._by_name = {a.name: a for a in self.accounts}
+        self._rr = 0
+        # todas em quarentena: a conversa vai para a que sai primeiro
+        self.exhausted = 0
+
+    def __iter__(self):
+        return iter(self.accounts)
+
+    def __len__(self) -> int:
+        return len(self.accounts)
+
+    def get(self, name: str | None) -> Account | None:
+        return self._by_name.get(name) if name else None
+
+    def assign(self) -> Account:
+        """Conta para uma conversa nova: rodízio entre as disponíveis."""
+        now = time.monotonic()
+        n = len(self.accounts)
+        for i in range(n):
+            account = self.accounts[(self._rr + i) % n]
+            if account.available(now):
+                self._rr = (self._rr + i + 1) % n
+                break
+        else:
+            self.exhausted += 1
+            account = min(self.accounts, key=lambda a: a.quarantined_until)
+        account.assigned += 1
+        return account
+
+    def record(self, account: Account, outcome: str):
+        """Resultado de uma abertura de stream feita com a conta (mesmo rótulo das métricas)."""
+        account.requests += 1
+        if outcome == "ok":
+            account.ok += 1
+            account._ok_times.append(time.monotonic())
+            account._strikes = 0
+            account.quarantine_s = 0.0
+            return
+        if outcome not in THROTTLE_OUTCOMES:
+            account.errors += 1
+            return
+        account.throttled += 1
+        account._strikes += 1
+        now = time.monotonic()
+        if self.threshold and account._strikes >= self.threshold and account.available(now):
+            # quarentena seguida sem nenhuma resposta normal no meio: dobra
+            account.quarantine_s = min(self.max_quarantine_s, account.quarantine_s * 2 or self.base_quarantine_s)
+            account.quarantined_until = now + account.quarantine_s
+            account.quarantines += 1
+            account._strikes = 0
+            print(f"⚠️ Conta {account.name!r} bloqueada pelo upstream; em quarentena por {account.quarantine_s:.0f}s")
+
+    def isolated(self, account: Account) -> bool:
+        """True se a conta está em quarentena e alguma outra segue disponível para conversas novas."""
+        now = time.monotonic()
+        if account.available(now):
+            return False
+        return any(a.available(now) for a in self.accounts if a is not account)
+
+    @property
+    def ready(self) -> bool:
+        """Alguma conta tem sessão aquecida (sem pool não há o que aquecer)."""
+        return any(a.pool is None or a.pool.ready for a in self.accounts)
+
+    @property
+    def warmup_s(self) -> float | None:
+        done = [a.pool.warmup_s for a in self.accounts if a.pool is not None and a.pool.warmup_s is not None]
+        return min(done) if done else None
+
+    async def start(self):
+        for account in self.accounts:
+            if account.pool is not None:
+                await account.pool.start()
+
+    async def wait_ready(self) -> bool:
+        """Aguarda o aquecimento de todas as contas; True se alguma ficou pronta."""
+        await asyncio.gather(*(a.pool.wait_ready() for a in self.accounts if a.pool is not None))
+        return self.ready
+
+    async def close(self):
+        for account in self.accounts:
+            if account.pool is not None:
+                await account.pool.close()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "count": len(self.accounts),
+            "available": sum(a.available(now) for a in self.accounts),
+            "threshold": self.threshold,
+            "exhausted": self.exhausted,
+            "accounts": [a.stats() for a in self.accounts],
+        }
@@ -0,0 +1,408 @@
+# bench_load.py
+"""Benchmark de carga do servidor OpenAI-compat contra o upstream simulado.
+
+Sobe mock_upstream.MockUpstream neste processo, inicia o servidor
+(start_openai_compat_api) em um subprocesso apontado para ele via
+PPLX_UPSTREAM_URL e dispara requisições em /v1/responses com concorrência
+fixa. Reporta requisições/s, TTFT (primeiro byte do corpo), latência
+p50/p90/p99 e CPU/RSS do processo do servidor.
+
+Nada sai para a rede: os números medem só o servidor (e o ritmo configurado
+no upstream simulado), então servem para acompanhar regressões.
+
+Uso:
+    python bench_load.py --concurrency 16 --requests 400
+    python bench_load.py --mode json --events 40 --answer-chars 4000
+    python bench_load.py --stream-format delta --error-rate 0.05 --errors 403,drop
+    python bench_load.py --env PPLX_SESSION_POOL_SIZE=8 --json resultado.json
+    python bench_load.py --replay capturas/ --replay-speed 0   # tráfego capturado em produção
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from mock_upstream import MockUpstream, add_config_arguments, config_from_args
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    # nearest-rank
+    k = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[k]
+
+
+# ==========================
+# Cliente HTTP mínimo (keep-alive, mede o primeiro byte do corpo)
+# ==========================
+class _Connection:
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader = None
+        self._writer = None
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def post(self, path: str, body: bytes, headers: dict | None = None) -> tuple:
+        """POST -> (status, s até o primeiro byte do corpo, s até o fim, bytes do corpo, falhou).
+
+        ``falhou`` indica erro dentro de uma resposta 200: evento {"error": ...} no
+        stream ou resposta não-stream com texto vazio.
+        """
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        extra = "".join(f"{k}: {v}\r\n" for k, v in (headers or {}).items())
+        t0 = time.perf_counter()
+        self._writer.write(
+            (f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+             f"Content-Length: {len(body)}\r\n{extra}\r\n").encode("latin-1") + body
+        )
+        try:
+            return await self._read_response(t0)
+        except BaseException:
+            # resposta incompleta: a conexão não pode ser reaproveitada
+            await self.close()
+            raise
+
+    async def _read_response(self, t0: float) -> tuple:
+        reader = self._reader
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        status = int(head[0].split(" ", 2)[1])
+        headers = {}
+        for line in head[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        first = None
+        nbytes = 0
+        failed = False
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunk = await reader.readexactly(size + 2)
+                failed = failed or b'{"error":' in chunk
+                if first is None:
+                    first = time.perf_counter() - t0
+                nbytes += size
+        else:
+            length = int(headers.get("content-length") or 0)
+            if length:
+                body = await reader.readexactly(length)
+                failed = b'{"error":' in body or b'"text":""' in body
+                first = time.perf_counter() - t0
+            nbytes = length
+        total = time.perf_counter() - t0
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, first if first is not None else total, total, nbytes, failed
+
+
+# ==========================
+# CPU/RSS do servidor (psutil se instalado, senão /proc)
+# ==========================
+class _ProcessSampler:
+    """CPU e RSS do processo do servidor somados aos filhos (workers do modo --workers)."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self._proc = None
+        try:
+            import psutil
+
+            self._proc = psutil.Process(pid)
+        except Exception:
+            self._proc = None
+        self._ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.rss_peak = 0
+
+    def _pids(self) -> list:
+        pids, i = [self.pid], 0
+        while i < len(pids):
+            try:
+                with open(f"/proc/{pids[i]}/task/{pids[i]}/children") as f:
+                    pids.extend(int(p) for p in f.read().split())
+            except (OSError, ValueError):
+                pass
+            i += 1
+        return pids
+
+    def _procs(self) -> list:
+        try:
+            return [self._proc, *self._proc.children(recursive=True)]
+        except Exception:
+            return [self._proc]
+
+    def cpu_seconds(self) -> float | None:
+        if self._proc is not None:
+            total = 0.0
+            for proc in self._procs():
+                try:
+                    t = proc.cpu_times()
+                except Exception:
+                    continue
+                total += t.user + t.system
+            return total
+        total = None
+        for pid in self._pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                total = (total or 0.0) + (int(fields[11]) + int(fields[12])) / self._ticks
+            except (OSError, IndexError, ValueError):
+                continue
+        return total
+
+    def rss_bytes(self) -> int | None:
+        rss = None
+        if self._proc is not None:
+            for proc in self._procs():
+                try:
+                    rss = (rss or 0) + proc.memory_info().rss
+                except Exception:
+                    continue
+        else:
+            for pid in self._pids():
+                try:
+                    with open(f"/proc/{pid}/status") as f:
+                        rss = (rss or 0) + next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmRSS:"))
+                except (OSError, StopIteration, ValueError):
+                    continue
+        if rss is None:
+            return None
+        self.rss_peak = max(self.rss_peak, rss)
+        return rss
+
+    async def sample_forever(self, every: float = 0.1):
+        while True:
+            self.rss_bytes()
+            await asyncio.sleep(every)
+
+
+# ==========================
+# Servidor sob teste
+# ==========================
+def _start_server(port: int, upstream_url: str, env_overrides: list, replay: str | None = None,
+                  replay_speed: float = 1.0, workers: int = 1) -> subprocess.Popen:
+    env = {
+        **os.environ,
+        "PPLX_UPSTREAM_URL": upstream_url,
+        # sem disco e sem cache: cada requisição vai ao upstream
+        "PPLX_CONTEXT_DB": "",
+        "PPLX_RESPONSE_CACHE_SIZE": "0",
+    }
+    if replay:
+        # capturas (stream_capture) no lugar do upstream simulado
+        env["PPLX_REPLAY_DIR"] = os.path.abspath(replay)
+        env["PPLX_REPLAY_SPEED"] = str(replay_speed)
+    for item in env_overrides:
+        name, _, value = item.partition("=")
+        env[name] = value
+    if workers > 1:
+        # roteador com afinidade por conversa na porta, workers em portas livres
+        code = (
+            "import worker_router\n"
+            "if __name__ == '__main__':\n"
+            f"    worker_router.serve_multiprocess(host='127.0.0.1', port={port}, workers={workers})\n"
+        )
+    else:
+        code = (
+            "import perplexity_working as w, sys\n"
+            f"ok, _ = w.start_openai_compat_api(host='127.0.0.1', port={port}, threaded=False)\n"
+            "sys.exit(0 if ok else 1)\n"
+        )
+    return subprocess.Popen([sys.executable, "-c", code], cwd=HERE, env=env)
+
+
+async def _wait_ready(port: int, proc: subprocess.Popen, timeout: float = 20.0, path: str = "/health"):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"servidor encerrou durante a inicialização (código {proc.returncode})")
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n".encode())
+            line = await reader.readline()
+            writer.close()
+            if b" 200 " in line:
+                return
+        except OSError:
+            pass
+        await asyncio.sleep(0.2)
+    raise SystemExit(f"servidor não respondeu {path} a tempo")
+
+
+# ==========================
+# Carga
+# ==========================
+def _request_body(i: int, args) -> bytes:
+    # perguntas distintas por padrão: evita que o single-flight junte as requisições
+    body = {
+        "model": "gpt-4o",
+        "input": "Como organizar minha rotina?" if args.same_query else f"Como organizar minha rotina? #{i}",
+        "stream": args.mode == "stream" or (args.mode == "mixed" and i % 2 == 0),
+    }
+    if body["stream"]:
+        body["stream_format"] = args.stream_format
+    if args.conversations:
+        body["conversation_id"] = f"bench-{i % args.conversations}"
+    return json.dumps(body).encode("utf-8")
+
+
+async def _run_load(port: int, args) -> dict:
+    results = []
+    errors: dict = {}
+    next_i = 0
+
+    async def worker():
+        nonlocal next_i
+        conn = _Connection("127.0.0.1", port)
+        try:
+            while next_i < args.requests:
+                i = next_i
+                next_i += 1
+                try:
+                    status, first, total, nbytes, failed = await conn.post("/v1/responses", _request_body(i, args))
+                except (OSError, asyncio.IncompleteReadError, ValueError) as e:
+                    errors[e.__class__.__name__] = errors.get(e.__class__.__name__, 0) + 1
+                    continue
+                if status != 200:
+                    errors[str(status)] = errors.get(str(status), 0) + 1
+                    continue
+                if failed:
+                    errors["upstream"] = errors.get("upstream", 0) + 1
+                    continue
+                results.append((first, total, nbytes))
+        finally:
+            await conn.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - t0
+    ttft = [r[0] for r in results]
+    latency = [r[1] for r in results]
+    return {
+        "requests": args.requests,
+        "ok": len(results),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "ttft_ms": {p: round(1000 * _percentile(ttft, q), 1) for p, q in (("p50", 50), ("p99", 99))},
+        "latency_ms": {
+            p: round(1000 * _percentile(latency, q), 1) for p, q in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))
+        },
+        "bytes_received": sum(r[2] for r in results),
+    }
+
+
+async def main(args) -> dict:
+    mock = await MockUpstream(config_from_args(args)).start()
+    port = args.port or _free_port()
+    proc = _start_server(port, mock.url, args.env, args.replay, args.replay_speed, args.workers)
+    sampler = _ProcessSampler(proc.pid)
+    try:
+        # o roteador responde /health antes dos workers subirem: espera todos prontos
+        await _wait_ready(port, proc, path="/ready" if args.workers > 1 else "/health")
+        if args.warmup:
+            warm = argparse.Namespace(**{**vars(args), "requests": args.warmup})
+            await _run_load(port, warm)
+        cpu0 = sampler.cpu_seconds()
+        rss0 = sampler.rss_bytes()
+        sampling = asyncio.get_running_loop().create_task(sampler.sample_forever())
+        report = await _run_load(port, args)
+        sampling.cancel()
+        cpu1 = sampler.cpu_seconds()
+        sampler.rss_bytes()
+        cpu = (cpu1 - cpu0) if cpu0 is not None and cpu1 is not None else None
+        report["server"] = {
+            "cpu_s": round(cpu, 3) if cpu is not None else None,
+            # % de um núcleo durante a carga
+            "cpu_pct": round(100 * cpu / report["elapsed_s"], 1) if cpu is not None and report["elapsed_s"] else None,
+            "cpu_ms_per_request": round(1000 * cpu / report["requests"], 2) if cpu is not None and report["requests"] else None,
+            "rss_start_mb": round(rss0 / 2**20, 1) if rss0 else None,
+            "rss_peak_mb": round(sampler.rss_peak / 2**20, 1) if sampler.rss_peak else None,
+        }
+        report["upstream"] = mock.stats()
+        report["config"] = {
+            "mode": args.mode, "stream_format": args.stream_format, "concurrency": args.concurrency,
+            "conversations": args.conversations, "same_query": args.same_query,
+            "events": args.events, "answer_chars": args.answer_chars, "first_event_delay": args.first_event_delay,
+            "interval": args.interval, "jitter": args.jitter, "error_rate": args.error_rate, "env": args.env,
+            "replay": args.replay, "replay_speed": args.replay_speed, "workers": args.workers,
+        }
+        return report
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        await mock.close()
+
+
+def _print_report(r: dict):
+    c = r["config"]
+    print(f"modo={c['mode']} formato={c['stream_format']} concorrência={c['concurrency']} "
+          f"eventos={c['events']} resposta={c['answer_chars']} chars")
+    print(f"requisições: {r['ok']}/{r['requests']} ok em {r['elapsed_s']}s  ->  {r['rps']} req/s")
+    if r["errors"]:
+        print(f"erros: {', '.join(f'{k}={v}' for k, v in sorted(r['errors'].items()))}")
+    print(f"TTFT (ms):     p50={r['ttft_ms']['p50']}  p99={r['ttft_ms']['p99']}")
+    lat = r["latency_ms"]
+    print(f"latência (ms): p50={lat['p50']}  p90={lat['p90']}  p99={lat['p99']}  max={lat['max']}")
+    s = r["server"]
+    print(f"servidor: CPU {s['cpu_s']}s ({s['cpu_pct']}% de um núcleo, {s['cpu_ms_per_request']} ms/req)  "
+          f"RSS {s['rss_start_mb']} -> pico {s['rss_peak_mb']} MB")
+    u = r["upstream"]
+    failures = ", ".join(f"{k}={v}" for k, v in u["failures"].items() if v) or "nenhuma"
+    print(f"upstream simulado: {u['streams']} streams, falhas injetadas: {failures}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark de carga de /v1/responses contra o upstream simulado")
+    g = parser.add_argument_group("carga")
+    g.add_argument("--concurrency", type=int, default=8, help="requisições simultâneas (padrão: 8)")
+    g.add_argument("--requests", type=int, default=200, help="total de requisições (padrão: 200)")
+    g.add_argument("--warmup", type=int, default=8, help="requisições de aquecimento fora da medição (padrão: 8)")
+    g.add_argument("--mode", choices=("stream", "json", "mixed"), default="stream", help="stream, não-stream ou alternado")
+    g.add_argument("--stream-format", choices=("passthrough", "delta"), default="passthrough")
+    g.add_argument("--conversations", type=int, default=0,
+                   help="distribui as requisições em N conversas (padrão: 0 = sem conversation_id)")
+    g.add_argument("--same-query", action="store_true", help="mesma pergunta em todas (exercita o single-flight)")
+    s = parser.add_argument_group("servidor")
+    s.add_argument("--port", type=int, default=0, help="porta do servidor (padrão: livre)")
+    s.add_argument("--workers", type=int, default=1,
+                   help="processos do servidor atrás do roteador por conversa (worker_router; padrão: 1)")
+    s.add_argument("--env", action="append", default=[], metavar="NOME=VALOR",
+                   help="variável de ambiente extra para o servidor (repetível)")
+    s.add_argument("--replay", metavar="DIR", help="serve capturas .sse.gz (stream_capture) em vez do upstream simulado")
+    s.add_argument("--replay-speed", type=float, default=1.0, help="ritmo do replay (1 = original, 0 = sem espera)")
+    parser.add_argument("--json", metavar="ARQUIVO", help="grava o relatório em JSON (para comparar execuções)")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    report = asyncio.run(main(args))
+    _print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
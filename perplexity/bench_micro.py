@@ -0,0 +1,341 @@
+# bench_micro.py
+"""Microbenchmarks dos componentes do caminho quente (sem rede).
+
+Uso:
+    python bench_micro.py sse      # enquadramento SSE: legado x sse_framer
+    python bench_micro.py decode   # decodificação de eventos: legado x event_decoder
+    python bench_micro.py suffix   # sufixo novo no chat_client: legado x stream_text
+    python bench_micro.py payload  # corpo do perplexity_ask: dict + json.dumps x request_builder
+    python bench_micro.py metrics  # custo por observação das métricas de /metrics
+    python bench_micro.py startup  # partida a frio do chat_client (orçamento STARTUP_BUDGET_MS)
+"""
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import event_decoder
+from sse_framer import SSEFramer
+from stream_text import StreamTextAssembler
+from request_builder import AskRequestBuilder
+from metrics import MetricsRegistry
+
+
+def _best_of(fn, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def _chunks(raw: bytes, size: int):
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def _sse_event(size: int) -> bytes:
+    # evento no formato do upstream: um snapshot FINAL grande em uma única linha data:
+    answer = "x" * size
+    payload = json.dumps({"backend_uuid": "b", "text": json.dumps([{"step_type": "FINAL", "content": {"answer": answer}}])})
+    return f"event: message\r\ndata: {payload}\r\n\r\n".encode()
+
+
+def _legacy_framer(chunks):
+    """Cópia do laço antigo de gen_resp(): buf += chunk; buf.split(b'\\n', 1)."""
+    buf = b''
+    lines = []
+    n = 0
+    for chunk in chunks:
+        buf += chunk
+        while b'\n' in buf:
+            raw_line, buf = buf.split(b'\n', 1)
+            line = raw_line.decode('utf-8', 'ignore')
+            if not line:
+                continue
+            if line.strip() == '':
+                n += 1
+                lines = []
+            else:
+                lines.append(line)
+    return n
+
+
+def _new_framer(chunks):
+    framer = SSEFramer()
+    n = 0
+    for chunk in chunks:
+        n += len(framer.feed(chunk))
+    return n + len(framer.close())
+
+
+def bench_sse():
+    header = f"{'evento':>10} {'legado (ms)':>12} {'ns/byte':>8} {'sse_framer (ms)':>16} {'ns/byte':>8}"
+
+    def row(size, chunks, legacy=True):
+        assert _new_framer(chunks) == 1
+        t_new = _best_of(lambda: _new_framer(chunks))
+        t_old = _best_of(lambda: _legacy_framer(chunks), repeat=1) if legacy else float("nan")
+        print(f"{size:>10} {t_old * 1e3:>12.2f} {t_old / size * 1e9:>8.1f} {t_new * 1e3:>16.2f} {t_new / size * 1e9:>8.1f}")
+
+    # snapshot FINAL em uma única linha data: — o laço legado refaz `b'\n' in buf`
+    # sobre o buffer inteiro a cada chunk
+    print("Snapshot de N bytes em uma linha, recebido em chunks de 4 KiB")
+    print(header)
+    for size in (65_536, 262_144, 1_048_576, 4_194_304):
+        row(size, _chunks(_sse_event(size), 4096), legacy=size <= 1_048_576)
+
+    # muitas linhas no mesmo chunk — o laço legado copia o restante do buffer a cada linha
+    print()
+    print("Evento de N bytes com uma linha a cada 80 bytes, recebido em um único chunk")
+    print(header)
+    for size in (65_536, 262_144, 1_048_576, 4_194_304):
+        line = b"data: " + b"y" * 73 + b"\n"
+        raw = b"event: message\n" + line * (size // len(line)) + b"\n"
+        row(size, [raw], legacy=size <= 1_048_576)
+
+
+def _message_data(n_chunks: int) -> str:
+    # data de um evento 'message' com o snapshot FINAL acumulado após n_chunks
+    chunks = [f"trecho {i} da resposta, " for i in range(n_chunks)]
+    answer = json.dumps({"answer": "".join(chunks), "chunks": chunks})
+    steps = [
+        {"step_type": "INITIAL_QUERY", "content": {"query": "pergunta"}},
+        {"step_type": "SEARCH_RESULTS", "content": {"web_results": [{"url": f"https://ex.com/{i}"} for i in range(10)]}},
+        {"step_type": "FINAL", "content": {"answer": answer}},
+    ]
+    return json.dumps({
+        "backend_uuid": "b", "context_uuid": "c", "frontend_context_uuid": "f",
+        "read_write_token": "t", "text": json.dumps(steps),
+    })
+
+
+def _legacy_decode(data: str):
+    """Caminho antigo: contexto, texto do servidor e chat_client decodificavam cada um as camadas."""
+    # _update_ctx_from_event(): camada externa para os ids de contexto
+    obj = json.loads(data)
+    ctx = obj.get("backend_uuid")
+    # process_event(): externa + steps + answer
+    for _ in range(2):  # servidor e _try_print_perplexity_steps() no chat_client
+        steps = json.loads(json.loads(data)["text"])
+        for step in steps:
+            if step.get("step_type") == "FINAL":
+                chunks = json.loads(step["content"]["answer"])["chunks"]
+    return ctx, chunks
+
+
+def _new_decode(data: str):
+    dec = event_decoder.decode_event(data)
+    ctx = dec.backend_uuid
+    chunks = dec.answer_chunks
+    dec.answer_obj  # segundo consumidor: já em cache
+    return ctx, chunks
+
+
+def bench_decode():
+    events = [_message_data(n) for n in range(0, 400, 4)]
+    total = sum(len(d) for d in events)
+    assert all(_legacy_decode(d) == _new_decode(d) for d in events)
+    print(f"{len(events)} eventos 'message' ({total} bytes), decodificados por evento")
+    print(f"{'decodificador':>26} {'tempo (ms)':>11} {'µs/evento':>10}")
+
+    def row(label, fn):
+        t = _best_of(lambda: [fn(d) for d in events], repeat=5)
+        print(f"{label:>26} {t * 1e3:>11.2f} {t / len(events) * 1e6:>10.1f}")
+
+    row("legado (json)", _legacy_decode)
+    saved = event_decoder.json_loads
+    event_decoder.json_loads = json.loads
+    try:
+        row("event_decoder (json)", _new_decode)
+    finally:
+        event_decoder.json_loads = saved
+    if event_decoder.JSON_BACKEND != "json":
+        row(f"event_decoder ({event_decoder.JSON_BACKEND})", _new_decode)
+
+
+def _legacy_suffix(prev: str, full_text: str) -> str:
+    """Cópia do _print_only_new_suffix() antigo (sem o print)."""
+    i = 0
+    while i < len(prev) and i < len(full_text) and prev[i] == full_text[i]:
+        i += 1
+    suffix = full_text[i:]
+    if not suffix or not suffix.strip():
+        return ""
+    import re as _re
+    norm = _re.sub(r"[\r\n]+", " ", suffix.lstrip())
+    norm = _re.sub(r"\s{2,}", " ", norm)
+    norm = _re.sub(r"\s+([,.;:!?%\)\]\}\»])", r"\1", norm)
+    return norm.lstrip()
+
+
+def bench_suffix():
+    # snapshots cumulativos como os do upstream: cada evento acrescenta um chunk
+    def run_legacy(chunks):
+        prev = ""
+        out = []
+        for k in range(1, len(chunks) + 1):
+            full = "".join(chunks[:k])
+            out.append(_legacy_suffix(prev, full))
+            prev = full
+        return out
+
+    def run_new(chunks):
+        asm = StreamTextAssembler()
+        return [asm.feed("".join(chunks[:k])) for k in range(1, len(chunks) + 1)]
+
+    def run_join(chunks):
+        # custo de montar os snapshots (comum aos dois; descontado)
+        for k in range(1, len(chunks) + 1):
+            "".join(chunks[:k])
+
+    print("Resposta de N chunks, um snapshot acumulado por chunk (montagem dos snapshots descontada)")
+    print(f"{'chunks':>8} {'texto':>8} {'legado (ms)':>12} {'stream_text (ms)':>17} {'µs/evento':>10}")
+    for n in (1000, 2000, 4000, 8000):
+        chunks = [f"palavra{i} com mais texto,\n" if i % 7 == 0 else f"palavra{i} com texto " for i in range(n)]
+        if n <= 2000:
+            assert run_legacy(chunks) == run_new(chunks)
+        t_join = _best_of(lambda: run_join(chunks))
+        t_new = max(0.0, _best_of(lambda: run_new(chunks)) - t_join)
+        t_old = max(0.0, _best_of(lambda: run_legacy(chunks), repeat=1) - t_join) if n <= 2000 else float("nan")
+        size = sum(len(c) for c in chunks)
+        print(f"{n:>8} {size:>8} {t_old * 1e3:>12.1f} {t_new * 1e3:>17.1f} {t_new / n * 1e6:>10.2f}")
+
+
+def _legacy_payload(query, ctx, language='pt-BR', sources=('web',), is_followup=False):
+    """Cópia do dict que _build_payload()/gen_resp() montavam a cada requisição."""
+    return {
+        'query_str': query,
+        'params': {
+            'last_backend_uuid': ctx.last_backend_uuid,
+            'context_uuid': ctx.context_uuid,
+            'frontend_context_uuid': ctx.frontend_context_uuid,
+            'read_write_token': ctx.read_write_token,
+            'attachments': [],
+            'language': language,
+            'timezone': 'America/Sao_Paulo',
+            'search_focus': 'internet',
+            'frontend_uuid': ctx.frontend_uuid,
+            'is_related_query': False,
+            'is_sponsored': False,
+            'visitor_id': ctx.visitor_id,
+            'user_nextauth_id': ctx.user_nextauth_id,
+            'prompt_source': 'user',
+            'query_source': 'followup' if (ctx.context_uuid or ctx.read_write_token or ctx.last_backend_uuid) else 'home',
+            'is_incognito': False,
+            'time_from_first_type': None,
+            'local_search_enabled': False,
+            'use_schematized_api': True,
+            'send_back_text_in_streaming_api': False,
+            'supported_block_use_cases': [
+                'answer_modes', 'media_items', 'knowledge_cards',
+                'inline_entity_cards', 'place_widgets', 'finance_widgets',
+                'sports_widgets', 'shopping_widgets', 'jobs_widgets',
+                'search_result_widgets', 'clarification_responses',
+                'inline_images', 'inline_assets', 'inline_finance_widgets',
+                'placeholder_cards', 'diff_blocks', 'inline_knowledge_cards', 'entity_group_v2'
+            ],
+            'client_coordinates': None,
+            'mentions': [],
+            'dsl_query': query,
+            'skip_search_enabled': True,
+            'is_nav_suggestions_disabled': False,
+            'always_search_override': False,
+            'override_no_search': False,
+            'comet_max_assistant_enabled': False,
+            'followup_source': 'link' if is_followup else None,
+            'mode': 'concise',
+            'model_preference': 'turbo',
+            'source': 'default',
+            'sources': list(sources),
+            'version': '2.18',
+            'search_recency_filter': None,
+        }
+    }
+
+
+def bench_payload():
+    ctx = SimpleNamespace(
+        last_backend_uuid="0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0", context_uuid="c0ffee00-1234-5678-9abc-def012345678",
+        frontend_context_uuid="f00dbabe-1234-5678-9abc-def012345678", read_write_token="rw-0123456789abcdef",
+        frontend_uuid="fe000000-1234-5678-9abc-def012345678", visitor_id="v0000000-1234-5678-9abc-def012345678",
+        user_nextauth_id=None,
+    )
+    builder = AskRequestBuilder()
+    n = 20_000
+    print(f"{n} corpos do perplexity_ask por variante")
+    print(f"{'pergunta':>10} {'dict + json.dumps (µs)':>23} {'request_builder (µs)':>21}")
+    for size in (40, 1_500, 6_000):
+        query = ("Como organizar minha rotina matinal? " * (size // 37 + 1))[:size]
+        for followup in (False, True):
+            # os dois caminhos (cliente e servidor) saem do mesmo builder e equivalem ao dict antigo
+            assert json.loads(builder.build(query, ctx, is_followup=followup)) == _legacy_payload(query, ctx, is_followup=followup)
+        t_old = _best_of(lambda: [json.dumps(_legacy_payload(query, ctx)).encode() for _ in range(n)])
+        t_new = _best_of(lambda: [builder.build(query, ctx) for _ in range(n)])
+        print(f"{size:>10} {t_old / n * 1e6:>23.2f} {t_new / n * 1e6:>21.2f}")
+
+
+def bench_metrics():
+    reg = MetricsRegistry("pplx_")
+    hist = reg.histogram("upstream_open_seconds", "abertura", ("outcome",))
+    counter = reg.counter("responses_total", "respostas", ("mode", "source"))
+    n = 1_000_000
+    print(f"{n} observações por métrica")
+    t_hist = _best_of(lambda: [hist.observe(0.12, "ok") for _ in range(n)])
+    t_counter = _best_of(lambda: [counter.inc("stream", "upstream") for _ in range(n)])
+    t_render = _best_of(lambda: [reg.render() for _ in range(1_000)])
+    print(f"histogram.observe: {t_hist / n * 1e9:.0f} ns")
+    print(f"counter.inc:       {t_counter / n * 1e9:.0f} ns")
+    print(f"render (/metrics): {t_render / 1_000 * 1e6:.1f} µs")
+
+
+def _cold_import_ms(code: str, repeat: int = 7) -> float:
+    # processo novo a cada medida: nada em cache no interpretador
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def bench_startup():
+    from chat_client import STARTUP_BUDGET_MS
+
+    base = _cold_import_ms("pass")
+    print(f"interpretador sozinho: {base:.0f} ms (descontado abaixo)")
+    cases = [
+        ("import chat_client", "import chat_client"),
+        ("  + ChatClient().session", "import chat_client; chat_client.ChatClient().session"),
+    ]
+    if importlib.util.find_spec("openai") is not None:
+        # o que o chat_client antigo importava antes do primeiro prompt
+        cases.append(("legado: openai + requests", "import openai, requests, sse_framer, event_decoder, stream_text"))
+    for label, code in cases:
+        print(f"{label:<28} {_cold_import_ms(code) - base:7.1f} ms")
+    own = _cold_import_ms("import chat_client") - base
+    verdict = "dentro do" if own <= STARTUP_BUDGET_MS else "ACIMA do"
+    print(f"import chat_client: {own:.1f} ms, {verdict} orçamento de {STARTUP_BUDGET_MS} ms")
+
+
+BENCHES = {
+    "sse": bench_sse,
+    "decode": bench_decode,
+    "suffix": bench_suffix,
+    "payload": bench_payload,
+    "metrics": bench_metrics,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        if name not in BENCHES:
+            raise SystemExit(f"benchmark desconhecido: {name} (opções: {', '.join(BENCHES)})")
+        BENCHES[name]()
+        print()
@@ -1,17 +1,43 @@
 # chat_client.py
-from openai import OpenAI
-from uuid import uuid4
-import requests
-import json
+"""Cliente de linha de comando (e biblioteca) do /v1/responses em streaming.
+
+Uso como biblioteca:
+
+    from chat_client import ChatClient
+
+    with ChatClient() as chat:
+        for text in chat.stream("Monte minha rotina de amanhã", conversation_id="ana"):
+            print(text, end="", flush=True)
+
+ChatClient mantém uma requests.Session para reaproveitar a conexão com o
+servidor entre as perguntas (antes, cada requests.post abria uma conexão
+nova). O módulo não importa o SDK da OpenAI (nunca usado: todo o tráfego já
+passava por requests) e só importa requests na primeira pergunta; a CLI faz
+esse import em background enquanto espera o conversation_id. O custo de
+partida a frio é medido por ``python bench_micro.py startup`` contra
+STARTUP_BUDGET_MS.
+
+SSETextStream converte os eventos de uma resposta no texto novo de cada
+evento, com os fallbacks de parse para os formatos vistos no upstream; um
+objeto por resposta, então vários streams podem correr em paralelo.
+"""
 import re
 import sys
+import threading
+from uuid import uuid4
+
+from sse_framer import iter_sse_events
+from event_decoder import PerplexityEvent, decode_event, json_loads
+from stream_text import StreamTextAssembler
+
+__all__ = ["ChatClient", "ChatHTTPError", "SSETextStream", "iter_sse_text", "print_sse_stream", "STARTUP_BUDGET_MS"]
 
 BASE_URL = "http://127.0.0.1:8000/v1"
 API_KEY = "123"
 MODEL = "gpt-4o"
 
-_STREAM_ACC = ""
-_PENDING_WS = ""
+# orçamento do import do módulo a frio, além do próprio interpretador (bench_micro.py startup)
+STARTUP_BUDGET_MS = 50
 
 # DEBUG: altere para False para silenciar logs
 DEBUG = False
@@ -20,45 +46,6 @@ def _dbg(msg: str):
     if DEBUG:
         print(f"[debug] {msg}", file=sys.stderr, flush=True)
 
-def extract_text(resp):
-    # Tenta 'output_text' (SDK costuma expor)
-    try:
-        txt = getattr(resp, "output_text", None)
-        if txt:
-            return txt
-    except Exception:
-        pass
-    # Fallback no payload bruto
-    try:
-        output = getattr(resp, "output", None) or resp.get("output")  # type: ignore
-        if isinstance(output, list) and output:
-            first = output[0]
-            if isinstance(first, dict):
-                content = first.get("content")
-                if isinstance(content, list) and content:
-                    for c in content:
-                        if isinstance(c, dict) and c.get("type") in {"output_text", "text"}:
-                            if c.get("text"):
-                                return c["text"]
-    except Exception:
-        pass
-    return "(sem conteúdo)"
-
-def _print_chunks_from_answer_payload(obj: dict) -> bool:
-    """Imprime SOMENTE chunks da resposta (sem fallback para 'answer' completo)."""
-    try:
-        if not isinstance(obj, dict):
-            return False
-        chunks = obj.get("chunks")
-        if not isinstance(chunks, list):
-            return False
-        safe = [c for c in chunks if isinstance(c, str) and c and c.strip()]
-        if not safe:
-            return False
-        return _print_only_new_suffix("".join(safe))
-    except Exception:
-        return False
-
 def _iter_possible_json_docs(s: str):
     """Tenta fatiar strings com múltiplos JSON concatenados (ex.: "] [" ou "}{")."""
     # primeiro, quebras comuns
@@ -93,59 +80,6 @@ def _iter_possible_json_docs(s: str):
     for doc in out:
         yield doc
 
-def _try_extract_answer_from_raw(delta_str: str) -> bool:
-    """Best-effort: extrair answer/chunks de uma string que contém JSON escapado."""
-    # procura por chave "answer": "{...}" (JSON escapado)
-    m = re.search(r'"answer"\s*:\s*"(\{.*?\})"', delta_str)
-    if not m:
-        return False
-    raw = m.group(1)
-    try:
-        # desescapa aspas
-        unescaped = raw.encode('utf-8').decode('unicode_escape')
-        obj = json.loads(unescaped)
-    except Exception:
-        return False
-    return _print_chunks_from_answer_payload(obj)
-
-def _try_print_perplexity_steps(delta_str: str) -> bool:
-    """Imprime SOMENTE chunks do campo answer dentro de steps FINAL (sem fallback)."""
-    try:
-        payload = json.loads(delta_str)
-    except Exception:
-        return False
-
-    printed = False
-    # formatos esperados: lista de steps ou dict com 'text' que é string JSON desses steps
-    if isinstance(payload, dict) and isinstance(payload.get('text'), str):
-        try:
-            payload = json.loads(payload['text'])
-        except Exception:
-            return False
-    if isinstance(payload, list):
-        for step in payload:
-            if not isinstance(step, dict):
-                continue
-            stype = step.get('step_type')
-            if stype == 'INITIAL_QUERY':
-                continue
-            if stype == 'FINAL':
-                content = step.get('content') or {}
-                ans_str = content.get('answer')
-                if isinstance(ans_str, str):
-                    try:
-                        ans_obj = json.loads(ans_str)
-                    except Exception:
-                        ans_obj = None
-                    if isinstance(ans_obj, dict):
-                        # Somente chunks
-                        chunks = ans_obj.get('chunks')
-                        if isinstance(chunks, list):
-                            safe_chunks = [ch for ch in chunks if isinstance(ch, str) and ch and ch.strip()]
-                            if safe_chunks and _print_only_new_suffix(''.join(safe_chunks)):
-                                printed = True
-    return printed
-
 def _extract_inner_jsons_from_data_carrier(s: str) -> list[str]:
     """Extrai todos os objetos JSON que seguem após ocorrências de 'data: ' em uma string.
     Usa balanceamento de chaves para encontrar o término de cada JSON.
@@ -195,34 +129,6 @@ def _extract_inner_jsons_from_data_carrier(s: str) -> list[str]:
         i = k
     return out
 
-def _try_handle_event_message_carrier(s: str) -> bool:
-    """Tratamento especial quando o delta contém um envelope 'event: message' com linhas 'data: {...}'.
-    Extrai os payloads data:, faz json.loads, e tenta imprimir SOMENTE a partir de answer/chunks.
-    """
-    if 'data:' not in s:
-        return False
-    try:
-        handled_any = False
-        for payload in _extract_inner_jsons_from_data_carrier(s):
-            try:
-                obj = json.loads(payload)
-            except Exception:
-                continue
-            text_field = obj.get('text') if isinstance(obj, dict) else None
-            if isinstance(text_field, str) and text_field:
-                # Imprimir apenas se houver chunks em answer
-                if _try_print_perplexity_steps(text_field):
-                    handled_any = True
-                    continue
-                for doc in _iter_possible_json_docs(text_field):
-                    if _try_print_perplexity_steps(doc):
-                        handled_any = True
-                        break
-                # sem fallback para answer completo/strings avulsas
-        return handled_any
-    except Exception:
-        return False
-
 def _iter_data_payload_json_objs(s: str):
     """Itera objetos JSON imediatamente após marcadores 'data: ' na string s.
     Usa balanceamento de chaves para capturar objetos mesmo sem quebra de linha entre eventos.
@@ -266,66 +172,263 @@ def _iter_data_payload_json_objs(s: str):
                         break
             k += 1
         try:
-            obj = json.loads(s[j:k])
+            obj = json_loads(s[j:k])
             yield obj
         except Exception:
             pass
         i = k
 
-def _reset_stream_acc():
-    global _STREAM_ACC
-    global _PENDING_WS
-    _STREAM_ACC = ""
-    _PENDING_WS = ""
 
-def _print_only_new_suffix(full_text: str) -> bool:
-    """Imprime apenas o sufixo não impresso ainda com base em _STREAM_ACC.
-    Retorna True se imprimiu algo.
+class SSETextStream:
+    """Texto novo de cada evento de uma resposta SSE (um objeto por resposta).
+
+    Cada evento do Perplexity traz a resposta acumulada; só o sufixo ainda não
+    entregue sai (ver StreamTextAssembler). Erros estruturados viram uma linha
+    "[erro] ...".
     """
-    global _STREAM_ACC, _PENDING_WS
-    prev = _STREAM_ACC or ""
-    # encontra prefixo comum
-    i = 0
-    try:
-        while i < len(prev) and i < len(full_text) and prev[i] == full_text[i]:
-            i += 1
-    except Exception:
-        i = 0
-    suffix = full_text[i:]
-    _dbg(f"_print_only_new_suffix: prev_len={len(prev)} new_len={len(full_text)} common_prefix={i} suffix={suffix!r}")
-    # Não imprimir sufixos que sejam apenas whitespace (inclui quebras de linha)
-    if not suffix or not suffix.strip():
-        _dbg("_print_only_new_suffix: sufixo vazio/whitespace -> ignorado")
-        _PENDING_WS += suffix
-        _STREAM_ACC = full_text
-        return False
-    # Remover qualquer whitespace inicial (inclui quebras de linha e espaços) para evitar buracos
-    suffix2 = suffix.lstrip()
-    if not suffix2:
-        _STREAM_ACC = full_text
-        return False
-    # Normalização agressiva para evitar quebras de linha: substituir \r/\n por espaço e colapsar múltiplos espaços
-    try:
-        import re as _re
-        # troca quebras por espaço
-        norm = _re.sub(r"[\r\n]+", " ", suffix2)
-        # colapsa múltiplos espaços
-        norm = _re.sub(r"\s{2,}", " ", norm)
-        # remove espaço antes de pontuação comum
-        norm = _re.sub(r"\s+([,.;:!?%\)\]\}\»])", r"\1", norm)
-        # opcional: remove espaço no início absoluto
-        norm = norm.lstrip()
-    except Exception:
-        norm = suffix2
-    if not norm:
-        _STREAM_ACC = full_text
+
+    def __init__(self):
+        self._acc = StreamTextAssembler()
+        self._out: list[str] = []
+
+    def _emit_chunks_from_answer_payload(self, obj: dict) -> bool:
+        """Emite SOMENTE chunks da resposta (sem fallback para 'answer' completo)."""
+        try:
+            if not isinstance(obj, dict):
+                return False
+            chunks = obj.get("chunks")
+            if not isinstance(chunks, list):
+                return False
+            safe = [c for c in chunks if isinstance(c, str) and c and c.strip()]
+            if not safe:
+                return False
+            return self._emit_only_new_suffix("".join(safe))
+        except Exception:
+            return False
+
+    def _try_extract_answer_from_raw(self, delta_str: str) -> bool:
+        """Best-effort: extrair answer/chunks de uma string que contém JSON escapado."""
+        # procura por chave "answer": "{...}" (JSON escapado)
+        m = re.search(r'"answer"\s*:\s*"(\{.*?\})"', delta_str)
+        if not m:
+            return False
+        raw = m.group(1)
+        try:
+            # desescapa aspas
+            unescaped = raw.encode('utf-8').decode('unicode_escape')
+            obj = json_loads(unescaped)
+        except Exception:
+            return False
+        return self._emit_chunks_from_answer_payload(obj)
+
+    def _try_emit_perplexity_steps(self, delta) -> bool:
+        """Emite SOMENTE chunks do campo answer dentro de steps FINAL (sem fallback).
+
+        Aceita o data do evento (str) ou um PerplexityEvent já decodificado.
+        """
+        dec = delta if isinstance(delta, PerplexityEvent) else decode_event(delta)
+        if dec is None:
+            return False
+        # formatos esperados: lista de steps ou dict com 'text' que é string JSON desses steps
+        ans_obj = dec.answer_obj
+        if ans_obj is None:
+            return False
+        # Somente chunks
+        chunks = ans_obj.get('chunks')
+        if isinstance(chunks, list):
+            safe_chunks = [ch for ch in chunks if isinstance(ch, str) and ch and ch.strip()]
+            if safe_chunks and self._emit_only_new_suffix(''.join(safe_chunks)):
+                return True
         return False
-    print(norm, end="", flush=True)
-    _STREAM_ACC = full_text
-    return True
+
+    def _try_handle_event_message_carrier(self, s: str) -> bool:
+        """Tratamento especial quando o delta contém um envelope 'event: message' com linhas 'data: {...}'.
+        Extrai os payloads data:, faz json.loads, e tenta emitir SOMENTE a partir de answer/chunks.
+        """
+        if 'data:' not in s:
+            return False
+        try:
+            handled_any = False
+            for payload in _extract_inner_jsons_from_data_carrier(s):
+                try:
+                    obj = json_loads(payload)
+                except Exception:
+                    continue
+                text_field = obj.get('text') if isinstance(obj, dict) else None
+                if isinstance(text_field, str) and text_field:
+                    # Emitir apenas se houver chunks em answer
+                    if self._try_emit_perplexity_steps(text_field):
+                        handled_any = True
+                        continue
+                    for doc in _iter_possible_json_docs(text_field):
+                        if self._try_emit_perplexity_steps(doc):
+                            handled_any = True
+                            break
+                    # sem fallback para answer completo/strings avulsas
+            return handled_any
+        except Exception:
+            return False
+
+    def _emit_only_new_suffix(self, full_text: str) -> bool:
+        """Emite apenas o sufixo ainda não emitido (ver StreamTextAssembler).
+        Retorna True se emitiu algo.
+        """
+        norm = self._acc.feed(full_text)
+        _dbg(f"_emit_only_new_suffix: new_len={len(full_text)} rewrites={self._acc.rewrites} printed={norm!r}")
+        if not norm:
+            return False
+        self._out.append(norm)
+        return True
+
+    def feed(self, data_str: str) -> str:
+        """Texto novo do data de um evento SSE ('' se nada novo)."""
+        self._handle(data_str.strip())
+        text = "".join(self._out)
+        self._out.clear()
+        return text
+
+    def _handle(self, data_str: str):
+        if not data_str:
+            _dbg("empty data_str; skipping")
+            return
+        # tenta parsear como JSON OpenAI/Perplexity, com vários fallbacks para casos reais
+        # decodifica uma única vez; steps/answer ficam sob demanda no PerplexityEvent
+        dec = decode_event(data_str)
+        if dec is not None:
+            # 1) tentar interpretar como steps do Perplexity
+            if self._try_emit_perplexity_steps(dec):
+                _dbg("handled by _try_emit_perplexity_steps (JSON parsed)")
+                return
+            # 2) tentar extrair answer/chunks de JSON escapado
+            if self._try_extract_answer_from_raw(data_str):
+                _dbg("handled by _try_extract_answer_from_raw (JSON parsed)")
+                return
+            # 3) erro estruturado
+            if dec.error is not None:
+                self._out.append(f"\n[erro] {dec.error}\n")
+                _dbg("handled by error branch (JSON parsed)")
+                return
+            _dbg("JSON parsed but no handler printed anything")
+            return
+        _dbg("decode_event failed; trying alternative handlers")
+        # payload possivelmente com JSON concatenado ou escapado; evitar despejar bruto
+        handled = False
+        # 0) tentar extrair inner JSON de 'event: message' e emitir
+        if self._try_handle_event_message_carrier(data_str):
+            _dbg("handled by _try_handle_event_message_carrier")
+            handled = True
+        for doc in _iter_possible_json_docs(data_str):
+            if self._try_emit_perplexity_steps(doc):
+                _dbg("handled by _iter_possible_json_docs -> _try_emit_perplexity_steps")
+                handled = True
+        # não usar fallback de texto bruto nem answer completo
+        # tenta interpretar JSON de steps do Perplexity
+        if not handled and data_str.lstrip().startswith(('{', '[')):
+            if self._try_emit_perplexity_steps(data_str):
+                _dbg("handled by _try_emit_perplexity_steps (direct fallback)")
+        # se nada foi tratado, não emite nada
+
+
+def iter_sse_text(chunks):
+    """Texto novo de cada evento de um stream SSE (iterável de bytes)."""
+    stream = SSETextStream()
+    for ev in iter_sse_events(chunks):
+        _dbg(f"event {ev.name!r} assembled; data_str[0:200]={ev.data[:200]!r}")
+        text = stream.feed(ev.data)
+        if text:
+            yield text
+
+
+def print_sse_stream(chunks):
+    """Imprime a resposta de um stream SSE (iterável de bytes) com os fallbacks de parse."""
+    for text in iter_sse_text(chunks):
+        print(text, end="", flush=True)
+
+
+class ChatHTTPError(Exception):
+    """Resposta não-200 do servidor."""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+        self.body = body
+
+
+class ChatClient:
+    """Cliente de streaming do /v1/responses com uma sessão HTTP persistente.
+
+    Args:
+        base_url: URL base da API OpenAI-compat (até /v1)
+        api_key: enviada como Bearer
+        model: campo "model" das requisições
+        timeout: (conexão, leitura) em segundos; a leitura vale entre dois pedaços do stream
+    """
+
+    def __init__(self, base_url: str = BASE_URL, api_key: str = API_KEY, model: str = MODEL,
+                 timeout: tuple = (5.0, 300.0)):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """requests.Session criada (e requests importado) no primeiro uso."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+
+                    session = requests.Session()
+                    session.headers.update({
+                        "Authorization": f"Bearer {self.api_key}",
+                        "Content-Type": "application/json",
+                    })
+                    self._session = session
+        return self._session
+
+    def warm_up(self) -> threading.Thread:
+        """Importa requests e cria a sessão em background (ex.: enquanto a CLI espera input)."""
+        thread = threading.Thread(target=lambda: self.session, name="chat-client-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def stream(self, question: str, conversation_id: str | None = None, **extra):
+        """Texto da resposta conforme chega, um pedaço por evento.
+
+        Raises:
+            ChatHTTPError: status diferente de 200
+        """
+        data = {"model": self.model, "input": question, "stream": True, **extra}
+        if conversation_id:
+            data["conversation_id"] = conversation_id
+        with self.session.post(f"{self.base_url}/responses", json=data, stream=True, timeout=self.timeout) as r:
+            if r.status_code != 200:
+                raise ChatHTTPError(r.status_code, r.text[:1000])
+            yield from iter_sse_text(r.iter_content(chunk_size=None))
+
+    def ask(self, question: str, conversation_id: str | None = None, **extra) -> str:
+        """Resposta completa (consome o stream)."""
+        return "".join(self.stream(question, conversation_id, **extra))
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 def main():
-    client = OpenAI(api_key=API_KEY, base_url=BASE_URL)
+    client = ChatClient()
+    # requests e a sessão ficam prontos enquanto o usuário digita
+    client.warm_up()
 
     print("\nIniciando interação com o usuário...\n")
     try:
@@ -334,128 +437,43 @@ def main():
         initial = ""
     conversation_id = initial if initial else str(uuid4())
 
-    while True:
-        q = input("\nDigite sua pergunta (ou 'sair' para encerrar): ")
-        if q.strip().lower() in {"sair", "exit", "quit"}:
-            print("\nAté logo! 👋")
-            break
+    try:
+        while True:
+            q = input("\nDigite sua pergunta (ou 'sair' para encerrar): ")
+            if q.strip().lower() in {"sair", "exit", "quit"}:
+                print("\nAté logo! 👋")
+                break
 
-        # Comandos de controle de conversa
-        if q.startswith(":id ") or q.startswith("/id "):
-            new_id = q.split(" ", 1)[1].strip()
-            if new_id:
-                conversation_id = new_id
-                print(f"[ok] Trocado conversation_id para: {conversation_id}")
-            else:
-                print("[erro] Use: :id <valor>")
-            continue
-        if q.strip().lower() in {":new", "/new"}:
-            conversation_id = str(uuid4())
-            print(f"[ok] Novo conversation_id: {conversation_id}")
-            continue
+            # Comandos de controle de conversa
+            if q.startswith(":id ") or q.startswith("/id "):
+                new_id = q.split(" ", 1)[1].strip()
+                if new_id:
+                    conversation_id = new_id
+                    print(f"[ok] Trocado conversation_id para: {conversation_id}")
+                else:
+                    print("[erro] Use: :id <valor>")
+                continue
+            if q.strip().lower() in {":new", "/new"}:
+                conversation_id = str(uuid4())
+                print(f"[ok] Novo conversation_id: {conversation_id}")
+                continue
 
-        print("\n📝 Resposta (streaming):")
-        # reinicia acumulador de sufixo a cada nova pergunta/stream
-        _reset_stream_acc()
-        current = []
-        try:
-            url = f"{BASE_URL}/responses"
-            headers = {
-                "Authorization": f"Bearer {API_KEY}",
-                "Content-Type": "application/json",
-            }
-            data = {"model": MODEL, "input": q, "stream": True, "conversation_id": conversation_id}
+            print("\n📝 Resposta (streaming):")
             print(f"[info] usando conversation_id={conversation_id}")
-            with requests.post(url, headers=headers, json=data, stream=True) as r:
-                if r.status_code != 200:
-                    print(f"Erro: status {r.status_code}")
-                    try:
-                        print(r.text[:1000])
-                    except Exception:
-                        pass
-                    continue
-                for raw in r.iter_lines(decode_unicode=True):
-                    try:
-                        line = raw.decode('utf-8') if isinstance(raw, bytes) else raw
-                    except Exception:
-                        line = raw if isinstance(raw, str) else ''
-                    _dbg(f"recv line: {line!r}")
-                    if line is None:
-                        continue
-                    line = line.rstrip('\r')
-                    if line == '':
-                        # evento completo
-                        printed_any = False
-                        data_lines = []
-                        for l in current:
-                            if l.startswith('data:'):
-                                data_lines.append(l[len('data:'):].lstrip())
-                        data_str = '\n'.join(data_lines).strip()
-                        _dbg(f"event assembled with {len(current)} lines; data_str[0:200]={data_str[:200]!r}")
-                        current = []
-                        if not data_str:
-                            _dbg("empty data_str; skipping")
-                            continue
-                        # tenta parsear como JSON OpenAI/Perplexity, com vários fallbacks para casos reais
-                        try:
-                            j = json.loads(data_str)
-                            handled = False
-                            # 1) tentar interpretar como steps do Perplexity
-                            if _try_print_perplexity_steps(data_str):
-                                _dbg("handled by _try_print_perplexity_steps (JSON parsed)")
-                                handled = True
-                            # 2) tentar extrair answer/chunks de JSON escapado
-                            if not handled and _try_extract_answer_from_raw(data_str):
-                                _dbg("handled by _try_extract_answer_from_raw (JSON parsed)")
-                                handled = True
-                            # 3) erro estruturado
-                            if not handled and isinstance(j, dict) and "error" in j:
-                                msg = j.get("error", {}).get("message") or "erro desconhecido"
-                                print(f"\n[erro] {msg}")
-                                _dbg("handled by error branch (JSON parsed)")
-                                handled = True
-                            if handled:
-                                printed_any = True
-                                _dbg("printed_any=True (JSON path)")
-                                continue
-                            else:
-                                _dbg("JSON parsed but no handler printed anything")
-                        except Exception:
-                            _dbg("json.loads failed; trying alternative handlers")
-                            # payload possivelmente com JSON concatenado ou escapado; evitar despejar bruto
-                            handled = False
-                            # 0) tentar extrair inner JSON de 'event: message' e imprimir
-                            if _try_handle_event_message_carrier(data_str):
-                                _dbg("handled by _try_handle_event_message_carrier")
-                                handled = True
-                            for doc in _iter_possible_json_docs(data_str):
-                                if _try_print_perplexity_steps(doc):
-                                    _dbg("handled by _iter_possible_json_docs -> _try_print_perplexity_steps")
-                                    handled = True
-                            # não usar fallback de texto bruto nem answer completo
-                            # tenta interpretar JSON de steps do Perplexity
-                            if (not handled and data_str and data_str.lstrip().startswith(('{', '['))):
-                                if _try_print_perplexity_steps(data_str):
-                                    _dbg("handled by _try_print_perplexity_steps (direct fallback)")
-                                    handled = True
-                            # se nada foi tratado, não imprime nada
-                        # se nada foi impresso, garante linha após término forçado
-                        if not printed_any:
-                            _dbg("no content printed for event; skipping newline")
-                    else:
-                        # linha não-vazia: acumula até o próximo separador em branco
-                        if line.startswith('event:'):
-                            _dbg(f"event header: {line}")
-                        current.append(line)
+            try:
+                for text in client.stream(q, conversation_id):
+                    print(text, end="", flush=True)
                 # não emitir quebra de linha forçada ao final
-        except StopIteration:
-            # não emitir quebra de linha forçada ao final
-            pass
-        except KeyboardInterrupt:
-            print()  # garante quebra de linha se interromper no meio do stream
-            return
-        except Exception as e:
-            print(f"Erro no streaming SSE: {e}")
+            except ChatHTTPError as e:
+                print(f"Erro: status {e.status_code}")
+                print(e.body)
+            except KeyboardInterrupt:
+                print()  # garante quebra de linha se interromper no meio do stream
+                return
+            except Exception as e:
+                print(f"Erro no streaming SSE: {e}")
+    finally:
+        client.close()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,170 @@
+# context_persistence.py
+"""Persistência em disco do contexto das conversas (SQLite, write-behind).
+
+Guarda os campos que garantem a continuidade de uma conversa no Perplexity
+(last_backend_uuid, context_uuid, frontend_context_uuid, read_write_token),
+mais a conta do upstream à qual a conversa está presa (account_pool), para
+que um deploy ou crash não derrube as threads em andamento.
+
+As gravações nunca acontecem no caminho do evento: save() só registra o
+último estado da conversa em um dict pendente e uma thread dedicada grava em
+lote. Várias atualizações da mesma conversa entre dois flushes viram uma
+única escrita. Cada entrada só sai do pendente depois do commit do lote (e
+se não foi substituída no meio tempo): load() a enxerga durante a gravação e
+uma falha do SQLite a deixa para o próximo flush.
+"""
+import sqlite3
+import threading
+import time
+
+CONTEXT_FIELDS = ("last_backend_uuid", "context_uuid", "frontend_context_uuid", "read_write_token", "account")
+
+
+class ConversationContextDB:
+    """Armazena o contexto por conversation_id em SQLite.
+
+    Args:
+        path: arquivo do banco
+        flush_interval: intervalo máximo (s) entre gravações em lote
+        max_age: contextos sem atualização há mais que isso (s) são apagados na abertura (0 desativa)
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5, max_age: float = 7 * 24 * 3600):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pending: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = False
+        self.writes = 0
+        self.write_errors = 0
+        self._failing = False
+        self.loads = 0
+        self.rehydrated = 0
+
+        self._read_conn = self._connect()
+        self._read_conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_context ("
+            " conversation_id TEXT PRIMARY KEY,"
+            " last_backend_uuid TEXT, context_uuid TEXT,"
+            " frontend_context_uuid TEXT, read_write_token TEXT,"
+            " updated_at REAL NOT NULL, account TEXT)"
+        )
+        # bancos criados antes do rodízio de contas
+        columns = {row[1] for row in self._read_conn.execute("PRAGMA table_info(conversation_context)")}
+        if "account" not in columns:
+            self._read_conn.execute("ALTER TABLE conversation_context ADD COLUMN account TEXT")
+        if max_age:
+            self._read_conn.execute("DELETE FROM conversation_context WHERE updated_at < ?", (time.time() - max_age,))
+        self._read_conn.commit()
+
+        self._writer = threading.Thread(target=self._run, name="context-db-writer", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        # vários workers (PPLX_WORKERS) podem usar o mesmo arquivo: espera o lock em vez de falhar
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10.0)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def save(self, conversation_id: str, ctx: dict):
+        """Agenda a gravação do contexto (não bloqueia)."""
+        with self._lock:
+            self._pending[conversation_id] = {f: ctx.get(f) for f in CONTEXT_FIELDS}
+        self._wake.set()
+
+    def load(self, conversation_id: str) -> dict | None:
+        """Lê o contexto salvo (inclui gravações ainda pendentes)."""
+        self.loads += 1
+        with self._lock:
+            pending = self._pending.get(conversation_id)
+        if pending is not None:
+            self.rehydrated += 1
+            return dict(pending)
+        try:
+            row = self._read_conn.execute(
+                "SELECT last_backend_uuid, context_uuid, frontend_context_uuid, read_write_token, account"
+                " FROM conversation_context WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        self.rehydrated += 1
+        return dict(zip(CONTEXT_FIELDS, row))
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                self._flush(conn)
+                if self._stop:
+                    return
+        finally:
+            conn.close()
+
+    def _flush(self, conn):
+        with self._lock:
+            # cópia: as entradas continuam pendentes (visíveis para load()) até o commit
+            batch = dict(self._pending)
+        if not batch:
+            return
+        now = time.time()
+        rows = [(cid, *(ctx.get(f) for f in CONTEXT_FIELDS), now) for cid, ctx in batch.items()]
+        try:
+            # o lote inteiro numa transação: ou grava tudo ou nada
+            conn.execute("BEGIN")
+            conn.executemany(
+                "INSERT INTO conversation_context"
+                " (conversation_id, last_backend_uuid, context_uuid, frontend_context_uuid, read_write_token, account, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(conversation_id) DO UPDATE SET"
+                " last_backend_uuid=excluded.last_backend_uuid, context_uuid=excluded.context_uuid,"
+                " frontend_context_uuid=excluded.frontend_context_uuid,"
+                " read_write_token=excluded.read_write_token, account=excluded.account,"
+                " updated_at=excluded.updated_at",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            try:
+                conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            self.write_errors += 1
+            if not self._failing:
+                self._failing = True
+                print(f"⚠️ Falha ao gravar contexto das conversas (nova tentativa a cada flush): {e}")
+            return
+        if self._failing:
+            self._failing = False
+            print("✅ Contexto das conversas voltou a ser gravado")
+        self.writes += len(rows)
+        with self._lock:
+            # só sai o que não foi substituído por um save() durante a gravação
+            for cid, ctx in batch.items():
+                if self._pending.get(cid) is ctx:
+                    del self._pending[cid]
+
+    def close(self):
+        """Grava o que estiver pendente e encerra a thread de escrita."""
+        self._stop = True
+        self._wake.set()
+        self._writer.join(timeout=5)
+        self._read_conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "path": self.path,
+            "pending": pending,
+            "writes": self.writes,
+            "write_errors": self.write_errors,
+            "loads": self.loads,
+            "rehydrated": self.rehydrated,
+        }
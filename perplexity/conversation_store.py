@@ -0,0 +1,135 @@
+# conversation_store.py
+"""Mapa limitado conversation_id -> cliente Perplexity.
+
+Substitui o dict CONVERSATIONS que crescia para sempre: mantém no máximo
+``max_entries`` conversas (LRU) e descarta as que ficaram ociosas por mais de
+``idle_ttl`` segundos, fechando a sessão curl_cffi de quem sai. Conversas em
+uso (checkout sem checkin) nunca são despejadas.
+"""
+import asyncio
+import inspect
+import time
+from collections import OrderedDict
+
+
+class _Entry:
+    __slots__ = ("client", "last_used", "busy")
+
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.busy = 0
+
+
+class ConversationStore:
+    """Armazena clientes por conversa com despejo LRU + TTL de ociosidade.
+
+    Args:
+        factory: factory(key) cria o cliente de uma conversa nova
+        max_entries: número máximo de conversas mantidas
+        idle_ttl: segundos sem uso até a conversa ser descartada (0 desativa)
+    """
+
+    def __init__(self, factory, max_entries: int = 1000, idle_ttl: float = 1800.0):
+        self._factory = factory
+        self.max_entries = max(1, int(max_entries))
+        self.idle_ttl = max(0.0, float(idle_ttl))
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._closing: set = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions_lru = 0
+        self.evictions_ttl = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def checkout(self, key: str):
+        """Retorna o cliente da conversa (criando se preciso) e o marca como em uso."""
+        now = time.monotonic()
+        self._evict_expired(now)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = _Entry(self._factory(key))
+            self._entries[key] = entry
+            self._evict_overflow()
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        entry.busy += 1
+        entry.last_used = now
+        return entry.client
+
+    def checkin(self, key: str):
+        """Libera a conversa após o uso (o TTL de ociosidade conta a partir daqui)."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        entry.busy = max(0, entry.busy - 1)
+        entry.last_used = time.monotonic()
+
+    def _evict_expired(self, now: float):
+        if not self.idle_ttl:
+            return
+        expired = []
+        # ordem do OrderedDict = ordem de último acesso; para no primeiro não expirado
+        for key, entry in self._entries.items():
+            if now - entry.last_used < self.idle_ttl:
+                break
+            if not entry.busy:
+                expired.append(key)
+        for key in expired:
+            self._drop(key)
+            self.evictions_ttl += 1
+
+    def _evict_overflow(self):
+        excess = len(self._entries) - self.max_entries
+        if excess <= 0:
+            return
+        victims = [k for k, e in self._entries.items() if not e.busy][:excess]
+        for key in victims:
+            self._drop(key)
+            self.evictions_lru += 1
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self.close_client(entry.client)
+
+    def close_client(self, client):
+        """Fecha um cliente (sync ou async) sem bloquear; usado também para clientes avulsos."""
+        try:
+            res = client.close()
+        except Exception:
+            return
+        if inspect.isawaitable(res):
+            try:
+                task = asyncio.get_running_loop().create_task(res)
+            except RuntimeError:
+                res.close()
+                return
+            # mantém referência até terminar para a task não ser coletada
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+    async def aclose(self):
+        """Fecha todas as sessões (uso no shutdown do servidor)."""
+        for key in list(self._entries):
+            self._drop(key)
+        if self._closing:
+            await asyncio.gather(*self._closing, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "idle_ttl_s": self.idle_ttl,
+            "busy": sum(1 for e in self._entries.values() if e.busy),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions_lru": self.evictions_lru,
+            "evictions_ttl": self.evictions_ttl,
+        }
@@ -0,0 +1,220 @@
+# conversation_turns.py
+"""Serialização de requisições por conversa.
+
+Duas requisições sobrepostas no mesmo conversation_id leem e atualizam o
+mesmo last_backend_uuid/read_write_token, o que bifurca a thread no upstream.
+Aqui cada conversa tem no máximo uma requisição em andamento ("turno"); o
+que acontece com quem chega enquanto o turno está ocupado depende da
+política:
+
+    queue  - aguarda na fila da conversa (até max_wait)
+    reject - recusa na hora (ConversationBusy)
+    cancel - interrompe o turno em andamento (e quem estiver na fila) e assume
+
+Conversas diferentes nunca se bloqueiam.
+"""
+import asyncio
+import time
+from collections import OrderedDict, deque
+
+POLICIES = ("queue", "reject", "cancel")
+
+
+class ConversationBusy(Exception):
+    """Conversa ocupada (política reject ou espera além de max_wait)."""
+
+
+class TurnSuperseded(Exception):
+    """O turno foi interrompido por uma requisição mais nova da mesma conversa."""
+
+
+class _Turn:
+    """Turno de uma requisição na conversa. release() é idempotente."""
+
+    __slots__ = ("key", "wait_s", "superseded", "_owner", "_task", "_released")
+
+    def __init__(self, owner: "ConversationTurns", key: str, wait_s: float):
+        self._owner = owner
+        self.key = key
+        self.wait_s = wait_s
+        self.superseded = False
+        self._task = None
+        self._released = False
+
+    def supersede(self):
+        self.superseded = True
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+
+    async def run(self, coro):
+        """Executa coro de forma cancelável pela política 'cancel'."""
+        self._task = asyncio.ensure_future(coro)
+        try:
+            return await self._task
+        except asyncio.CancelledError:
+            if self.superseded:
+                raise TurnSuperseded("requisição substituída por outra mais nova na mesma conversa")
+            raise
+        finally:
+            self._task = None
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._owner._release(self.key)
+
+
+class _Slot:
+    __slots__ = ("holder", "waiters")
+
+    def __init__(self):
+        self.holder = None
+        self.waiters: deque = deque()
+
+
+class _ConvStats:
+    __slots__ = ("turns", "waits", "wait_total", "wait_max", "last_wait", "rejected", "superseded")
+
+    def __init__(self):
+        self.turns = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.last_wait = 0.0
+        self.rejected = 0
+        self.superseded = 0
+
+
+class ConversationTurns:
+    """Um turno por conversa, com política configurável para requisições concorrentes.
+
+    Args:
+        policy: 'queue', 'reject' ou 'cancel'
+        max_wait: segundos máximos aguardando o turno (política queue/cancel)
+        max_tracked: conversas com estatísticas mantidas (LRU)
+    """
+
+    def __init__(self, policy: str = "queue", max_wait: float = 60.0, max_tracked: int = 1000):
+        if policy not in POLICIES:
+            raise ValueError(f"política inválida: {policy!r} (use {', '.join(POLICIES)})")
+        self.policy = policy
+        self.max_wait = max_wait
+        self.max_tracked = max_tracked
+        self._slots: dict[str, _Slot] = {}
+        self._stats: "OrderedDict[str, _ConvStats]" = OrderedDict()
+
+    def _conv_stats(self, key: str) -> _ConvStats:
+        st = self._stats.get(key)
+        if st is None:
+            st = self._stats[key] = _ConvStats()
+            if len(self._stats) > self.max_tracked:
+                self._stats.popitem(last=False)
+        else:
+            self._stats.move_to_end(key)
+        return st
+
+    async def acquire(self, key: str) -> _Turn:
+        """Obtém o turno da conversa conforme a política."""
+        st = self._conv_stats(key)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = self._slots[key] = _Slot()
+        if slot.holder is None and not slot.waiters:
+            return self._grant(slot, key, st, 0.0)
+
+        if self.policy == "reject":
+            st.rejected += 1
+            raise ConversationBusy("já existe uma requisição em andamento nesta conversa")
+        if self.policy == "cancel":
+            # só a requisição mais nova interessa: derruba o turno atual e a fila
+            if slot.holder is not None and not slot.holder.superseded:
+                slot.holder.supersede()
+                st.superseded += 1
+            while slot.waiters:
+                fut = slot.waiters.popleft()
+                if not fut.done():
+                    fut.set_exception(TurnSuperseded("requisição substituída por outra mais nova na mesma conversa"))
+                    st.superseded += 1
+
+        fut = asyncio.get_running_loop().create_future()
+        slot.waiters.append(fut)
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait((fut,), timeout=self.max_wait)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self._release(key)
+            else:
+                fut.cancel()
+                self._discard(slot, fut)
+            raise
+        if not fut.done():
+            fut.cancel()
+            self._discard(slot, fut)
+            st.rejected += 1
+            raise ConversationBusy("tempo máximo de espera pelo turno da conversa excedido")
+        fut.result()  # propaga TurnSuperseded
+        return self._grant(slot, key, st, time.monotonic() - t0)
+
+    def _grant(self, slot: _Slot, key: str, st: _ConvStats, wait_s: float) -> _Turn:
+        turn = _Turn(self, key, wait_s)
+        # o turno pode ter sido derrubado entre a transferência e a retomada deste waiter
+        if slot.holder is not None and slot.holder.superseded:
+            turn.superseded = True
+        slot.holder = turn
+        st.turns += 1
+        st.last_wait = wait_s
+        if wait_s > 0:
+            st.waits += 1
+            st.wait_total += wait_s
+            st.wait_max = max(st.wait_max, wait_s)
+        return turn
+
+    def _discard(self, slot: _Slot, fut):
+        try:
+            slot.waiters.remove(fut)
+        except ValueError:
+            pass
+
+    def _release(self, key: str):
+        slot = self._slots.get(key)
+        if slot is None:
+            return
+        slot.holder = None
+        while slot.waiters:
+            fut = slot.waiters.popleft()
+            if not fut.done():
+                # o turno passa direto para o próximo; _grant registra o novo holder
+                slot.holder = _Turn(self, key, 0.0)
+                fut.set_result(None)
+                return
+        del self._slots[key]
+
+    def conversation_stats(self, key: str) -> dict | None:
+        st = self._stats.get(key)
+        if st is None:
+            return None
+        slot = self._slots.get(key)
+        return {
+            "turns": st.turns,
+            "in_flight": bool(slot is not None and slot.holder is not None),
+            "queued": len(slot.waiters) if slot is not None else 0,
+            "waits": st.waits,
+            "wait_ms_last": round(1000 * st.last_wait, 2),
+            "wait_ms_avg": round(1000 * st.wait_total / st.waits, 2) if st.waits else 0.0,
+            "wait_ms_max": round(1000 * st.wait_max, 2),
+            "rejected": st.rejected,
+            "superseded": st.superseded,
+        }
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "active": sum(1 for s in self._slots.values() if s.holder is not None),
+            "queued": sum(len(s.waiters) for s in self._slots.values()),
+            "tracked": len(self._stats),
+            "wait_ms_max": round(1000 * max((s.wait_max for s in self._stats.values()), default=0.0), 2),
+            "rejected": sum(s.rejected for s in self._stats.values()),
+            "superseded": sum(s.superseded for s in self._stats.values()),
+        }
@@ -0,0 +1,186 @@
+# event_decoder.py
+"""Decodificação única dos eventos do Perplexity (JSON dentro de JSON dentro de JSON).
+
+Cada evento 'message' do upstream tem três camadas de JSON:
+
+    data            -> dict com backend_uuid, context_uuid, read_write_token, text, blocks...
+    data['text']    -> string JSON com a lista de steps
+    FINAL.content['answer'] -> string JSON com {'answer': ..., 'chunks': [...]}
+
+Antes, servidor e chat_client decodificavam as mesmas camadas várias vezes
+por evento. decode_event() faz o parse externo uma vez e as camadas internas
+sob demanda, guardando o resultado: quem só precisa dos ids de contexto não
+paga pelos steps, e quem precisa da resposta não repete o trabalho.
+
+Usa orjson ou msgspec quando instalados (PPLX_JSON_BACKEND=json força a
+stdlib).
+"""
+import json
+import os
+
+__all__ = ["JSON_BACKEND", "DECODE_ERRORS", "json_loads", "decode_event", "PerplexityEvent"]
+
+DECODE_ERRORS: tuple = (ValueError, TypeError)
+_backend = os.environ.get("PPLX_JSON_BACKEND", "auto").lower()
+json_loads = json.loads
+JSON_BACKEND = "json"
+
+if _backend in ("auto", "orjson"):
+    try:
+        import orjson
+
+        json_loads = orjson.loads
+        JSON_BACKEND = "orjson"
+    except ImportError:
+        pass
+if JSON_BACKEND == "json" and _backend in ("auto", "msgspec"):
+    try:
+        import msgspec
+
+        json_loads = msgspec.json.Decoder().decode
+        DECODE_ERRORS = (ValueError, TypeError, msgspec.DecodeError)
+        JSON_BACKEND = "msgspec"
+    except ImportError:
+        pass
+
+_UNSET = object()
+
+
+def _loads_or_none(s):
+    try:
+        return json_loads(s)
+    except DECODE_ERRORS:
+        return None
+
+
+class PerplexityEvent:
+    """Evento do Perplexity decodificado uma única vez.
+
+    ``obj`` é o dict externo; ``steps``, ``final_step``, ``answer_obj``,
+    ``answer_text`` e ``answer_chunks`` são decodificados no primeiro acesso.
+    """
+
+    __slots__ = ("obj", "_steps", "_final", "_answer_obj")
+
+    def __init__(self, obj: dict, steps=_UNSET):
+        self.obj = obj
+        self._steps = steps
+        self._final = _UNSET
+        self._answer_obj = _UNSET
+
+    # --- contexto da conversa (camada externa) ---
+    @property
+    def backend_uuid(self):
+        return self.obj.get("backend_uuid")
+
+    @property
+    def context_uuid(self):
+        return self.obj.get("context_uuid")
+
+    @property
+    def frontend_context_uuid(self):
+        return self.obj.get("frontend_context_uuid")
+
+    @property
+    def read_write_token(self):
+        return self.obj.get("read_write_token")
+
+    @property
+    def error(self):
+        """Mensagem de erro se o evento for {'error': {...}} (ex.: gerado pelo servidor)."""
+        err = self.obj.get("error")
+        if isinstance(err, dict):
+            return err.get("message") or "erro desconhecido"
+        if isinstance(err, str):
+            return err
+        return None
+
+    @property
+    def is_completed(self):
+        return self.obj.get("type") == "response.completed" or self.obj.get("final") is True
+
+    # --- camadas internas (sob demanda) ---
+    @property
+    def steps(self):
+        """Lista de steps (campo 'text' decodificado) ou None."""
+        if self._steps is _UNSET:
+            text = self.obj.get("text")
+            if isinstance(text, str):
+                text = _loads_or_none(text) if text[:1] in ("[", "{") else None
+            self._steps = text if isinstance(text, list) else None
+        return self._steps
+
+    @property
+    def final_step(self):
+        if self._final is _UNSET:
+            self._final = None
+            for step in self.steps or ():
+                if isinstance(step, dict) and step.get("step_type") == "FINAL":
+                    self._final = step
+                    break
+        return self._final
+
+    @property
+    def answer_obj(self):
+        """Conteúdo decodificado de FINAL.content.answer ({'answer', 'chunks', ...}) ou None."""
+        if self._answer_obj is _UNSET:
+            self._answer_obj = None
+            final = self.final_step
+            content = final.get("content") if final else None
+            ans = content.get("answer") if isinstance(content, dict) else None
+            if isinstance(ans, str):
+                ans = _loads_or_none(ans)
+            if isinstance(ans, dict):
+                self._answer_obj = ans
+        return self._answer_obj
+
+    @property
+    def answer_text(self):
+        """Resposta cumulativa até este evento (FINAL.answer ou blocos markdown) ou None."""
+        ans = self.answer_obj
+        if ans is not None and isinstance(ans.get("answer"), str):
+            return ans["answer"]
+        chunks = self._block_chunks()
+        if chunks is not None:
+            return "".join(chunks)
+        return None
+
+    @property
+    def answer_chunks(self):
+        """Chunks de texto da resposta (strings não vazias) ou None."""
+        ans = self.answer_obj
+        chunks = ans.get("chunks") if ans is not None else None
+        if not isinstance(chunks, list):
+            chunks = self._block_chunks()
+        if chunks is None:
+            return None
+        return [c for c in chunks if isinstance(c, str) and c]
+
+    def _block_chunks(self):
+        # formato "schematized": blocks[].markdown_block.chunks
+        blocks = self.obj.get("blocks")
+        if not isinstance(blocks, list):
+            return None
+        for block in blocks:
+            md = block.get("markdown_block") if isinstance(block, dict) else None
+            if isinstance(md, dict) and isinstance(md.get("chunks"), list):
+                return md["chunks"]
+        return None
+
+    def as_dict(self) -> dict:
+        """Dict externo com 'text' já substituído pelos steps (formato de search())."""
+        steps = self.steps
+        if steps is not None and isinstance(self.obj.get("text"), str):
+            self.obj["text"] = steps
+        return self.obj
+
+
+def decode_event(data) -> PerplexityEvent | None:
+    """Decodifica o data de um evento (str/bytes). None se não for JSON de dict/lista."""
+    obj = _loads_or_none(data)
+    if isinstance(obj, dict):
+        return PerplexityEvent(obj)
+    if isinstance(obj, list):
+        # payload que já é a lista de steps
+        return PerplexityEvent({}, steps=obj)
+    return None
@@ -0,0 +1,164 @@
+# metrics.py
+"""Métricas do servidor no formato texto do Prometheus (GET /metrics).
+
+Implementação mínima, sem dependências: contadores, gauges e histogramas com
+rótulos, guardados em dicts indexados pela tupla de valores dos rótulos. No
+caminho quente o custo é um acesso a dict (e um bisect nos histogramas); a
+formatação do texto só acontece quando o Prometheus coleta.
+
+Gauges podem receber uma função, avaliada na coleta; assim tamanhos que já
+existem nos componentes (conversas, fila de admissão, pool) não precisam ser
+atualizados a cada requisição.
+
+O servidor roda num único event loop, então não há locks.
+"""
+from bisect import bisect_left
+
+__all__ = ["Counter", "Gauge", "Histogram", "MetricsRegistry", "CONTENT_TYPE", "LATENCY_BUCKETS", "SIZE_BUCKETS"]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# segundos: de uma abertura de stream rápida (~50ms) a respostas longas do modelo
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+# bytes
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Contador monotônico; inc() recebe os valores dos rótulos na ordem declarada."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        super().__init__(name, help, labels)
+        self._values: dict = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values) -> float:
+        return self._values.get(label_values, 0)
+
+    def render(self) -> list:
+        lines = self._header()
+        for values, v in self._values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, values)} {_num(v)}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Valor instantâneo: set() explícito ou ``fn`` avaliada na coleta (sem rótulos)."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), fn=None):
+        super().__init__(name, help, labels)
+        self._values: dict = {}
+        self._fn = fn
+
+    def set(self, value: float, *label_values):
+        self._values[label_values] = value
+
+    def render(self) -> list:
+        lines = self._header()
+        if self._fn is not None:
+            lines.append(f"{self.name} {_num(self._fn())}")
+            return lines
+        for values, v in self._values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, values)} {_num(v)}")
+        return lines
+
+
+class Histogram(_Metric):
+    """Histograma com buckets fixos; guarda contagens por bucket (não cumulativas) até a coleta."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # rótulos -> [contagem por bucket..., +Inf, soma]
+        self._series: dict = {}
+
+    def observe(self, value: float, *label_values):
+        series = self._series.get(label_values)
+        if series is None:
+            series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, *label_values) -> int:
+        series = self._series.get(label_values)
+        return sum(series[:-1]) if series else 0
+
+    def render(self) -> list:
+        lines = self._header()
+        names = self.label_names
+        for values, series in self._series.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), series):
+                cumulative += n
+                le = 'le="' + _num(bound) + '"'
+                lines.append(f"{self.name}_bucket{_labels(names, values, le)} {cumulative}")
+            lbl = _labels(names, values)
+            lines.append(f"{self.name}_sum{lbl} {_num(round(series[-1], 6))}")
+            lines.append(f"{self.name}_count{lbl} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Conjunto de métricas exposto em /metrics."""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: list = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(self.prefix + name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = (), fn=None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
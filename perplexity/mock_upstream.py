@@ -0,0 +1,317 @@
+# mock_upstream.py
+"""Upstream do Perplexity simulado, para benchmarks e testes sem rede.
+
+Atende as duas rotas que os clientes usam:
+
+    GET  /api/auth/session          -> {} (cookies de sessão não são verificados)
+    POST /rest/sse/perplexity_ask   -> stream SSE no formato do upstream
+
+Cada resposta é uma sequência de eventos ``event: message`` com snapshots
+cumulativos do step FINAL (o texto inteiro até ali, como o Perplexity faz),
+seguida de ``event: end_of_stream``. Tamanho da resposta, número de eventos,
+ritmo, variação do ritmo e falhas são configuráveis:
+
+    403   - desafio do Cloudflare (HTTP 403 com HTML)
+    5xx   - HTTP 502
+    html  - HTTP 200 com Content-Type text/html
+    drop  - conexão fechada no meio do stream
+    stall - HTTP 200 com SSE, mas nenhum evento (o stream fica parado)
+
+Contas bloqueadas (``blocked_cookies``): perplexity_ask com algum desses
+cookies ("nome=valor") recebe sempre o 403 do Cloudflare, como uma conta
+limitada pelo upstream (rodízio de contas, ver account_pool).
+
+Para apontar o servidor para cá: PPLX_UPSTREAM_URL=http://127.0.0.1:<porta>.
+
+Uso:
+    python mock_upstream.py --port 8787 --events 20 --answer-chars 1500 --interval 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+from uuid import uuid4
+
+__all__ = ["MockUpstreamConfig", "MockUpstream", "ERROR_KINDS", "DEFAULT_ERRORS", "add_config_arguments", "config_from_args"]
+
+ERROR_KINDS = ("403", "5xx", "html", "drop", "stall")
+# stall só entra no sorteio se pedido: sem detecção de stall o cliente espera para sempre
+DEFAULT_ERRORS = ("403", "5xx", "html", "drop")
+
+_WORDS = (
+    "rotina", "tarefa", "manhã", "foco", "pausa", "agenda", "prioridade", "hábito",
+    "semana", "energia", "bloco", "revisão", "meta", "descanso", "planejamento", "tempo",
+)
+
+_CF_PAGE = b"<!DOCTYPE html><html><head><title>Just a moment...</title></head><body>cf-challenge</body></html>"
+
+
+class MockUpstreamConfig:
+    """Forma das respostas simuladas.
+
+    Args:
+        events: eventos 'message' por resposta
+        answer_chars: tamanho da resposta final (caracteres)
+        first_event_delay: segundos até o primeiro evento (tempo de "pensar" do modelo)
+        auth_delay: segundos para responder /api/auth/session (simula handshake/Cloudflare)
+        interval: segundos entre eventos
+        jitter: variação máxima (+/-) aplicada a cada intervalo
+        error_rate: fração das requisições que falham (0..1)
+        errors: tipos de falha sorteados (ver ERROR_KINDS)
+        seed: semente do sorteio de falhas e do jitter (None = aleatório)
+        blocked_cookies: cookies ("nome=valor") cujas requisições recebem sempre 403
+    """
+
+    def __init__(self, events: int = 20, answer_chars: int = 1500, first_event_delay: float = 0.2,
+                 auth_delay: float = 0.0, interval: float = 0.02, jitter: float = 0.0, error_rate: float = 0.0,
+                 errors: tuple = DEFAULT_ERRORS, seed: int | None = None, blocked_cookies: tuple = ()):
+        unknown = set(errors) - set(ERROR_KINDS)
+        if unknown:
+            raise ValueError(f"tipos de falha desconhecidos: {', '.join(sorted(unknown))} (use {', '.join(ERROR_KINDS)})")
+        self.events = max(1, int(events))
+        self.answer_chars = max(1, int(answer_chars))
+        self.first_event_delay = max(0.0, float(first_event_delay))
+        self.auth_delay = max(0.0, float(auth_delay))
+        self.interval = max(0.0, float(interval))
+        self.jitter = max(0.0, float(jitter))
+        self.error_rate = min(1.0, max(0.0, float(error_rate)))
+        self.errors = tuple(errors) or DEFAULT_ERRORS
+        self.seed = seed
+        self.blocked_cookies = tuple(blocked_cookies)
+
+
+def _answer(chars: int) -> str:
+    rnd = random.Random(chars)
+    words = []
+    size = 0
+    while size < chars:
+        w = rnd.choice(_WORDS)
+        words.append(w)
+        size += len(w) + 1
+    return " ".join(words)[:chars]
+
+
+class MockUpstream:
+    """Servidor HTTP/1.1 mínimo (asyncio, keep-alive, corpo SSE em chunked)."""
+
+    def __init__(self, config: MockUpstreamConfig | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.config = config or MockUpstreamConfig()
+        self.host = host
+        self.port = port
+        self._server = None
+        self._rnd = random.Random(self.config.seed)
+        answer = _answer(self.config.answer_chars)
+        n = self.config.events
+        # pontos de corte dos snapshots cumulativos (o último é a resposta inteira)
+        self._cuts = [max(1, len(answer) * (i + 1) // n) for i in range(n)]
+        self._answer = answer
+        self.requests = 0
+        self.auth_requests = 0
+        self.streams = 0
+        self.failures = {kind: 0 for kind in ERROR_KINDS}
+        self.bytes_sent = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "auth_requests": self.auth_requests,
+            "streams": self.streams,
+            "failures": dict(self.failures),
+            "bytes_sent": self.bytes_sent,
+        }
+
+    # --- HTTP ---
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, path, _ = (lines[0].split(" ", 2) + ["", ""])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    name, sep, value = line.partition(":")
+                    if sep:
+                        headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length") or 0)
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = headers.get("connection", "").lower() != "close"
+                self.requests += 1
+                if path.startswith("/api/auth/session"):
+                    self.auth_requests += 1
+                    if self.config.auth_delay:
+                        await asyncio.sleep(self.config.auth_delay)
+                    await self._send(writer, 200, "application/json", b"{}", keep_alive)
+                elif method == "POST" and path.startswith("/rest/sse/perplexity_ask"):
+                    keep_alive = await self._ask(reader, writer, body, headers.get("cookie", "")) and keep_alive
+                else:
+                    await self._send(writer, 404, "text/plain", b"not found", keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            # cliente caiu ou o servidor simulado está sendo encerrado
+            pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status: int, content_type: str, body: bytes, keep_alive: bool = True):
+        head = (
+            f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        ).encode("latin-1")
+        writer.write(head + body)
+        self.bytes_sent += len(head) + len(body)
+        await writer.drain()
+
+    def _delay(self, base: float) -> float:
+        jitter = self.config.jitter
+        return max(0.0, base + self._rnd.uniform(-jitter, jitter)) if jitter else base
+
+    def _event(self, ctx: dict, query: str, cut: int, final: bool) -> bytes:
+        text = self._answer[:cut]
+        answer = json.dumps({"answer": text, "chunks": [text]}, ensure_ascii=False)
+        steps = [
+            {"step_type": "INITIAL_QUERY", "content": {"query": query}},
+            {"step_type": "FINAL", "content": {"answer": answer}},
+        ]
+        data = {
+            **ctx,
+            "status": "COMPLETED" if final else "PENDING",
+            "final": final,
+            "text": json.dumps(steps, ensure_ascii=False),
+        }
+        return f"event: message\r\ndata: {json.dumps(data, ensure_ascii=False)}\r\n\r\n".encode("utf-8")
+
+    async def _ask(self, reader, writer, body: bytes, cookie: str = "") -> bool:
+        """Responde um perplexity_ask; False se a conexão não pode ser reaproveitada."""
+        cfg = self.config
+        failure = None
+        if cfg.blocked_cookies and any(c.strip() in cfg.blocked_cookies for c in cookie.split(";")):
+            failure = "403"
+        elif cfg.error_rate and self._rnd.random() < cfg.error_rate:
+            failure = self._rnd.choice(cfg.errors)
+        if failure is not None and failure not in ("drop", "stall"):
+            self.failures[failure] += 1
+            if failure == "403":
+                await self._send(writer, 403, "text/html; charset=UTF-8", _CF_PAGE)
+            elif failure == "5xx":
+                await self._send(writer, 502, "text/html", b"<html>Bad gateway</html>")
+            else:
+                await self._send(writer, 200, "text/html; charset=UTF-8", _CF_PAGE)
+            return True
+
+        try:
+            req = json.loads(body or b"{}")
+        except ValueError:
+            req = {}
+        params = req.get("params") or {}
+        ctx = {
+            "backend_uuid": str(uuid4()),
+            "context_uuid": params.get("context_uuid") or str(uuid4()),
+            "frontend_context_uuid": params.get("frontend_context_uuid") or str(uuid4()),
+            "read_write_token": params.get("read_write_token") or uuid4().hex,
+        }
+        query = req.get("query_str") or ""
+
+        head = (
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/event-stream; charset=utf-8\r\n"
+            "Transfer-Encoding: chunked\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("latin-1")
+        writer.write(head)
+        self.bytes_sent += len(head)
+        self.streams += 1
+        cuts = self._cuts
+        drop_at = len(cuts) // 2 if failure == "drop" else None
+        if failure == "stall":
+            self.failures["stall"] += 1
+            # cabeçalhos enviados e nada mais: só termina quando o cliente desiste (EOF)
+            await writer.drain()
+            await reader.read()
+            return False
+        await asyncio.sleep(self._delay(cfg.first_event_delay))
+        for i, cut in enumerate(cuts):
+            if i == drop_at:
+                self.failures["drop"] += 1
+                # sem o chunk terminal: o cliente vê a conexão cair no meio do stream
+                return False
+            if i:
+                await asyncio.sleep(self._delay(cfg.interval))
+            self._write_chunk(writer, self._event(ctx, query, cut, final=i == len(cuts) - 1))
+            await writer.drain()
+        self._write_chunk(writer, b"event: end_of_stream\r\ndata: {}\r\n\r\n")
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+        return True
+
+    def _write_chunk(self, writer, data: bytes):
+        frame = b"%x\r\n%s\r\n" % (len(data), data)
+        writer.write(frame)
+        self.bytes_sent += len(frame)
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    """Opções de linha de comando de MockUpstreamConfig (compartilhadas com bench_load.py)."""
+    g = parser.add_argument_group("upstream simulado")
+    g.add_argument("--events", type=int, default=20, help="eventos por resposta (padrão: 20)")
+    g.add_argument("--answer-chars", type=int, default=1500, help="tamanho da resposta final (padrão: 1500)")
+    g.add_argument("--first-event-delay", type=float, default=0.2, help="segundos até o primeiro evento (padrão: 0.2)")
+    g.add_argument("--auth-delay", type=float, default=0.0, help="segundos para responder /api/auth/session (padrão: 0)")
+    g.add_argument("--interval", type=float, default=0.02, help="segundos entre eventos (padrão: 0.02)")
+    g.add_argument("--jitter", type=float, default=0.0, help="variação +/- de cada intervalo (padrão: 0)")
+    g.add_argument("--error-rate", type=float, default=0.0, help="fração de requisições com falha (padrão: 0)")
+    g.add_argument("--errors", default=",".join(DEFAULT_ERRORS),
+                   help=f"falhas sorteadas entre {','.join(ERROR_KINDS)} (padrão: {','.join(DEFAULT_ERRORS)})")
+    g.add_argument("--seed", type=int, default=None, help="semente das falhas e do jitter")
+    g.add_argument("--blocked-cookie", action="append", default=[], metavar="NOME=VALOR",
+                   help="conta bloqueada: perplexity_ask com esse cookie recebe sempre 403 (repetível)")
+
+
+def config_from_args(args) -> MockUpstreamConfig:
+    return MockUpstreamConfig(
+        events=args.events, answer_chars=args.answer_chars, first_event_delay=args.first_event_delay,
+        auth_delay=args.auth_delay,
+        interval=args.interval, jitter=args.jitter, error_rate=args.error_rate,
+        errors=tuple(e.strip() for e in args.errors.split(",") if e.strip()), seed=args.seed,
+        blocked_cookies=tuple(args.blocked_cookie),
+    )
+
+
+async def _serve(args):
+    mock = await MockUpstream(config_from_args(args), host=args.host, port=args.port).start()
+    print(f"Upstream simulado em {mock.url} (use PPLX_UPSTREAM_URL={mock.url})")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await mock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upstream do Perplexity simulado (sem rede)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    add_config_arguments(parser)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
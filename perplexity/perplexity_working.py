@@ -1,14 +1,136 @@
 from curl_cffi import requests
+from curl_cffi import CurlError
+from curl_cffi.requests.exceptions import ConnectTimeout
+import asyncio
+import functools
 import json
+import os
+import time
+from collections import deque
 from uuid import uuid4
 
-class WorkingPerplexityClient:
+from sse_framer import SSEEvent, iter_sse_events, aiter_sse_events
+from event_decoder import decode_event, json_loads
+from request_builder import build_ask_body
+from upstream_retry import UpstreamStallError
+
+
+class PerplexityUpstreamError(Exception):
+    """Resposta do upstream inutilizável (HTTP != 200 ou content-type inesperado)."""
+
+    def __init__(self, message, status_code=None, body='', retry_after=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.body = body
+        # header Retry-After da resposta (texto cru), se veio
+        self.retry_after = retry_after
+
+
+def _upstream_problem(response):
+    """Descreve o problema do upstream (status/Content-Type) ou None se utilizável."""
+    if response.status_code != 200:
+        return f"Erro HTTP: {response.status_code}"
+    # valida Content-Type do upstream (evita parse de HTML do Cloudflare)
+    ct = (response.headers.get('content-type') or '').lower()
+    if 'text/event-stream' not in ct:
+        return f"Upstream content-type inesperado: {ct or 'desconhecido'}"
+    return None
+
+
+def _check_upstream_response(response):
+    """Levanta PerplexityUpstreamError se a resposta não for um stream SSE válido."""
+    problem = _upstream_problem(response)
+    if problem is None:
+        return
+    try:
+        body = response.text[:1000]
+    except Exception:
+        body = ''
+    raise PerplexityUpstreamError(f"{problem} | body: {body}", status_code=response.status_code, body=body,
+                                  retry_after=response.headers.get('retry-after'))
+
+
+async def _acheck_upstream_response(response):
+    """Versão assíncrona de _check_upstream_response (lê o body via acontent())."""
+    problem = _upstream_problem(response)
+    if problem is None:
+        return
+    try:
+        body = (await response.acontent()).decode('utf-8', 'ignore')[:1000]
+    except Exception:
+        body = ''
+    raise PerplexityUpstreamError(f"{problem} | body: {body}", status_code=response.status_code, body=body,
+                                  retry_after=response.headers.get('retry-after'))
+
+
+def _upstream_outcome(exc) -> str:
+    """Rótulo do resultado da abertura do stream (métricas): ok, http_403, http_5xx, content_type..."""
+    if exc is None:
+        return "ok"
+    if isinstance(exc, PerplexityUpstreamError):
+        code = exc.status_code
+        if code == 200:
+            # status 200 com HTML (desafio do Cloudflare) em vez de SSE
+            return "content_type"
+        if code in (401, 403, 429):
+            return f"http_{code}"
+        if code is not None and code >= 500:
+            return "http_5xx"
+        return "http_4xx"
+    if isinstance(exc, UpstreamStallError):
+        return "stall"
+    if isinstance(exc, asyncio.CancelledError):
+        return "cancelled"
+    return "transport"
+
+
+# erros do curl em que a pergunta não saiu: proxy/DNS não resolvidos, conexão recusada, handshake TLS
+_NOT_SENT_CURL_CODES = frozenset((5, 6, 7, 35, 97))
+
+
+def _request_not_sent(exc) -> bool:
+    """True se a falha aconteceu antes de a pergunta chegar ao upstream (repetir não duplica o turno)."""
+    if isinstance(exc, ConnectTimeout):
+        return True
+    code = getattr(exc, "code", None)
+    return isinstance(exc, CurlError) and code is not None and int(code) in _NOT_SENT_CURL_CODES
+
+
+# PPLX_UPSTREAM_URL aponta para outro host (ex.: o upstream simulado de mock_upstream.py)
+_UPSTREAM_URL = os.environ.get("PPLX_UPSTREAM_URL", "https://www.perplexity.ai").rstrip("/")
+_AUTH_URL = f'{_UPSTREAM_URL}/api/auth/session'
+_ASK_URL = f'{_UPSTREAM_URL}/rest/sse/perplexity_ask'
+
+_BROWSER_HEADERS = {
+    'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
+    'accept-language': 'en-US,en;q=0.9',
+    'cache-control': 'max-age=0',
+    'dnt': '1',
+    'priority': 'u=0, i',
+    'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
+    'sec-ch-ua-arch': '"x86"',
+    'sec-ch-ua-bitness': '"64"',
+    'sec-ch-ua-full-version': '"128.0.6613.120"',
+    'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-model': '""',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-ch-ua-platform-version': '"19.0.0"',
+    'sec-fetch-dest': 'document',
+    'sec-fetch-mode': 'navigate',
+    'sec-fetch-site': 'same-origin',
+    'sec-fetch-user': '?1',
+    'upgrade-insecure-requests': '1',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
+}
+
+
+class _PerplexityClientBase:
     """
-    Cliente Perplexity funcional que resolve o problema de retorno None.
+    Estado de conversa e montagem de requisições comuns aos clientes sync e async.
     """
-    
-    def __init__(self, cookies={}):
-        self.session = requests.Session(impersonate="chrome110")
+
+    def _init_context(self):
         # Variáveis para manter contexto da conversa
         self.last_backend_uuid = None
         self.read_write_token = None
@@ -17,235 +139,80 @@ class WorkingPerplexityClient:
         self.user_nextauth_id = None
         self.context_uuid = None
         self.frontend_context_uuid = None
-        # Update headers
-        self.session.headers.update({
-            'accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.7',
-            'accept-language': 'en-US,en;q=0.9',
-            'cache-control': 'max-age=0',
-            'dnt': '1',
-            'priority': 'u=0, i',
-            'sec-ch-ua': '"Not;A=Brand";v="24", "Chromium";v="128"',
-            'sec-ch-ua-arch': '"x86"',
-            'sec-ch-ua-bitness': '"64"',
-            'sec-ch-ua-full-version': '"128.0.6613.120"',
-            'sec-ch-ua-full-version-list': '"Not;A=Brand";v="24.0.0.0", "Chromium";v="128.0.6613.120"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-model': '""',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-ch-ua-platform-version': '"19.0.0"',
-            'sec-fetch-dest': 'document',
-            'sec-fetch-mode': 'navigate',
+        # callback(dict) chamado quando algum campo de contexto muda (ex.: persistência)
+        self.on_context_change = None
+        # contexto de rotina já enviado nesta conversa (RoutineContextState, usado pelo servidor)
+        self.routine_context = None
+
+    def context_snapshot(self):
+        """Campos que garantem a continuidade da conversa no upstream."""
+        return {
+            'last_backend_uuid': self.last_backend_uuid,
+            'context_uuid': self.context_uuid,
+            'frontend_context_uuid': self.frontend_context_uuid,
+            'read_write_token': self.read_write_token,
+        }
+
+    def restore_context(self, ctx):
+        """Reidrata o contexto salvo por context_snapshot()."""
+        for field in ('last_backend_uuid', 'context_uuid', 'frontend_context_uuid', 'read_write_token'):
+            if ctx.get(field):
+                setattr(self, field, ctx[field])
+
+    def _build_payload(self, query, sources=['web'], language='pt-BR', is_followup=False):
+        """Corpo JSON (bytes) do perplexity_ask com o contexto atual da conversa."""
+        return build_ask_body(query, self, language=language, sources=sources, is_followup=is_followup)
+
+    def _sse_headers(self, session=None):
+        return {
+            **(session or self.session).headers,
+            'accept': 'text/event-stream',
+            'content-type': 'application/json',
+            'origin': 'https://www.perplexity.ai',
+            'referer': 'https://www.perplexity.ai/',
+            'sec-fetch-mode': 'cors',
             'sec-fetch-site': 'same-origin',
-            'sec-fetch-user': '?1',
-            'upgrade-insecure-requests': '1',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/128.0.0.0 Safari/537.36',
-        })
-        
-        # Update cookies separately if provided
-        if cookies:
-            self.session.cookies.update(cookies)
-        
-        # Autenticar sessão
-        self.session.get('https://www.perplexity.ai/api/auth/session')
-        self.last_backend_uuid = None
-        
-    def search(self, query, mode='pro',model='gpt-4o', sources=['web'], language='pt-BR', is_followup=False):
-        """
-        Realiza uma busca no Perplexity AI.
-        
-        Args:
-            query (str): A pergunta/consulta
-            mode (str): Modo de busca ('auto', 'pro', 'reasoning', 'deep research')
-            language (str): Código de idioma (ex: 'en-US', 'pt-BR')
-            is_followup (bool): Se é uma pergunta de follow-up
-            
-        Returns:
-            dict: Resposta processada ou None se houver erro
-        """
-        try:
-            
-            # Preparar dados da requisição com contexto
-            json_data = {
-                'query_str': query,
-                'params': {
-                    'last_backend_uuid': self.last_backend_uuid,
-                    'context_uuid': getattr(self, 'context_uuid', None),
-                    'frontend_context_uuid': getattr(self, 'frontend_context_uuid', None),
-                    'read_write_token': self.read_write_token,
-                    'attachments': [],
-                    'language': language,
-                    'timezone': 'America/Sao_Paulo',
-                    'search_focus': 'internet',
-                    'frontend_uuid': self.frontend_uuid,
-                    'is_related_query': False,
-                    'is_sponsored': False,
-                    'visitor_id': self.visitor_id,
-                    'user_nextauth_id': self.user_nextauth_id,
-                    'prompt_source': 'user',
-                    'query_source': 'followup' if (getattr(self, 'context_uuid', None) or getattr(self, 'read_write_token', None) or getattr(self, 'last_backend_uuid', None)) else 'home',
-                    'is_incognito': False,
-                    'use_schematized_api': True,
-                    'send_back_text_in_streaming_api': False,
-                    'supported_block_use_cases': [
-                        'answer_modes', 'media_items', 'knowledge_cards',
-                        'inline_entity_cards', 'place_widgets', 'finance_widgets',
-                        'sports_widgets', 'shopping_widgets', 'jobs_widgets',
-                        'search_result_widgets', 'clarification_responses',
-                        'inline_images', 'inline_assets', 'inline_finance_widgets',
-                        'placeholder_cards', 'diff_blocks', 'inline_knowledge_cards', 'entity_group_v2'
-                    ],
-                    'client_coordinates': None,
-                    'mentions': [],
-                    'skip_search_enabled': True,
-                    'is_nav_suggestions_disabled': False,
-                    'followup_source': 'link' if is_followup else None,
-                    'mode': 'concise',
-                    'model_preference': 'turbo',
-                    'source': 'default',
-                    'sources': sources,
-                    'version': '2.18',
-                    'context_uuid': getattr(self, 'context_uuid', None),
-                    'search_recency_filter': None,
-                    'dsl_query': query,
-                    'local_search_enabled': False,
-                    'always_search_override': False,
-                    'override_no_search': False,
-                    'comet_max_assistant_enabled': False,
-                }
-            }
-            
-            # Fazer requisição
-            _sse_headers = {
-                **self.session.headers,
-                'accept': 'text/event-stream',
-                'origin': 'https://www.perplexity.ai',
-                'referer': 'https://www.perplexity.ai/',
-                'sec-fetch-mode': 'cors',
-                'sec-fetch-site': 'same-origin',
-                'accept-language': 'pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7',
-            }
-            response = self.session.post(
-                'https://www.perplexity.ai/rest/sse/perplexity_ask', 
-                json=json_data,
-                headers=_sse_headers,
-                stream=True,
-            )
-            
-            if response.status_code != 200:
-                try:
-                    body = response.text[:1000]
-                except Exception:
-                    body = ''
-                print(f"❌ Erro HTTP: {response.status_code} | body: {body}")
-                return None
-            
-            # valida Content-Type do upstream (evita parse de HTML do Cloudflare)
-            ct = (response.headers.get('content-type') or '').lower()
-            if 'text/event-stream' not in ct:
-                try:
-                    body = response.text[:1000]
-                except Exception:
-                    body = ''
-                print(f"❌ Upstream content-type inesperado: {ct or 'desconhecido'} | body: {body}")
-                return None
-            
-            # Processar resposta Server-Sent Events
-            content_text = response.content.decode('utf-8')
-            
-            if not content_text.strip():
-                return None
-            
-            # Extrair chunks válidos
-            chunks = []
-            events = content_text.split('\r\n\r\n')
-            
-            def _update_ctx_from_event_lines(lines: list[str]):
-                try:
-                    data_parts = [l[5:].lstrip() for l in lines if l.startswith('data:')]
-                    if not data_parts:
-                        return
-                    joined = ''.join(data_parts).strip()
-                    objs = []
-                    try:
-                        obj = json.loads(joined)
-                        objs = [obj]
-                    except Exception:
-                        for part in data_parts:
-                            part = part.strip()
-                            if not part or part[:1] not in ('{', '['):
-                                continue
-                            try:
-                                objs.append(json.loads(part))
-                            except Exception:
-                                continue
-                    for obj in objs:
-                        if not isinstance(obj, dict):
-                            continue
-                        bu = obj.get('backend_uuid')
-                        cu = obj.get('context_uuid')
-                        fcu = obj.get('frontend_context_uuid')
-                        rwt = obj.get('read_write_token')
-                        if bu:
-                            setattr(self, 'last_backend_uuid', bu)
-                        # Preserve o primeiro context_uuid/front_ctx/read_write_token da conversa
-                        if cu and getattr(self, 'context_uuid', None) is None:
-                            setattr(self, 'context_uuid', cu)
-                        if fcu and getattr(self, 'frontend_context_uuid', None) is None:
-                            setattr(self, 'frontend_context_uuid', fcu)
-                        if rwt and getattr(self, 'read_write_token', None) is None:
-                            setattr(self, 'read_write_token', rwt)
-                except Exception:
-                    pass
+            'accept-language': 'pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7',
+        }
 
-            for event in events:
-                if not event.strip():
-                    continue
-                    
-                if event.startswith('event: message\r\n'):
-                    try:
-                        # Extrair dados JSON
-                        json_part = event[len('event: message\r\ndata: '):]
-                        event_data = json.loads(json_part)
-                        
-                        # Parse do campo 'text' se existir
-                        if 'text' in event_data and isinstance(event_data['text'], str):
-                            try:
-                                event_data['text'] = json.loads(event_data['text'])
-                            except json.JSONDecodeError:
-                                # Se não conseguir fazer parse, manter como string
-                                pass
-                        
-                        chunks.append(event_data)
-                        
-                    except json.JSONDecodeError as e:
-                        print(f"⚠️ Erro ao processar chunk: {e}")
-                        continue
-                
-                elif event.startswith('event: end_of_stream\r\n'):
-                    break
-            
-            if not chunks:
-                print("❌ Nenhum chunk válido encontrado")
-                return None
-            
-            # Update last_backend_uuid for conversation continuity
-            final_chunk = chunks[-1]
-            if 'backend_uuid' in final_chunk:
-                self.last_backend_uuid = final_chunk['backend_uuid']
-            # Preserve primeiros valores
-            if 'read_write_token' in final_chunk and getattr(self, 'read_write_token', None) is None:
-                self.read_write_token = final_chunk['read_write_token']
-            if 'context_uuid' in final_chunk and getattr(self, 'context_uuid', None) is None:
-                self.context_uuid = final_chunk['context_uuid']
-            if 'frontend_context_uuid' in final_chunk and getattr(self, 'frontend_context_uuid', None) is None:
-                self.frontend_context_uuid = final_chunk['frontend_context_uuid']
-            
-            return final_chunk
-            
-        except Exception as e:
-            print(f"❌ Erro na busca: {e}")
+    def _parse_message_event(self, data):
+        """Parseia o data de um evento 'message' (e o campo 'text' aninhado) e atualiza o contexto."""
+        ev = decode_event(data)
+        if ev is None or not ev.obj:
+            print(f"⚠️ Erro ao processar chunk: JSON inválido ({data[:80]!r})")
             return None
-    
+        self._update_ctx(ev.obj)
+        # 'text' vira a lista de steps; se não for JSON, permanece string
+        return ev.as_dict()
+
+    def _update_ctx(self, obj):
+        """Atualiza o contexto da conversa a partir de um evento já parseado."""
+        if not isinstance(obj, dict):
+            return
+        bu = obj.get('backend_uuid')
+        cu = obj.get('context_uuid')
+        fcu = obj.get('frontend_context_uuid')
+        rwt = obj.get('read_write_token')
+        changed = False
+        if bu and bu != self.last_backend_uuid:
+            self.last_backend_uuid = bu
+            changed = True
+        # Preserve o primeiro context_uuid/front_ctx/read_write_token da conversa
+        if cu and getattr(self, 'context_uuid', None) is None:
+            self.context_uuid = cu
+            changed = True
+        if fcu and getattr(self, 'frontend_context_uuid', None) is None:
+            self.frontend_context_uuid = fcu
+            changed = True
+        if rwt and getattr(self, 'read_write_token', None) is None:
+            self.read_write_token = rwt
+            changed = True
+        if changed and self.on_context_change is not None:
+            try:
+                self.on_context_change(self.context_snapshot())
+            except Exception:
+                pass
+
     def get_answer_text(self, response):
         """
         Extrai o texto da resposta de forma limpa.
@@ -270,7 +237,7 @@ class WorkingPerplexityClient:
                         'content' in item and 
                         'answer' in item['content']):
                         
-                        answer_json = json.loads(item['content']['answer'])
+                        answer_json = json_loads(item['content']['answer'])
                         return answer_json.get('answer', '')
             
             elif isinstance(text_data, str):
@@ -281,13 +248,576 @@ class WorkingPerplexityClient:
             
         return None
 
+class WorkingPerplexityClient(_PerplexityClientBase):
+    """
+    Cliente Perplexity funcional que resolve o problema de retorno None.
+    """
+    
+    def __init__(self, cookies={}):
+        self.session = requests.Session(impersonate="chrome110")
+        self._init_context()
+        self.session.headers.update(_BROWSER_HEADERS)
+        
+        # Update cookies separately if provided
+        if cookies:
+            self.session.cookies.update(cookies)
+        
+        # Autenticar sessão
+        self.session.get(_AUTH_URL)
+
+    def close(self):
+        self.session.close()
+
+    def search_stream(self, query, mode='pro', model='gpt-4o', sources=['web'], language='pt-BR', is_followup=False):
+        """
+        Gerador que produz cada evento 'message' do Perplexity assim que chega.
+
+        Cada evento já vem com o campo 'text' parseado (quando for JSON) e o
+        contexto da conversa é atualizado evento a evento. Apenas o evento
+        corrente fica em memória, então o consumo não cresce com o tamanho
+        da resposta.
+
+        Raises:
+            PerplexityUpstreamError: status HTTP != 200 ou content-type inesperado
+        """
+        response = self.session.post(
+            _ASK_URL,
+            data=self._build_payload(query, sources=sources, language=language, is_followup=is_followup),
+            headers=self._sse_headers(),
+            stream=True,
+        )
+        try:
+            _check_upstream_response(response)
+            for ev in iter_sse_events(response.iter_content()):
+                if ev.name == 'end_of_stream':
+                    break
+                if ev.name != 'message' or not ev.data:
+                    continue
+                event_data = self._parse_message_event(ev.data)
+                if event_data is not None:
+                    yield event_data
+        finally:
+            response.close()
+
+    def search(self, query, mode='pro',model='gpt-4o', sources=['web'], language='pt-BR', is_followup=False):
+        """
+        Realiza uma busca no Perplexity AI.
+        
+        Args:
+            query (str): A pergunta/consulta
+            mode (str): Modo de busca ('auto', 'pro', 'reasoning', 'deep research')
+            language (str): Código de idioma (ex: 'en-US', 'pt-BR')
+            is_followup (bool): Se é uma pergunta de follow-up
+            
+        Returns:
+            dict: Resposta processada ou None se houver erro
+        """
+        try:
+            # Os eventos são snapshots cumulativos: basta guardar o último
+            final_chunk = None
+            for event_data in self.search_stream(query, mode=mode, model=model, sources=sources,
+                                                 language=language, is_followup=is_followup):
+                final_chunk = event_data
+
+            if final_chunk is None:
+                print("❌ Nenhum chunk válido encontrado")
+                return None
+
+            return final_chunk
+
+        except PerplexityUpstreamError as e:
+            print(f"❌ {e}")
+            return None
+        except Exception as e:
+            print(f"❌ Erro na busca: {e}")
+            return None
+
+
+async def new_authenticated_session(cookies=None):
+    """Cria uma AsyncSession com fingerprint de navegador já autenticada no upstream."""
+    session = requests.AsyncSession(impersonate="chrome110")
+    session.headers.update(_BROWSER_HEADERS)
+    if cookies:
+        session.cookies.update(cookies)
+    try:
+        await session.get(_AUTH_URL)
+    except BaseException:
+        await session.close()
+        raise
+    return session
+
+
+async def ping_session(session):
+    """Ping leve de keep-alive (GET /api/auth/session); levanta se a sessão foi barrada."""
+    response = await session.get(_AUTH_URL)
+    if response.status_code != 200:
+        raise PerplexityUpstreamError(f"Erro HTTP: {response.status_code}", status_code=response.status_code)
+
+
+async def _abort_upstream_response(response) -> bool:
+    """Fecha uma resposta de stream do curl_cffi interrompendo a transferência.
+
+    Response.aclose() do curl_cffi só aguarda a tarefa que lê o stream, ou seja,
+    baixa o resto da resposta do upstream antes de voltar. Com o stream ainda em
+    andamento a tarefa é cancelada: o handle sai do curl_multi (release_curl) e a
+    conexão é fechada na hora.
+
+    Returns:
+        True se o stream foi cortado no meio
+    """
+    task = getattr(response, "astream_task", None)
+    if task is None or task.done():
+        await response.aclose()
+        return False
+    task.cancel()
+    await asyncio.wait((task,))
+    return True
+
+
+class _UpstreamResponse:
+    """Resposta de stream do upstream cujo aclose() corta a transferência em andamento.
+
+    Com ``lease`` a sessão emprestada volta ao pool no aclose(); se o stream foi
+    cortado no meio ela é descartada (healthy=False) e reposta pelo pool.
+    """
+
+    def __init__(self, response, lease=None):
+        self._response = response
+        self._lease = lease
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    def aiter_content(self, *args, **kwargs):
+        return self._response.aiter_content(*args, **kwargs)
+
+    async def aclose(self):
+        cut = True
+        try:
+            cut = await _abort_upstream_response(self._response)
+        finally:
+            if self._lease is not None:
+                self._lease.release(healthy=not cut)
+
+
+async def _discard_stream(result):
+    """Fecha (cortando a transferência) o stream de uma tentativa descartada pelo hedge."""
+    response, _, _ = result
+    await response.aclose()
+
+
+class AsyncWorkingPerplexityClient(_PerplexityClientBase):
+    """
+    Versão asyncio do WorkingPerplexityClient sobre curl_cffi.AsyncSession.
+
+    A autenticação (GET /api/auth/session) é feita de forma preguiçosa na
+    primeira busca, então construir o cliente não faz I/O. Com ``session_pool``
+    o cliente guarda apenas o contexto da conversa e pega emprestada, a cada
+    requisição, uma sessão já autenticada do pool.
+    """
+
+    def __init__(self, cookies={}, session_pool=None):
+        self._init_context()
+        self._pool = session_pool
+        self.session = None
+        if session_pool is None:
+            self.session = requests.AsyncSession(impersonate="chrome110")
+            self.session.headers.update(_BROWSER_HEADERS)
+            if cookies:
+                self.session.cookies.update(cookies)
+        self._authenticated = session_pool is not None
+        self._auth_lock = asyncio.Lock()
+        # callback(resultado, segundos) a cada abertura de stream (métricas do servidor)
+        self.on_upstream_open = None
+        # captura dos streams (stream_capture.StreamRecorder) e replay no lugar do upstream (ReplaySource)
+        self.recorder = None
+        self.replay = None
+        # retry/hedge da abertura do stream até o primeiro evento (upstream_retry.RetryPolicy)
+        self.retry = None
+        # circuit breaker do servidor (upstream_limiter.CircuitBreaker): aberto, nem envia
+        self.breaker = None
+        # conta do upstream usada pelo cliente (account_pool; definida pelo servidor)
+        self.account = None
+
+    async def _ensure_auth(self):
+        if self._authenticated:
+            return
+        async with self._auth_lock:
+            if not self._authenticated:
+                await self.session.get(_AUTH_URL)
+                self._authenticated = True
+
+    async def close(self):
+        # sessões do pool pertencem ao pool
+        if self.session is not None:
+            await self.session.close()
+
+    async def open_stream(self, body: bytes):
+        """Abre o stream SSE do perplexity_ask já validado (status/Content-Type).
+
+        ``body`` é o corpo JSON montado por _build_payload().
+
+        O chamador é responsável por fechar a resposta (await resp.aclose()).
+
+        Raises:
+            CircuitOpenError: circuito aberto (inclusive em retries e hedges)
+        """
+        if self.breaker is not None:
+            self.breaker.check()
+        t0 = time.perf_counter()
+        try:
+            if self.replay is not None:
+                response = await self.replay.open()
+            else:
+                response = await self._open_stream(body)
+        except BaseException as e:
+            if self.on_upstream_open is not None:
+                self.on_upstream_open(_upstream_outcome(e), time.perf_counter() - t0)
+            raise
+        open_s = time.perf_counter() - t0
+        if self.on_upstream_open is not None:
+            self.on_upstream_open("ok", open_s)
+        if self.recorder is not None:
+            response = self.recorder.wrap(response, body, t0, open_s)
+        return response
+
+    async def _open_stream(self, body: bytes):
+        if self._pool is None:
+            await self._ensure_auth()
+            response = await self.session.post(
+                _ASK_URL,
+                data=body,
+                headers=self._sse_headers(),
+                stream=True,
+            )
+            try:
+                await _acheck_upstream_response(response)
+            except BaseException:
+                await _abort_upstream_response(response)
+                raise
+            return _UpstreamResponse(response)
+
+        lease = await self._pool.borrow()
+        try:
+            response = await lease.session.post(
+                _ASK_URL,
+                data=body,
+                headers=self._sse_headers(lease.session),
+                stream=True,
+            )
+        except BaseException:
+            # falha de transporte: a sessão é descartada e reposta pelo pool
+            lease.release(healthy=False)
+            raise
+        try:
+            await _acheck_upstream_response(response)
+        except PerplexityUpstreamError as e:
+            await _abort_upstream_response(response)
+            # 401/403 ou HTML com status 200 (desafio do Cloudflare) indicam sessão barrada
+            lease.release(healthy=e.status_code not in (200, 401, 403))
+            raise
+        except BaseException:
+            cut = await _abort_upstream_response(response)
+            lease.release(healthy=not cut)
+            raise
+        return _UpstreamResponse(response, lease)
+
+    async def _open_first_event(self, query, sources, language, is_followup):
+        # uma tentativa do retry: abre o stream e lê até o primeiro evento (None se veio vazio)
+        response = await self.open_stream(
+            self._build_payload(query, sources=sources, language=language, is_followup=is_followup)
+        )
+        events = aiter_sse_events(response.aiter_content())
+        try:
+            first = await events.__anext__()
+        except StopAsyncIteration:
+            first = None
+        except BaseException:
+            await response.aclose()
+            raise
+        return response, events, first
+
+    async def stream_events(self, query, sources=['web'], language='pt-BR', is_followup=False):
+        """
+        Eventos SSE (SSEEvent) do perplexity_ask para a pergunta, com o contexto da conversa.
+
+        Com ``retry`` a abertura é repetida em falhas transitórias e em stall, mas
+        só até o primeiro evento; o hedge vale apenas no primeiro turno (num
+        follow-up as duas requisições virariam dois turnos da thread). Num
+        follow-up só se repete o que comprovadamente não chegou ao upstream
+        (falha de conexão, 429/503 com Retry-After); stall e 5xx podem já ter
+        criado o turno e voltam como erro.
+
+        Raises:
+            PerplexityUpstreamError: status HTTP != 200 ou content-type inesperado
+            UpstreamStallError: nenhum evento dentro do prazo de stall
+        """
+        if self.retry is None:
+            response = await self.open_stream(
+                self._build_payload(query, sources=sources, language=language, is_followup=is_followup)
+            )
+            try:
+                async for ev in aiter_sse_events(response.aiter_content()):
+                    yield ev
+            finally:
+                await response.aclose()
+            return
+        response, events, first = await self.retry.run(
+            lambda: self._open_first_event(query, sources, language, is_followup),
+            discard=_discard_stream,
+            hedge=self.last_backend_uuid is None,
+            followup=self.last_backend_uuid is not None,
+        )
+        try:
+            if first is not None:
+                yield first
+                async for ev in events:
+                    yield ev
+        finally:
+            await response.aclose()
+
+    async def search_stream(self, query, mode='pro', model='gpt-4o', sources=['web'], language='pt-BR', is_followup=False):
+        """
+        Gerador assíncrono equivalente a WorkingPerplexityClient.search_stream().
+
+        Raises:
+            PerplexityUpstreamError: status HTTP != 200 ou content-type inesperado
+        """
+        events = self.stream_events(query, sources=sources, language=language, is_followup=is_followup)
+        try:
+            async for ev in events:
+                if ev.name == 'end_of_stream':
+                    break
+                if ev.name != 'message' or not ev.data:
+                    continue
+                event_data = self._parse_message_event(ev.data)
+                if event_data is not None:
+                    yield event_data
+        finally:
+            await events.aclose()
+
+    async def search(self, query, mode='pro', model='gpt-4o', sources=['web'], language='pt-BR', is_followup=False):
+        """
+        Versão assíncrona de WorkingPerplexityClient.search().
+
+        Returns:
+            dict: Último snapshot da resposta ou None se houver erro
+        """
+        try:
+            final_chunk = None
+            async for event_data in self.search_stream(query, mode=mode, model=model, sources=sources,
+                                                       language=language, is_followup=is_followup):
+                final_chunk = event_data
+
+            if final_chunk is None:
+                print("❌ Nenhum chunk válido encontrado")
+                return None
+
+            return final_chunk
+
+        except PerplexityUpstreamError as e:
+            print(f"❌ {e}")
+            return None
+        except Exception as e:
+            print(f"❌ Erro na busca: {e}")
+            return None
+
 # ==========================
 # API OpenAI-compat (FastAPI)
 # ==========================
-def start_openai_compat_api(host: str = "127.0.0.1", port: int = 8000, *, threaded: bool = True):
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+STREAM_FORMATS = ("passthrough", "delta")
+
+
+def _answer_event_data(text: str) -> dict:
+    """Evento no formato do upstream (steps com FINAL) carregando a resposta completa."""
+    answer = json.dumps({"answer": text, "chunks": [text]}, ensure_ascii=False)
+    steps = [{"step_type": "FINAL", "content": {"answer": answer}}]
+    return {"text": json.dumps(steps, ensure_ascii=False), "status": "COMPLETED", "final": True}
+
+
+class _StreamStats:
+    """Respostas em streaming e bytes enviados, por formato (exposto em /health)."""
+
+    def __init__(self):
+        self._by_format = {fmt: [0, 0] for fmt in STREAM_FORMATS}
+
+    def record(self, fmt: str, nbytes: int):
+        entry = self._by_format[fmt]
+        entry[0] += 1
+        entry[1] += nbytes
+
+    def stats(self) -> dict:
+        return {
+            fmt: {
+                "responses": n,
+                "bytes_sent": nbytes,
+                "bytes_avg": round(nbytes / n) if n else 0,
+            }
+            for fmt, (n, nbytes) in self._by_format.items()
+        }
+
+
+class _AdmissionRefused(Exception):
+    """Requisição recusada antes de ir ao upstream: circuito aberto, conversa ocupada ou servidor ocupado."""
+
+    def __init__(self, status_code: int, message: str, type: str, retry_after: int | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.type = type
+        self.retry_after = retry_after
+
+    def error(self) -> dict:
+        return {"message": str(self), "type": self.type}
+
+
+class _UpstreamCall:
+    """Requisição admitida: cliente, pergunta final, turno da conversa e vaga do upstream.
+
+    release() devolve a vaga, o turno e a conversa (ou fecha o cliente avulso); é idempotente.
+    """
+
+    __slots__ = ("client", "query", "turn", "lease", "routine_kind", "_conversations", "_key", "_released")
+
+    def __init__(self, conversations, key, client, query: str, turn, lease, routine_kind: str | None = None):
+        self._conversations = conversations
+        self._key = key
+        self.client = client
+        self.query = query
+        self.turn = turn
+        self.lease = lease
+        self.routine_kind = routine_kind
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.lease.release()
+        if self.turn is not None:
+            self.turn.release()
+            self._conversations.checkin(self._key)
+        else:
+            self._conversations.close_client(self.client)
+
+
+def start_openai_compat_api(host: str = "127.0.0.1", port: int = 8000, *, threaded: bool = True,
+                            max_upstream: int | None = None, max_queue: int | None = None,
+                            max_queue_wait: float | None = None, max_conversations: int | None = None,
+                            conversation_ttl: float | None = None, context_db: str | None = None,
+                            session_pool_size: int | None = None, session_max_age: float | None = None,
+                            session_keepalive: float | None = None, conversation_policy: str | None = None, conversation_max_wait: float | None = None,
+                            response_cache_size: int | None = None, response_cache_ttl: float | None = None,
+                            single_flight: bool | None = None, capture_dir: str | None = None,
+                            replay_dir: str | None = None, replay_speed: float | None = None,
+                            upstream_retries: int | None = None, upstream_stall: float | None = None,
+                            upstream_hedge: bool | None = None, retry_budget: float | None = None,
+                            adaptive_limit: bool | None = None, breaker_threshold: int | None = None,
+                            breaker_open: float | None = None, batch_concurrency: int | None = None,
+                            accounts_file: str | None = None):
+    """Sobe o servidor OpenAI-compat.
+
+    Limites de upstream (argumento ou variável de ambiente):
+        max_upstream (PPLX_MAX_UPSTREAM, 32): streams simultâneos no upstream
+        max_queue (PPLX_MAX_QUEUE, 64): pedidos aguardando vaga; excedente -> 429
+        max_queue_wait (PPLX_MAX_QUEUE_WAIT, 10s): espera máxima na fila -> 429
+
+    Bloqueio pelo upstream (403/429/HTML do Cloudflare; ver upstream_limiter):
+        adaptive_limit (PPLX_ADAPTIVE_LIMIT, 1): limite AIMD de streams simultâneos, entre
+            PPLX_MIN_UPSTREAM (1) e max_upstream; -25% no bloqueio, +1 por rodada no sucesso
+        breaker_threshold (PPLX_BREAKER_THRESHOLD, 5): bloqueios seguidos que abrem o
+            circuito; aberto, o servidor responde 503 na hora (0 desativa)
+        breaker_open (PPLX_BREAKER_OPEN, 10s): tempo aberto antes da requisição de teste;
+            dobra a cada teste bloqueado (até 120s)
+
+    Conversas em memória:
+        max_conversations (PPLX_MAX_CONVERSATIONS, 1000): limite LRU de conversas
+        conversation_ttl (PPLX_CONVERSATION_TTL, 1800s): ociosidade até descartar
+        context_db (PPLX_CONTEXT_DB, perplexity/conversations.sqlite3): SQLite com o
+            contexto das conversas para sobreviver a restarts ('' desativa)
+
+    Sessões com o upstream:
+        session_pool_size (PPLX_SESSION_POOL_SIZE, 4): sessões autenticadas mantidas
+            aquecidas e compartilhadas entre conversas (0 = uma sessão por conversa)
+        session_max_age (PPLX_SESSION_MAX_AGE, 900s): reciclagem das sessões do pool
+        session_keepalive (PPLX_SESSION_KEEPALIVE, 45s): ociosidade até um ping leve manter a
+            conexão da sessão viva (0 desativa); sessão que não responde é trocada
+        O servidor só se declara pronto ("ready" em /health, GET /ready) quando há sessão aquecida.
+
+    Contas do upstream (ver account_pool):
+        accounts_file (PPLX_ACCOUNTS_FILE, ''): JSON com as contas (nome + cookies); conversas
+            novas são distribuídas entre elas e ficam presas à conta ('' = uma conta anônima).
+            Cada conta tem o próprio pool de session_pool_size sessões
+        PPLX_ACCOUNT_THROTTLE (3): bloqueios seguidos que põem a conta em quarentena (0 desativa)
+        PPLX_ACCOUNT_QUARANTINE (60s): quarentena sem conversas novas; dobra a cada quarentena
+            seguida (até 900s) e a conta volta sozinha ao rodízio
+
+    Retry da abertura do stream (só até o primeiro evento; ver upstream_retry):
+        upstream_retries (PPLX_UPSTREAM_RETRIES, 2): novas tentativas em falha transitória
+            (429/5xx, queda de conexão, stall), com backoff e jitter; bloqueios (401/403,
+            HTML do Cloudflare) não são repetidos e ficam com o breaker e a quarentena da conta;
+            em turnos seguintes da conversa, só falhas em que a pergunta não chegou ao upstream
+        upstream_stall (PPLX_UPSTREAM_STALL, 15s): stream aberto sem nenhum evento por esse
+            tempo conta como falha (0 desativa)
+        upstream_hedge (PPLX_UPSTREAM_HEDGE, 0): em perguntas de primeiro turno, envia uma
+            segunda requisição se o primeiro evento não chegou no p95 recente
+        retry_budget (PPLX_RETRY_BUDGET, 0.2): retries + hedges por requisição na janela de
+            10s (mais 1/s garantido), para não multiplicar o tráfego com o upstream fora do ar
+
+    Requisições concorrentes na mesma conversa (conversas diferentes seguem em paralelo):
+        conversation_policy (PPLX_CONVERSATION_POLICY, 'queue'): 'queue' enfileira,
+            'reject' responde 409, 'cancel' interrompe a requisição anterior
+        conversation_max_wait (PPLX_CONVERSATION_MAX_WAIT, 60s): espera máxima pelo turno -> 409
+
+    Cache de respostas (só requisições sem conversation_id; Cache-Control: no-cache/no-store/max-age):
+        response_cache_size (PPLX_RESPONSE_CACHE_SIZE, 0): respostas guardadas (0 desativa)
+        response_cache_ttl (PPLX_RESPONSE_CACHE_TTL, 300s): validade de cada resposta
+        single_flight (PPLX_SINGLE_FLIGHT, 1): requisições idênticas sem conversation_id em
+            andamento compartilham um único stream com o upstream
+
+    Captura e replay dos streams do upstream (ver stream_capture):
+        capture_dir (PPLX_CAPTURE_DIR, ''): grava cada stream em <dir>/*.sse.gz ('' desativa);
+            PPLX_CAPTURE_MAX (1000) limita as capturas por processo
+        replay_dir (PPLX_REPLAY_DIR, ''): serve as capturas do diretório no lugar do upstream
+        replay_speed (PPLX_REPLAY_SPEED, 1): ritmo do replay (1 = original, 0 = sem espera)
+
+    Lotes (POST /v1/responses/batch, resultados em NDJSON na ordem em que terminam):
+        batch_concurrency (PPLX_BATCH_CONCURRENCY, 8): itens em paralelo por lote (o campo
+            "concurrency" do lote só pode reduzir); PPLX_BATCH_MAX_ITEMS (1000) limita o lote
+
+    Formato do streaming (por requisição, campo "stream_format" ou header X-Stream-Format):
+        'passthrough' (padrão) reenvia os eventos do upstream como vieram; 'delta'
+        envia só o texto novo em eventos content.delta e um response.completed final
+    """
     try:
         from fastapi import FastAPI, Request
-        from fastapi.responses import StreamingResponse, JSONResponse
+        from fastapi.responses import StreamingResponse, JSONResponse, Response
+        from starlette.background import BackgroundTask
+        from upstream_admission import UpstreamAdmission, AdmissionRejected
+        from conversation_store import ConversationStore
+        from context_persistence import ConversationContextDB
+        from session_pool import SessionPool
+        from account_pool import AccountPool, load_accounts
+        from conversation_turns import ConversationTurns, ConversationBusy, TurnSuperseded
+        from response_cache import ResponseCache, CacheControl
+        from single_flight import SingleFlight
+        from routine_context import RoutineContextState, RoutineContextStats, normalize_tasks, render_prompt
+        from metrics import MetricsRegistry, SIZE_BUCKETS, CONTENT_TYPE as METRICS_CONTENT_TYPE
+        from stream_capture import StreamRecorder, ReplaySource
+        from upstream_retry import RetryPolicy, RetryBudget
+        from upstream_limiter import THROTTLE_OUTCOMES, AIMDLimit, CircuitBreaker, CircuitOpenError
         import uvicorn
         import threading
         import time
@@ -296,18 +826,364 @@ def start_openai_compat_api(host: str = "127.0.0.1", port: int = 8000, *, thread
 
         app = FastAPI()
 
-        # Conversas em memória: conversation_id -> WorkingPerplexityClient()
-        CONVERSATIONS: dict[str, WorkingPerplexityClient] = {}
+        # Contexto das conversas em disco (write-behind); reidratado no primeiro acesso
+        if context_db is None:
+            context_db = os.environ.get("PPLX_CONTEXT_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "conversations.sqlite3"))
+        CONTEXT_DB = ConversationContextDB(context_db) if context_db else None
+
+        # Captura dos streams do upstream e replay das capturas (opt-in)
+        if capture_dir is None:
+            capture_dir = os.environ.get("PPLX_CAPTURE_DIR", "")
+        RECORDER = StreamRecorder(capture_dir, max_files=_env_int("PPLX_CAPTURE_MAX", 1000)) if capture_dir else None
+        if replay_dir is None:
+            replay_dir = os.environ.get("PPLX_REPLAY_DIR", "")
+        REPLAY = None
+        if replay_dir:
+            REPLAY = ReplaySource(
+                replay_dir,
+                speed=replay_speed if replay_speed is not None else _env_float("PPLX_REPLAY_SPEED", 1.0),
+            )
+
+        # Sessões autenticadas compartilhadas: o contexto fica no cliente, o transporte no pool
+        if session_pool_size is None:
+            session_pool_size = _env_int("PPLX_SESSION_POOL_SIZE", 4)
+        if session_max_age is None:
+            session_max_age = _env_float("PPLX_SESSION_MAX_AGE", 900.0)
+        if session_keepalive is None:
+            session_keepalive = _env_float("PPLX_SESSION_KEEPALIVE", 45.0)
+
+        def _session_pool(cookies):
+            # em replay nada fala com o upstream: sem sessões para aquecer
+            if session_pool_size <= 0 or REPLAY is not None:
+                return None
+            return SessionPool(
+                functools.partial(new_authenticated_session, cookies),
+                size=session_pool_size,
+                max_age=session_max_age,
+                ping=ping_session,
+                keepalive_interval=session_keepalive,
+            )
+
+        # Contas do upstream: um pool de sessões por conta, conversas presas à conta
+        if accounts_file is None:
+            accounts_file = os.environ.get("PPLX_ACCOUNTS_FILE", "")
+        ACCOUNTS = AccountPool(
+            load_accounts(accounts_file) if accounts_file else [("default", {})],
+            pool_factory=_session_pool,
+            threshold=_env_int("PPLX_ACCOUNT_THROTTLE", 3),
+            quarantine_s=_env_float("PPLX_ACCOUNT_QUARANTINE", 60.0),
+        )
+
+        # Retry/hedge da abertura do stream, com orçamento global
+        RETRY = RetryPolicy(
+            attempts=1 + max(0, upstream_retries if upstream_retries is not None else _env_int("PPLX_UPSTREAM_RETRIES", 2)),
+            stall_timeout=upstream_stall if upstream_stall is not None else _env_float("PPLX_UPSTREAM_STALL", 15.0),
+            hedge=upstream_hedge if upstream_hedge is not None else bool(_env_int("PPLX_UPSTREAM_HEDGE", 0)),
+            budget=RetryBudget(ratio=retry_budget if retry_budget is not None else _env_float("PPLX_RETRY_BUDGET", 0.2)),
+            not_sent=_request_not_sent,
+        )
+
+        def _ready() -> bool:
+            # sem pool não há o que aquecer (cada conversa abre a própria sessão)
+            return ACCOUNTS.ready
+
+        def _upstream_client(account=None) -> AsyncWorkingPerplexityClient:
+            # sem conta definida (conversa nova ou requisição sem estado): próxima do rodízio
+            if account is None:
+                account = ACCOUNTS.assign()
+            client = AsyncWorkingPerplexityClient(cookies=account.cookies, session_pool=account.pool)
+            client.account = account.name
+            client.on_upstream_open = lambda outcome, seconds, _account=account: _observe_open(outcome, seconds, _account)
+            client.recorder = RECORDER
+            client.replay = REPLAY
+            client.retry = RETRY
+            client.breaker = BREAKER
+            return client
+
+        def _new_client(key: str) -> AsyncWorkingPerplexityClient:
+            saved = CONTEXT_DB.load(key) if CONTEXT_DB is not None else None
+            # a thread pertence à conta em que começou (se ela ainda estiver configurada)
+            client = _upstream_client(ACCOUNTS.get(saved.get("account")) if saved else None)
+            if CONTEXT_DB is not None:
+                if saved:
+                    client.restore_context(saved)
+                client.on_context_change = lambda ctx, _key=key, _account=client.account: CONTEXT_DB.save(
+                    _key, {**ctx, "account": _account})
+            return client
+
+        # Conversas em memória: conversation_id -> AsyncWorkingPerplexityClient() (LRU + TTL)
+        CONVERSATIONS = ConversationStore(
+            _new_client,
+            max_entries=max_conversations if max_conversations is not None else _env_int("PPLX_MAX_CONVERSATIONS", 1000),
+            idle_ttl=conversation_ttl if conversation_ttl is not None else _env_float("PPLX_CONVERSATION_TTL", 1800.0),
+        )
+
+        # Uma requisição por vez em cada conversa (evita bifurcar o contexto no upstream)
+        TURNS = ConversationTurns(
+            policy=conversation_policy or os.environ.get("PPLX_CONVERSATION_POLICY", "queue"),
+            max_wait=conversation_max_wait if conversation_max_wait is not None else _env_float("PPLX_CONVERSATION_MAX_WAIT", 60.0),
+        )
+
+        # Vagas dedicadas ao I/O com o upstream + fila de admissão limitada
+        admission = UpstreamAdmission(
+            max_concurrency=max_upstream if max_upstream is not None else _env_int("PPLX_MAX_UPSTREAM", 32),
+            max_queue=max_queue if max_queue is not None else _env_int("PPLX_MAX_QUEUE", 64),
+            max_wait=max_queue_wait if max_queue_wait is not None else _env_float("PPLX_MAX_QUEUE_WAIT", 10.0),
+        )
+
+        # Limite adaptativo e circuit breaker, alimentados pelo resultado de cada abertura de stream
+        if adaptive_limit is None:
+            adaptive_limit = bool(_env_int("PPLX_ADAPTIVE_LIMIT", 1))
+        LIMIT = AIMDLimit(admission, min_limit=_env_int("PPLX_MIN_UPSTREAM", 1)) if adaptive_limit else None
+        BREAKER = CircuitBreaker(
+            threshold=breaker_threshold if breaker_threshold is not None else _env_int("PPLX_BREAKER_THRESHOLD", 5),
+            open_s=breaker_open if breaker_open is not None else _env_float("PPLX_BREAKER_OPEN", 10.0),
+        )
+
+        # Respostas de chamadas sem estado (opt-in)
+        RESPONSE_CACHE = ResponseCache(
+            max_entries=response_cache_size if response_cache_size is not None else _env_int("PPLX_RESPONSE_CACHE_SIZE", 0),
+            ttl=response_cache_ttl if response_cache_ttl is not None else _env_float("PPLX_RESPONSE_CACHE_TTL", 300.0),
+        )
+
+        # Coalescência de requisições idênticas sem estado em andamento
+        if single_flight is None:
+            single_flight = bool(_env_int("PPLX_SINGLE_FLIGHT", 1))
+        SINGLE_FLIGHT = SingleFlight() if single_flight else None
+
+        # Lotes (/v1/responses/batch): paralelismo máximo por lote e tamanho máximo
+        BATCH_CONCURRENCY = max(1, batch_concurrency if batch_concurrency is not None else _env_int("PPLX_BATCH_CONCURRENCY", 8))
+        BATCH_MAX_ITEMS = max(1, _env_int("PPLX_BATCH_MAX_ITEMS", 1000))
+
+        # Métricas Prometheus (GET /metrics): contadores e histogramas em cada etapa do upstream
+        METRICS = MetricsRegistry("pplx_")
+        M_UPSTREAM_OPEN = METRICS.histogram(
+            "upstream_open_seconds", "Abertura do stream no perplexity_ask até status/Content-Type validados, por resultado",
+            ("outcome",))
+        M_UPSTREAM_FIRST_EVENT = METRICS.histogram(
+            "upstream_first_event_seconds", "Do envio da pergunta ao primeiro evento SSE do upstream (TTFB)")
+        M_UPSTREAM_STREAM = METRICS.histogram(
+            "upstream_stream_seconds", "Duração total do stream do upstream, por resultado", ("result",))
+        M_UPSTREAM_EVENTS = METRICS.histogram(
+            "upstream_events_per_response", "Eventos SSE recebidos do upstream por resposta",
+            buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+        M_SEARCH = METRICS.histogram(
+            "search_seconds", "Busca completa do caminho não-stream (search()), por resultado", ("result",))
+        M_STREAM_BYTES = METRICS.histogram(
+            "stream_response_bytes", "Bytes enviados ao cliente por resposta em streaming", ("format",),
+            buckets=SIZE_BUCKETS)
+        M_ADMISSION_WAIT = METRICS.histogram(
+            "admission_wait_seconds", "Espera na fila de admissão do upstream")
+        M_RESPONSES = METRICS.counter(
+            "responses_total", "Respostas de /v1/responses por modo e origem (upstream, cache, single_flight)",
+            ("mode", "source"))
+        M_REJECTED = METRICS.counter(
+            "rejected_total", "Requisições de /v1/responses recusadas, por motivo", ("reason",))
+        M_BATCH_ITEMS = METRICS.counter(
+            "batch_items_total", "Itens de /v1/responses/batch concluídos, por resultado", ("status",))
+        M_RETRIES = METRICS.counter(
+            "upstream_retries_total", "Novas tentativas de abrir o stream, pelo motivo da falha anterior", ("reason",))
+        M_HEDGES = METRICS.counter(
+            "upstream_hedges_total", "Requisições de hedge enviadas, por vencedora (hedge ou primary)", ("winner",))
+        METRICS.gauge("upstream_retry_budget_available", "Retries disponíveis no orçamento",
+                      fn=lambda: max(0.0, RETRY.budget.available()))
+        RETRY.on_retry = lambda exc: M_RETRIES.inc(_upstream_outcome(exc))
+        RETRY.on_hedge = lambda won: M_HEDGES.inc("hedge" if won else "primary")
+        METRICS.gauge("conversations", "Conversas em memória (CONVERSATIONS)", fn=lambda: len(CONVERSATIONS))
+        METRICS.gauge("upstream_in_flight", "Streams abertos com o upstream", fn=lambda: admission.stats()["in_flight"])
+        METRICS.gauge("admission_queue_depth", "Requisições aguardando vaga do upstream",
+                      fn=lambda: admission.stats()["queue_depth"])
+        METRICS.gauge("upstream_limit", "Limite atual de streams simultâneos (AIMD)", fn=lambda: admission.limit)
+        METRICS.gauge("circuit_open", "Circuit breaker do upstream: 0 fechado, 1 half-open, 2 aberto",
+                      fn=lambda: (BREAKER.CLOSED, BREAKER.HALF_OPEN, BREAKER.OPEN).index(BREAKER.state))
+        METRICS.gauge("response_cache_entries", "Respostas no cache", fn=lambda: len(RESPONSE_CACHE))
+        if any(account.pool is not None for account in ACCOUNTS):
+            METRICS.gauge("session_pool_ready", "Sessões autenticadas prontas nos pools (todas as contas)",
+                          fn=lambda: sum(a.pool.stats()["ready"] for a in ACCOUNTS if a.pool is not None))
+        M_ACCOUNT_REQUESTS = METRICS.counter(
+            "account_requests_total", "Aberturas de stream por conta do upstream e resultado", ("account", "outcome"))
+        M_ACCOUNT_AVAILABLE = METRICS.gauge(
+            "account_available", "1 se a conta recebe conversas novas, 0 em quarentena", ("account",))
+        M_ACCOUNT_OK_RATE = METRICS.gauge(
+            "account_ok_per_minute", "Respostas normais por minuto na conta (último minuto)", ("account",))
+        METRICS.gauge("ready", "1 quando há sessão aquecida com o upstream", fn=lambda: int(_ready()))
+        if SINGLE_FLIGHT is not None:
+            METRICS.gauge("single_flight_in_flight", "Voos em andamento", fn=lambda: SINGLE_FLIGHT.stats()["in_flight"])
+
+        def _observe_open(outcome: str, seconds: float, account=None):
+            M_UPSTREAM_OPEN.observe(seconds, outcome)
+            if account is not None:
+                ACCOUNTS.record(account, outcome)
+                M_ACCOUNT_REQUESTS.inc(account.name, outcome)
+                # conta em quarentena com outra atendendo as conversas novas: o bloqueio é dela,
+                # não abre o circuito nem corta o limite das demais
+                if outcome in THROTTLE_OUTCOMES and ACCOUNTS.isolated(account):
+                    return
+            if LIMIT is not None:
+                LIMIT.record(outcome)
+            BREAKER.record(outcome)
+
+        STREAM_STATS = _StreamStats()
+        ROUTINE_STATS = RoutineContextStats()
+        SSE_HEADERS = {
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+        }
+
+        def _response_object(response_id: str, model: str, text: str, **extra) -> dict:
+            return {
+                "id": response_id,
+                "object": "response",
+                "created": int(time.time()),
+                "model": model,
+                **extra,
+                "output": [
+                    {
+                        "type": "message",
+                        "role": "assistant",
+                        "content": [
+                            {"type": "output_text", "text": text}
+                        ]
+                    }
+                ],
+            }
+
+        def _sse_data(obj) -> str:
+            return f"data: {json.dumps(obj, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+        def _cached_response(hit, model: str, stream: bool, stream_format: str):
+            # resposta do cache: JSON ou SSE montado de uma vez, sem tocar no upstream
+            headers = {"X-Cache": "HIT", "Age": str(int(hit.age))}
+            response_id = f"resp-{uuid4()}"
+            if not stream:
+                return JSONResponse(_response_object(response_id, model, hit.text), headers=headers)
+            if stream_format == "delta":
+                body = _sse_data({"type": "content.delta", "delta": hit.text})
+                bytes_sent = len(body.encode('utf-8'))
+                body += _sse_data({
+                    "type": "response.completed",
+                    "response": _response_object(response_id, model, hit.text, bytes_sent=bytes_sent),
+                })
+            else:
+                body = SSEEvent("message", json.dumps(_answer_event_data(hit.text), ensure_ascii=False)).encode()
+            data = body.encode('utf-8')
+            STREAM_STATS.record(stream_format, len(data))
+            return Response(data, media_type="text/event-stream", headers={**SSE_HEADERS, **headers})
 
         @app.get("/health")
         async def health():
-            return {"status": "ok"}
+            return {
+                "status": "ok",
+                "ready": _ready(),
+                "admission": admission.stats(),
+                "adaptive_limit": LIMIT.stats() if LIMIT is not None else None,
+                "circuit": BREAKER.stats(),
+                "conversations": CONVERSATIONS.stats(),
+                "context_db": CONTEXT_DB.stats() if CONTEXT_DB is not None else None,
+                "accounts": ACCOUNTS.stats(),
+                "retry": RETRY.stats(),
+                "turns": TURNS.stats(),
+                "streams": STREAM_STATS.stats(),
+                "response_cache": RESPONSE_CACHE.stats(),
+                "single_flight": SINGLE_FLIGHT.stats() if SINGLE_FLIGHT is not None else None,
+                "routine_context": ROUTINE_STATS.stats(),
+                "capture": RECORDER.stats() if RECORDER is not None else None,
+                "replay": REPLAY.stats() if REPLAY is not None else None,
+            }
+
+        @app.get("/ready")
+        async def ready():
+            # prontidão para balanceadores/probes: 503 até o aquecimento terminar
+            if _ready():
+                return {"ready": True}
+            return JSONResponse({"ready": False}, status_code=503)
+
+        @app.get("/metrics")
+        async def metrics():
+            # estado por conta é calculado na coleta (quarentena expira sozinha)
+            now = time.monotonic()
+            for account in ACCOUNTS:
+                M_ACCOUNT_AVAILABLE.set(int(account.available(now)), account.name)
+                M_ACCOUNT_OK_RATE.set(account.ok_per_min(now), account.name)
+            return Response(METRICS.render(), media_type=METRICS_CONTENT_TYPE)
+
+        @app.get("/v1/conversations/{conversation_id}")
+        async def conversation_stats(conversation_id: str):
+            stats = TURNS.conversation_stats(conversation_id)
+            if stats is None:
+                return JSONResponse({"error": {"message": "Conversa desconhecida"}}, status_code=404)
+            return {"conversation_id": conversation_id, "cached": conversation_id in CONVERSATIONS, **stats}
 
-        def _get_or_create_client(conversation_id: str | None) -> WorkingPerplexityClient:
-            key = conversation_id or "default"
-            if key not in CONVERSATIONS:
-                CONVERSATIONS[key] = WorkingPerplexityClient()
-            return CONVERSATIONS[key]
+        async def _report_warmup():
+            if await ACCOUNTS.wait_ready():
+                print(f"✅ Upstream aquecido em {ACCOUNTS.warmup_s * 1000:.0f} ms; servidor pronto")
+            else:
+                print("⚠️ Nenhuma sessão do upstream aquecida; /ready responde 503 até o pool se recuperar")
+
+        @app.on_event("startup")
+        async def _warm_sessions():
+            if any(account.pool is not None for account in ACCOUNTS):
+                await ACCOUNTS.start()
+                app.state.warmup_task = asyncio.get_running_loop().create_task(_report_warmup())
+
+        @app.on_event("shutdown")
+        async def _close_conversations():
+            await CONVERSATIONS.aclose()
+            await ACCOUNTS.close()
+            if CONTEXT_DB is not None:
+                CONTEXT_DB.close()
+
+        async def _admit(conversation_id: str | None, query: str, tasks) -> _UpstreamCall:
+            """Breaker -> turno da conversa -> fila de admissão -> cliente (/v1/responses e itens do lote).
+
+            Com o turno da conversa e ``tasks``, a pergunta final sai do contexto da
+            rotina guardado na conversa (call.query, call.routine_kind).
+
+            Raises:
+                _AdmissionRefused: circuito aberto (503), conversa ocupada (409) ou servidor ocupado (429)
+            """
+            # Upstream bloqueando (circuito aberto): falha na hora, sem ocupar turno nem vaga
+            if not BREAKER.allow():
+                M_REJECTED.inc("circuit_open")
+                raise _AdmissionRefused(503, "Upstream bloqueando requisições (circuito aberto)",
+                                        "upstream_circuit_open", BREAKER.retry_after())
+
+            # Sem conversation_id a requisição é avulsa: cliente efêmero, sem fila de conversa
+            turn = None
+            if conversation_id:
+                try:
+                    turn = await TURNS.acquire(conversation_id)
+                except (ConversationBusy, TurnSuperseded) as busy:
+                    M_REJECTED.inc("conversation_busy")
+                    raise _AdmissionRefused(409, f"Conversa ocupada: {busy}", "conversation_busy") from None
+
+            try:
+                lease = await admission.acquire()
+            except AdmissionRejected as rej:
+                if turn is not None:
+                    turn.release()
+                M_REJECTED.inc("admission")
+                raise _AdmissionRefused(429, f"Servidor ocupado: {rej.reason}", "rate_limit", rej.retry_after) from None
+            except BaseException:
+                # cancelada na fila: o turno não pode ficar preso
+                if turn is not None:
+                    turn.release()
+                raise
+            M_ADMISSION_WAIT.observe(lease.wait_s)
+
+            routine_kind = None
+            if turn is not None:
+                client = CONVERSATIONS.checkout(conversation_id)
+                if tasks is not None:
+                    # com o turno da conversa em mãos: contexto completo, diff ou só a pergunta
+                    if client.routine_context is None:
+                        client.routine_context = RoutineContextState()
+                    query, routine_kind, full = client.routine_context.prepare(query, tasks, client.last_backend_uuid)
+                    ROUTINE_STATS.record(routine_kind, len(query), len(full))
+            else:
+                client = _upstream_client()
+            return _UpstreamCall(CONVERSATIONS, conversation_id, client, query, turn, lease, routine_kind)
 
         @app.post("/v1/responses")
         async def responses(request: Request):
@@ -321,293 +1197,420 @@ def start_openai_compat_api(host: str = "127.0.0.1", port: int = 8000, *, thread
             conversation_id = body.get("conversation_id") or body.get("thread_id") or body.get("id_base")
             direct_input = body.get("input") or body.get("prompt") or ""
 
-            client = _get_or_create_client(conversation_id)
-
             query = direct_input if isinstance(direct_input, str) else ""
+            stream_format = body.get("stream_format") or request.headers.get("x-stream-format") or "passthrough"
+            if stream_format not in STREAM_FORMATS:
+                return JSONResponse(
+                    {"error": {"message": f"stream_format inválido: {stream_format!r} (use {', '.join(STREAM_FORMATS)})"}},
+                    status_code=400,
+                )
+            delta_mode = stream_format == "delta"
+            language = body.get("language") or "pt-BR"
 
-            if stream:
-                # Streaming SSE de respostas no formato simples para o cliente consumir
-                def gen_resp():
-                    import json as _json
-                    try:
-                        # Monta o payload igual ao usado em search() para máxima compatibilidade
-                        json_data = {
-                            'query_str': query,
-                            'params': {
-                                'last_backend_uuid': client.last_backend_uuid,
-                                'context_uuid': getattr(client, 'context_uuid', None),
-                                'frontend_context_uuid': getattr(client, 'frontend_context_uuid', None),
-                                'read_write_token': client.read_write_token,
-                                'attachments': [],
-                                'language': 'pt-BR',
-                                'timezone': 'America/Sao_Paulo',
-                                'search_focus': 'internet',
-                                'frontend_uuid': client.frontend_uuid,
-                                'is_related_query': False,
-                                'is_sponsored': False,
-                                'visitor_id': client.visitor_id,
-                                'user_nextauth_id': client.user_nextauth_id,
-                                'prompt_source': 'user',
-                                'query_source': 'followup' if (getattr(client, 'context_uuid', None) or getattr(client, 'read_write_token', None) or getattr(client, 'last_backend_uuid', None)) else 'home',
-                                'is_incognito': False,
-                                'time_from_first_type': None,
-                                'local_search_enabled': False,
-                                'use_schematized_api': True,
-                                'send_back_text_in_streaming_api': False,
-                                'supported_block_use_cases': [
-                                    'answer_modes','media_items','knowledge_cards','inline_entity_cards','place_widgets','finance_widgets','sports_widgets','shopping_widgets','jobs_widgets','search_result_widgets','clarification_responses','inline_images','inline_assets','inline_finance_widgets','placeholder_cards','diff_blocks','inline_knowledge_cards','entity_group_v2'
-                                ],
-                                'client_coordinates': None,
-                                'mentions': [],
-                                'dsl_query': query,
-                                'skip_search_enabled': True,
-                                'is_nav_suggestions_disabled': False,
-                                'always_search_override': False,
-                                'override_no_search': False,
-                                'comet_max_assistant_enabled': False,
-                                'followup_source': None,
-                                'mode': 'concise',
-                                'model_preference': 'turbo',
-                                'source': 'default',
-                                'sources': ['web'],
-                                'version': '2.18',
-                                'context_uuid': getattr(client, 'context_uuid', None),
-                                'search_recency_filter': None,
-                            }
-                        }
+            # Tarefas estruturadas: o servidor monta o prompt da rotina (ver routine_context)
+            tasks = body.get("tasks")
+            routine_headers = {}
+            if tasks is not None:
+                if not isinstance(tasks, list):
+                    return JSONResponse({"error": {"message": "tasks inválido: esperado lista"}}, status_code=400)
+                tasks = normalize_tasks(tasks)
+                if not conversation_id:
+                    # avulsa: sem thread no upstream, sempre o contexto completo
+                    query = render_prompt(tasks, query)
+                    ROUTINE_STATS.record("full", len(query), len(query))
+                    routine_headers["X-Routine-Context"] = "full"
 
-                        # usar curl_cffi (client.session) para manter fingerprint/headers e evitar 403 (Cloudflare)
-                        _sse_headers = {
-                            **client.session.headers,
-                            'accept': 'text/event-stream',
-                            'origin': 'https://www.perplexity.ai',
-                            'referer': 'https://www.perplexity.ai/',
-                            'sec-fetch-mode': 'cors',
-                            'sec-fetch-site': 'same-origin',
-                            'accept-language': 'pt-BR,pt;q=0.9,en-US;q=0.8,en;q=0.7',
-                        }
-                        resp = client.session.post(
-                            'https://www.perplexity.ai/rest/sse/perplexity_ask',
-                            json=json_data,
-                            headers=_sse_headers,
-                            stream=True,
-                        )
-                        if resp.status_code != 200:
-                            try:
-                                body = resp.text[:1000]
-                            except Exception:
-                                body = ''
-                            err = {"error": {"message": f"Upstream HTTP {resp.status_code} | body: {body}"}}
-                            yield f"data: {_json.dumps(err, ensure_ascii=False)}\n\n"
-                            return
-
-                        # valida Content-Type do upstream (evita parse de HTML do Cloudflare)
-                        ct = (resp.headers.get('content-type') or '').lower()
-                        if 'text/event-stream' not in ct:
-                            try:
-                                body = resp.text[:1000]
-                            except Exception:
-                                body = ''
-                            err = {"error": {"message": f"Upstream content-type inesperado: {ct or 'desconhecido'} | body: {body}"}}
-                            yield f"data: {_json.dumps(err, ensure_ascii=False)}\n\n"
-                            return
-
-                        # helper: extrai e atualiza contexto do cliente a partir das linhas do evento SSE
-                        def _update_ctx_from_event_lines(lines: list[str]):
-                            try:
-                                data_parts = [l[5:].lstrip() for l in lines if l.startswith('data:')]
-                                if not data_parts:
-                                    return
-                                joined = ''.join(data_parts).strip()
-                                objs: list = []
-                                try:
-                                    obj = _json.loads(joined)
-                                    objs = [obj]
-                                except Exception:
-                                    for part in data_parts:
-                                        p = part.strip()
-                                        if not p or p[:1] not in ('{', '['):
-                                            continue
-                                        try:
-                                            objs.append(_json.loads(p))
-                                        except Exception:
-                                            continue
-                                for obj in objs:
-                                    if not isinstance(obj, dict):
-                                        continue
-                                    bu = obj.get('backend_uuid')
-                                    cu = obj.get('context_uuid')
-                                    fcu = obj.get('frontend_context_uuid')
-                                    rwt = obj.get('read_write_token')
-                                    if bu:
-                                        setattr(client, 'last_backend_uuid', bu)
-                                    # Preserve o primeiro context_uuid/front_ctx/read_write_token da conversa
-                                    if cu and getattr(client, 'context_uuid', None) is None:
-                                        setattr(client, 'context_uuid', cu)
-                                    if fcu and getattr(client, 'frontend_context_uuid', None) is None:
-                                        setattr(client, 'frontend_context_uuid', fcu)
-                                    if rwt and getattr(client, 'read_write_token', None) is None:
-                                        setattr(client, 'read_write_token', rwt)
-                            except Exception:
-                                pass
-
-                        def _extract_useful_text(piece, st):
-                            # retorna iterável de strings limpias p/ enviar
-                            emitted = st['emitted_chunks']
-                            acc = st['acc_answer']
-                            try:
-                                # strings que parecem JSON -> tentar carregar
-                                if isinstance(piece, str) and piece and piece.lstrip().startswith(("[", "{")):
-                                    piece_loaded = _json.loads(piece)
-                                else:
-                                    piece_loaded = piece
-                            except Exception:
-                                piece_loaded = piece
-
-                            out = []
-                            try:
-                                # caso steps: lista de objetos
-                                if isinstance(piece_loaded, list):
-                                    for step in piece_loaded:
-                                        if not isinstance(step, dict):
-                                            continue
-                                        stype = step.get('step_type')
-                                        if stype == 'INITIAL_QUERY':
-                                            continue
-                                        if stype == 'FINAL':
-                                            content = step.get('content') or {}
-                                            ans_str = content.get('answer')
-                                            if isinstance(ans_str, str):
-                                                try:
-                                                    ans_obj = _json.loads(ans_str)
-                                                except Exception:
-                                                    ans_obj = None
-                                                if isinstance(ans_obj, dict):
-                                                    chunks = ans_obj.get('chunks')
-                                                    if isinstance(chunks, list):
-                                                        for ch in chunks:
-                                                            if isinstance(ch, str) and ch and ch not in emitted:
-                                                                emitted.add(ch)
-                                                                out.append(ch)
-                                                    # fallback: se houver 'answer' final, emitir apenas sufixo novo
-                                                    final_txt = ans_obj.get('answer')
-                                                    if isinstance(final_txt, str) and final_txt:
-                                                        # emite apenas o sufixo não enviado
-                                                        if final_txt.startswith(acc):
-                                                            new_part = final_txt[len(acc):]
-                                                        else:
-                                                            new_part = final_txt
-                                                        if new_part:
-                                                            out.append(new_part)
-                                                        st['acc_answer'] = final_txt
-                                    return out
-                            except Exception:
-                                pass
-                            # não era steps estruturado -> tratar como texto simples
-                            if isinstance(piece, str) and piece.strip():
-                                return [piece]
-                            return []
-
-                        def send_delta(text_piece: str):
-                            data = {"type": "content.delta", "delta": text_piece}
-                            yield f"data: {_json.dumps(data, ensure_ascii=False)}\n\n"
-
-                        def process_event(ev_text: str):
-                            if not ev_text.strip():
-                                return None, None
-                            if ev_text.startswith(":"):
-                                return None, None
-                            if ev_text.strip() == "data: [DONE]":
-                                return None, 'END'
-                            try:
-                                if ev_text.startswith("data: "):
-                                    payload = ev_text[6:]
-                                else:
-                                    payload = ev_text
-                                obj = _json.loads(payload)
-                            except Exception:
-                                return payload, None
-                            if isinstance(obj, dict) and obj.get("type") == "response.completed":
-                                return None, 'END'
-                            return obj, None
-
-                        current_event_lines: list[str] = []
-
-                        buf = b''
-                        for chunk in resp.iter_content(chunk_size=4096):
-                            if not chunk:
+            # Sem conversation_id a resposta não depende de contexto no upstream: pode vir do cache
+            cache_key = cache_cc = None
+            cache_headers = {}
+            if RESPONSE_CACHE.enabled and not conversation_id and query:
+                cache_key = RESPONSE_CACHE.key(query, model, language)
+                cache_cc = CacheControl.parse(request.headers.get("cache-control"))
+                hit = RESPONSE_CACHE.get(cache_key, cache_cc)
+                if hit is not None:
+                    M_RESPONSES.inc("stream" if stream else "json", "cache")
+                    return _cached_response(hit, model, stream, stream_format)
+                cache_headers["X-Cache"] = "MISS" if cache_cc.lookup else "BYPASS"
+
+            async def _upstream_events(client):
+                # eventos do upstream já decodificados: (SSEEvent, [PerplexityEvent]); atualiza o contexto da conversa
+                # usar curl_cffi (client.session) para manter fingerprint/headers e evitar 403 (Cloudflare)
+                t0 = time.perf_counter()
+                events = client.stream_events(query, language=language)
+                last_answer = None
+                upstream_error = False
+                done_ev = None
+                n_events = 0
+                # sem mudar até o fim: o consumidor fechou o gerador (cliente saiu/turno substituído)
+                result = "cancelled"
+                try:
+                    async for ev in events:
+                        if not n_events:
+                            M_UPSTREAM_FIRST_EVENT.observe(time.perf_counter() - t0)
+                        n_events += 1
+                        if ev.data.strip() == '[DONE]':
+                            # interromper apenas em '[DONE]'
+                            done_ev = ev
+                            break
+                        decoded = _decode(ev)
+                        for dec in decoded:
+                            client._update_ctx(dec.obj)
+                            if dec.error is not None:
+                                upstream_error = True
+                            elif 'text' in dec.obj or 'blocks' in dec.obj:
+                                last_answer = dec
+                        yield ev, decoded
+                    result = "upstream_error" if upstream_error else "completed"
+                except Exception:
+                    result = "failed"
+                    raise
+                finally:
+                    await events.aclose()
+                    M_UPSTREAM_STREAM.observe(time.perf_counter() - t0, result)
+                    M_UPSTREAM_EVENTS.observe(n_events)
+                if cache_key is not None and last_answer is not None and not upstream_error:
+                    RESPONSE_CACHE.put(cache_key, last_answer.answer_text or "", cache_cc)
+                if done_ev is not None:
+                    yield done_ev, []
+
+            async def _search_result(client):
+                t0 = time.perf_counter()
+                resp = await client.search(query, model=model, language=language, is_followup=False)
+                content = client.get_answer_text(resp) or ""
+                # search() já trata os erros do upstream (abertura contada em upstream_open_seconds)
+                M_SEARCH.observe(time.perf_counter() - t0, "ok" if content else "empty")
+                if cache_key is not None:
+                    RESPONSE_CACHE.put(cache_key, content, cache_cc)
+                yield content
+
+            async def _transcode(source, turn, st):
+                # converte os eventos do upstream no formato pedido (passthrough ou delta)
+                try:
+                    while True:
+                        if turn is not None and turn.superseded:
+                            raise TurnSuperseded("requisição substituída por outra mais nova na mesma conversa")
+                        # com turno, a espera pelo próximo evento é cancelável: a requisição mais
+                        # nova derruba esta na hora, sem esperar o upstream mandar mais nada
+                        try:
+                            ev, decoded = await (turn.run(anext(source)) if turn is not None else anext(source))
+                        except StopAsyncIteration:
+                            break
+                        if not delta_mode:
+                            # passthrough: reenvia o evento como veio do upstream (linhas terminadas em '\n')
+                            yield ev.encode()
+                            continue
+                        for dec in decoded:
+                            if dec.error is not None:
+                                yield _sse_data({"error": {"message": dec.error}})
                                 continue
-                            buf += chunk
-                            while b'\n' in buf:
-                                raw_line, buf = buf.split(b'\n', 1)
-                                line = raw_line.decode('utf-8', 'ignore')
-                                if not line:
-                                    continue
-                                if line.strip() == '':
-                                    ev = '\r\n'.join(current_event_lines)
-                                    _update_ctx_from_event_lines(current_event_lines)
-                                    current_event_lines = []
-                                    # passthrough: reenvia exatamente como veio do upstream
-                                    yield f"{ev}\n\n"
-                                    # interromper apenas em '[DONE]'
-                                    if ev.strip() == 'data: [DONE]':
-                                        break
-                                else:
-                                    current_event_lines.append(line)
-                            else:
-                                pass
-                        if buf:
-                            try:
-                                tail = buf.decode('utf-8', 'ignore')
-                                if tail:
-                                    current_event_lines.append(tail)
-                            except Exception:
-                                pass
-                        if current_event_lines:
-                            ev = '\r\n'.join(current_event_lines)
-                            _update_ctx_from_event_lines(current_event_lines)
-                            current_event_lines = []
-                            # passthrough: reenvia exatamente como veio do upstream
-                            yield f"{ev}\n\n"
-                            # fora do loop de linhas, encerrar somente em '[DONE]'
-                            if ev.strip() == 'data: [DONE]':
-                                return
-
-                    except Exception as stre:
-                        err = {"error": {"message": f"Stream error: {stre.__class__.__name__}: {str(stre) or 'no message'}"}}
-                        yield f"data: {_json.dumps(err, ensure_ascii=False)}\n\n"
-                        return
-
-                return StreamingResponse(
-                    gen_resp(),
-                    media_type="text/event-stream",
-                    headers={
-                        "Cache-Control": "no-cache",
-                        "Connection": "keep-alive",
-                        "X-Accel-Buffering": "no",
-                    },
+                            out = _answer_delta(dec, st)
+                            if out is not None:
+                                yield _sse_data(out)
+                    st['completed'] = True
+                except TurnSuperseded:
+                    yield _sse_data({"error": {"message": "Requisição substituída por outra mais nova na mesma conversa"}})
+                except PerplexityUpstreamError as ue:
+                    yield _sse_data({"error": {"message": str(ue)}})
+                except Exception as stre:
+                    yield _sse_data({"error": {"message": f"Stream error: {stre.__class__.__name__}: {str(stre) or 'no message'}"}})
+                finally:
+                    await source.aclose()
+
+            async def _stream_body(source, release, turn):
+                # devolve a vaga do upstream ao fim do stream (ou se o cliente desconectar)
+                st = {'text': '', 'completed': False}
+                stream_bytes = 0
+                body = _transcode(source, turn, st)
+                try:
+                    async for piece in body:
+                        data = piece.encode('utf-8')
+                        stream_bytes += len(data)
+                        yield data
+                    if delta_mode and st['completed']:
+                        data = _sse_data({
+                            "type": "response.completed",
+                            # bytes_sent: bytes enviados neste stream antes deste evento
+                            "response": _response_object(f"resp-{uuid4()}", model, st['text'],
+                                                         conversation_id=conversation_id, bytes_sent=stream_bytes),
+                        }).encode('utf-8')
+                        stream_bytes += len(data)
+                        yield data
+                finally:
+                    try:
+                        # fecha (cortando a transferência com o upstream) antes de devolver a vaga;
+                        # a vaga volta mesmo se o fechamento for interrompido por cancelamento
+                        await body.aclose()
+                    finally:
+                        release()
+                        STREAM_STATS.record(stream_format, stream_bytes)
+                        M_STREAM_BYTES.observe(stream_bytes, stream_format)
+
+            async def _respond(source, release, headers, turn=None):
+                if stream:
+                    async def _release_in_loop():
+                        # BackgroundTask roda funções síncronas no threadpool; a liberação precisa ficar no event loop
+                        release()
+
+                    return StreamingResponse(
+                        _stream_body(source, release, turn),
+                        media_type="text/event-stream",
+                        headers={**SSE_HEADERS, **headers},
+                        # garante a devolução da vaga mesmo se o cliente cair antes do stream começar
+                        background=BackgroundTask(_release_in_loop),
+                    )
+
+                # Caminho não-stream
+                async def _collect():
+                    content = ""
+                    async for content in source:
+                        pass
+                    return content
+
+                try:
+                    content = await (turn.run(_collect()) if turn is not None else _collect())
+                except TurnSuperseded as sup:
+                    return JSONResponse(
+                        {"error": {"message": str(sup), "type": "conversation_superseded"}},
+                        status_code=409,
+                    )
+                finally:
+                    release()
+                return JSONResponse(_response_object(f"resp-{uuid4()}", model, content), headers=headers)
+
+            # Requisições idênticas sem estado em andamento compartilham o mesmo upstream
+            flight_key = None
+            if SINGLE_FLIGHT is not None and not conversation_id and query:
+                flight_key = ("stream" if stream else "search",) + ResponseCache.key(query, model, language)
+                sub = SINGLE_FLIGHT.join(flight_key)
+                if sub is not None:
+                    # inscrito em voo existente: não ocupa vaga do upstream
+                    headers = {"X-Single-Flight": "follower", **cache_headers, **routine_headers}
+                    M_RESPONSES.inc("stream" if stream else "json", "single_flight")
+                    return await _respond(sub, sub.close, headers)
+
+            try:
+                call = await _admit(conversation_id, query, tasks)
+            except _AdmissionRefused as ref:
+                return JSONResponse(
+                    {"error": ref.error()},
+                    status_code=ref.status_code,
+                    headers={"Retry-After": str(ref.retry_after)} if ref.retry_after is not None else None,
                 )
+            M_RESPONSES.inc("stream" if stream else "json", "upstream")
+            client, query, turn = call.client, call.query, call.turn
+            queue_headers = {"X-Queue-Wait-Ms": str(int(call.lease.wait_s * 1000)), **cache_headers, **routine_headers}
+            if turn is not None:
+                queue_headers["X-Conversation-Wait-Ms"] = str(int(turn.wait_s * 1000))
+            if call.routine_kind is not None:
+                queue_headers["X-Routine-Context"] = call.routine_kind
 
-            # Caminho não-stream
-            resp = client.search(query, model=model, language='pt-BR', is_followup=False)
-            content = client.get_answer_text(resp) or ""
+            source = _upstream_events(client) if stream else _search_result(client)
+            if flight_key is not None:
+                # o voo é dono do upstream: a vaga é devolvida quando ele termina, não quando este cliente sai
+                sub = SINGLE_FLIGHT.start(flight_key, source, on_done=call.release)
+                queue_headers["X-Single-Flight"] = "leader"
+                return await _respond(sub, sub.close, queue_headers)
+            return await _respond(source, call.release, queue_headers, turn)
 
-            data = {
-                "id": f"resp-{uuid4()}",
-                "object": "response",
-                "created": int(time.time()),
-                "model": model,
-                "output": [
-                    {
-                        "type": "message",
-                        "role": "assistant",
-                        "content": [
-                            {"type": "output_text", "text": content}
-                        ]
-                    }
-                ],
-            }
-            return JSONResponse(data)
+        async def _batch_item(item: dict, model: str, language: str) -> dict:
+            # um item do lote pelo mesmo caminho do /v1/responses não-stream; erros ficam no resultado do item
+            query = item.get("input") or item.get("prompt") or ""
+            conversation_id = item.get("conversation_id") or item.get("thread_id") or item.get("id_base")
+            language = item.get("language") or language
+            if not isinstance(query, str) or not query:
+                return {"status": "error", "error": {"message": "input vazio ou inválido", "type": "invalid_request"}}
+            tasks = item.get("tasks")
+            if tasks is not None:
+                if not isinstance(tasks, list):
+                    return {"status": "error", "error": {"message": "tasks inválido: esperado lista", "type": "invalid_request"}}
+                tasks = normalize_tasks(tasks)
+                if not conversation_id:
+                    query = render_prompt(tasks, query)
+                    ROUTINE_STATS.record("full", len(query), len(query))
+            cache_key = None
+            if RESPONSE_CACHE.enabled and not conversation_id:
+                cache_key = RESPONSE_CACHE.key(query, model, language)
+                hit = RESPONSE_CACHE.get(cache_key)
+                if hit is not None:
+                    M_RESPONSES.inc("batch", "cache")
+                    return {"status": "ok", "output_text": hit.text, "cache": "HIT"}
+            try:
+                call = await _admit(conversation_id, query, tasks)
+            except _AdmissionRefused as ref:
+                # no lote o Retry-After vai no resultado do item
+                error = ref.error()
+                if ref.retry_after is not None:
+                    error["retry_after"] = ref.retry_after
+                return {"status": "error", "error": error}
+            M_RESPONSES.inc("batch", "upstream")
+            client, query, turn = call.client, call.query, call.turn
+
+            async def _search():
+                # search_stream() em vez de search(): o erro do upstream chega ao resultado do item
+                final = None
+                events = client.search_stream(query, model=model, language=language)
+                try:
+                    async for final in events:
+                        pass
+                finally:
+                    await events.aclose()
+                return client.get_answer_text(final) if final is not None else None
+
+            t0 = time.perf_counter()
+            content = None
+            try:
+                content = await (turn.run(_search()) if turn is not None else _search())
+            except TurnSuperseded as sup:
+                return {"status": "error", "error": {"message": str(sup), "type": "conversation_superseded"}}
+            except CircuitOpenError as coe:
+                return {"status": "error", "error": {"message": str(coe), "type": "upstream_circuit_open",
+                                                     "retry_after": coe.retry_after}}
+            except PerplexityUpstreamError as ue:
+                return {"status": "error", "error": {"message": str(ue), "type": "upstream_error",
+                                                     "status_code": ue.status_code}}
+            except Exception as e:
+                return {"status": "error", "error": {
+                    "message": f"{e.__class__.__name__}: {str(e) or 'no message'}", "type": "upstream_error",
+                }}
+            finally:
+                M_SEARCH.observe(time.perf_counter() - t0, "ok" if content else "empty")
+                call.release()
+            if not content:
+                return {"status": "error", "error": {"message": "Resposta vazia do upstream", "type": "upstream_error"}}
+            if cache_key is not None:
+                RESPONSE_CACHE.put(cache_key, content)
+            return {"status": "ok", "output_text": content}
+
+        @app.post("/v1/responses/batch")
+        async def responses_batch(request: Request):
+            """Vários itens {input, conversation_id} em paralelo; um JSON por linha (NDJSON) na ordem em que terminam.
+
+            Itens da mesma conversa rodam em sequência, na ordem do lote; conversas
+            diferentes e itens avulsos rodam em paralelo (até "concurrency"). A
+            última linha é o resumo do lote (type = "batch.summary").
+            """
+            try:
+                body = await request.json()
+            except Exception:
+                return JSONResponse({"error": {"message": "Body inválido: esperado JSON"}}, status_code=400)
+            items = body.get("items") if isinstance(body, dict) else None
+            if not isinstance(items, list) or not items or not all(isinstance(it, dict) for it in items):
+                return JSONResponse({"error": {"message": "items inválido: esperada lista de objetos"}}, status_code=400)
+            if len(items) > BATCH_MAX_ITEMS:
+                return JSONResponse({"error": {"message": f"Lote grande demais: {len(items)} itens (máximo {BATCH_MAX_ITEMS})"}},
+                                    status_code=400)
+            model = body.get("model", "gpt-4o")
+            language = body.get("language") or "pt-BR"
+            try:
+                concurrency = int(body.get("concurrency") or BATCH_CONCURRENCY)
+            except (TypeError, ValueError):
+                return JSONResponse({"error": {"message": "concurrency inválido"}}, status_code=400)
+            concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+
+            # itens da mesma conversa em um grupo sequencial; avulsos, um grupo cada
+            groups: dict = {}
+            for index, item in enumerate(items):
+                key = item.get("conversation_id") or item.get("thread_id") or item.get("id_base") or ("", index)
+                groups.setdefault(key, []).append(index)
+            pending = deque(groups.values())
+
+            async def _worker(out: asyncio.Queue):
+                while pending:
+                    for index in pending.popleft():
+                        item = items[index]
+                        conversation_id = item.get("conversation_id") or item.get("thread_id") or item.get("id_base")
+                        t0 = time.perf_counter()
+                        try:
+                            result = await _batch_item(item, model, language)
+                        except Exception as e:
+                            # erro inesperado (ex.: tasks malformado) fica isolado no item
+                            result = {"status": "error", "error": {
+                                "message": f"{e.__class__.__name__}: {str(e) or 'no message'}", "type": "invalid_request",
+                            }}
+                        result = {
+                            "index": index,
+                            **({"id": item["id"]} if "id" in item else {}),
+                            **({"conversation_id": conversation_id} if conversation_id else {}),
+                            **result,
+                            "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+                        }
+                        M_BATCH_ITEMS.inc(result["status"])
+                        await out.put(result)
+
+            async def _lines():
+                out: asyncio.Queue = asyncio.Queue()
+                t0 = time.perf_counter()
+                workers = [asyncio.ensure_future(_worker(out)) for _ in range(min(concurrency, len(groups)))]
+                latencies = []
+                errors: dict = {}
+                try:
+                    for _ in range(len(items)):
+                        result = await out.get()
+                        latencies.append(result["elapsed_ms"])
+                        if result["status"] != "ok":
+                            kind = result["error"]["type"]
+                            errors[kind] = errors.get(kind, 0) + 1
+                        yield json.dumps(result, ensure_ascii=False) + "\n"
+                    elapsed = time.perf_counter() - t0
+                    latencies.sort()
+                    yield json.dumps({
+                        "type": "batch.summary",
+                        "items": len(items),
+                        "ok": len(items) - sum(errors.values()),
+                        "errors": errors,
+                        "conversations": sum(1 for key in groups if not isinstance(key, tuple)),
+                        "concurrency": concurrency,
+                        "elapsed_s": round(elapsed, 3),
+                        "items_per_s": round(len(items) / elapsed, 2) if elapsed > 0 else None,
+                        "latency_ms": {
+                            "p50": latencies[len(latencies) // 2],
+                            "p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+                            "max": latencies[-1],
+                        },
+                    }, ensure_ascii=False) + "\n"
+                finally:
+                    # cliente desconectou: os itens ainda não iniciados não vão ao upstream
+                    pending.clear()
+                    for w in workers:
+                        w.cancel()
+
+            return StreamingResponse(_lines(), media_type="application/x-ndjson", headers={"Cache-Control": "no-cache"})
+
+        def _decode(ev):
+            # decodifica o evento uma única vez; steps/answer ficam sob demanda no PerplexityEvent
+            if not ev.data or ev.data.strip() == '[DONE]':
+                return []
+            dec = decode_event(ev.data)
+            if dec is not None:
+                return [dec]
+            # fallback: várias linhas data: com um JSON em cada
+            out = []
+            for part in ev.data.split('\n'):
+                p = part.strip()
+                if p[:1] in ('{', '['):
+                    dec = decode_event(p)
+                    if dec is not None:
+                        out.append(dec)
+            return out
+
+        def _answer_delta(dec, st):
+            # converte o snapshot cumulativo da resposta no trecho ainda não enviado
+            chunks = dec.answer_chunks
+            text = ''.join(chunks) if chunks is not None else dec.answer_text
+            if not text:
+                return None
+            sent = st['text']
+            if text.startswith(sent):
+                if len(text) == len(sent):
+                    return None
+                st['text'] = text
+                return {"type": "content.delta", "delta": text[len(sent):]}
+            if sent.startswith(text):
+                # snapshot atrasado (mais curto que o já enviado): nada novo
+                return None
+            # raro: o upstream reescreveu trecho já enviado -> cliente substitui o texto inteiro
+            st['text'] = text
+            return {"type": "content.replace", "text": text}
 
         def _run():
             uvicorn.run(app, host=host, port=port, log_level="warning")
@@ -640,6 +1643,14 @@ if __name__ == "__main__":
             return "0.0.0.0"  # Fallback para aceitar todas as interfaces
     
     host_ip = get_local_ip()
+    workers = _env_int("PPLX_WORKERS", 1)
+    if workers > 1:
+        # N processos atrás de um roteador com afinidade por conversation_id
+        from worker_router import serve_multiprocess
+
+        print(f"Iniciando {workers} workers OpenAI-compat: http://{host_ip}:8000/v1")
+        serve_multiprocess(host="0.0.0.0", port=8000, workers=workers)
+        raise SystemExit(0)
     print(f"Iniciando servidor OpenAI-compat em modo bloqueante: http://{host_ip}:8000/v1")
     print(f"Servidor também acessível via: http://0.0.0.0:8000/v1")
     ok, _ = start_openai_compat_api(host="0.0.0.0", threaded=False)
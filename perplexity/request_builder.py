@@ -0,0 +1,108 @@
+# request_builder.py
+"""Corpo da requisição perplexity_ask montado em um único lugar.
+
+O payload (~50 campos) era montado à mão duas vezes, em _build_payload() dos
+clientes e no gen_resp() do servidor, e as cópias já tinham divergido
+(time_from_first_type, language, followup_source). A cada requisição os
+dicts eram recriados, inclusive a lista estática de
+supported_block_use_cases, e serializados de novo.
+
+Aqui os parâmetros estáticos são serializados uma única vez em bytes; por
+requisição só os campos variáveis (pergunta, ids de contexto, uuids,
+idioma, fontes) são serializados e emendados no fragmento pronto.
+"""
+import json
+
+from event_decoder import JSON_BACKEND
+
+__all__ = ["STATIC_PARAMS", "AskRequestBuilder", "build_ask_body"]
+
+# Parâmetros que não dependem da conversa nem da pergunta
+STATIC_PARAMS = {
+    'attachments': [],
+    'timezone': 'America/Sao_Paulo',
+    'search_focus': 'internet',
+    'is_related_query': False,
+    'is_sponsored': False,
+    'prompt_source': 'user',
+    'is_incognito': False,
+    'time_from_first_type': None,
+    'local_search_enabled': False,
+    'use_schematized_api': True,
+    'send_back_text_in_streaming_api': False,
+    'supported_block_use_cases': [
+        'answer_modes', 'media_items', 'knowledge_cards',
+        'inline_entity_cards', 'place_widgets', 'finance_widgets',
+        'sports_widgets', 'shopping_widgets', 'jobs_widgets',
+        'search_result_widgets', 'clarification_responses',
+        'inline_images', 'inline_assets', 'inline_finance_widgets',
+        'placeholder_cards', 'diff_blocks', 'inline_knowledge_cards', 'entity_group_v2'
+    ],
+    'client_coordinates': None,
+    'mentions': [],
+    'skip_search_enabled': True,
+    'is_nav_suggestions_disabled': False,
+    'always_search_override': False,
+    'override_no_search': False,
+    'comet_max_assistant_enabled': False,
+    'mode': 'concise',
+    'model_preference': 'turbo',
+    'source': 'default',
+    'version': '2.18',
+    'search_recency_filter': None,
+}
+
+if JSON_BACKEND == "orjson":
+    import orjson
+
+    _dumps = orjson.dumps
+else:
+    def _dumps(obj) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class AskRequestBuilder:
+    """Serializa o corpo do perplexity_ask com os parâmetros estáticos pré-serializados.
+
+    Args:
+        static_params: parâmetros fixos (serializados uma vez no construtor)
+    """
+
+    __slots__ = ("_static",)
+
+    def __init__(self, static_params: dict = STATIC_PARAMS):
+        # '"k":v,...' sem as chaves externas, pronto para ser emendado
+        self._static = _dumps(static_params)[1:-1]
+
+    def build(self, query: str, ctx, *, language: str = 'pt-BR', sources=('web',), is_followup: bool = False) -> bytes:
+        """Corpo JSON (bytes) para a pergunta, com o contexto da conversa de ``ctx`` (cliente)."""
+        last_backend_uuid = ctx.last_backend_uuid
+        context_uuid = ctx.context_uuid
+        read_write_token = ctx.read_write_token
+        params = {
+            'last_backend_uuid': last_backend_uuid,
+            'context_uuid': context_uuid,
+            'frontend_context_uuid': ctx.frontend_context_uuid,
+            'read_write_token': read_write_token,
+            'language': language,
+            'frontend_uuid': ctx.frontend_uuid,
+            'visitor_id': ctx.visitor_id,
+            'user_nextauth_id': ctx.user_nextauth_id,
+            'query_source': 'followup' if (context_uuid or read_write_token or last_backend_uuid) else 'home',
+            'followup_source': 'link' if is_followup else None,
+            'sources': list(sources),
+        }
+        # a pergunta vai duas vezes (query_str e dsl_query): serializa uma só
+        q = _dumps(query)
+        return b''.join((
+            b'{"query_str":', q,
+            b',"params":{', _dumps(params)[1:-1], b',"dsl_query":', q, b',', self._static, b'}}',
+        ))
+
+
+_DEFAULT = AskRequestBuilder()
+
+
+def build_ask_body(query: str, ctx, **kwargs) -> bytes:
+    """Atalho para o builder padrão (ver AskRequestBuilder.build)."""
+    return _DEFAULT.build(query, ctx, **kwargs)
@@ -0,0 +1,161 @@
+# response_cache.py
+"""Cache exato de respostas para chamadas sem estado de /v1/responses.
+
+Requisições sem conversation_id não dependem de contexto anterior no
+upstream: a mesma pergunta (mesmo modelo e idioma) tem a mesma resposta
+enquanto ela for recente. Aqui guardamos o texto final (get_answer_text())
+por ``max_entries`` entradas (LRU) e ``ttl`` segundos, e o servidor o devolve
+sem passar pelo Perplexity.
+
+A chave usa a pergunta normalizada (espaços colapsados nas pontas e no meio);
+maiúsculas/minúsculas e pontuação continuam distinguindo perguntas.
+
+O cliente controla o cache pelo header Cache-Control da requisição:
+
+    no-cache   - ignora a entrada guardada, mas grava a resposta nova
+    no-store   - não lê nem grava
+    max-age=N  - só aceita entradas com até N segundos
+"""
+import re
+import time
+from collections import OrderedDict
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_query(query: str) -> str:
+    return _WS.sub(" ", query).strip()
+
+
+class CacheControl:
+    """Diretivas de Cache-Control relevantes para o cache de respostas."""
+
+    __slots__ = ("no_cache", "no_store", "max_age")
+
+    def __init__(self, no_cache: bool = False, no_store: bool = False, max_age: float | None = None):
+        self.no_cache = no_cache
+        self.no_store = no_store
+        self.max_age = max_age
+
+    @classmethod
+    def parse(cls, header: str | None) -> "CacheControl":
+        cc = cls()
+        if not header:
+            return cc
+        for part in header.lower().split(","):
+            name, _, value = part.strip().partition("=")
+            if name == "no-cache":
+                cc.no_cache = True
+            elif name == "no-store":
+                cc.no_store = True
+            elif name == "max-age":
+                try:
+                    cc.max_age = max(0.0, float(value.strip('" ')))
+                except ValueError:
+                    pass
+        return cc
+
+    @property
+    def lookup(self) -> bool:
+        return not (self.no_cache or self.no_store)
+
+
+class _Entry:
+    __slots__ = ("text", "stored_at")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.stored_at = time.monotonic()
+
+
+class CachedAnswer:
+    """Resposta servida do cache: texto e idade (s)."""
+
+    __slots__ = ("text", "age")
+
+    def __init__(self, text: str, age: float):
+        self.text = text
+        self.age = age
+
+
+class ResponseCache:
+    """Cache LRU + TTL de respostas por (pergunta normalizada, modelo, idioma).
+
+    Args:
+        max_entries: respostas mantidas (0 desativa o cache)
+        ttl: segundos até uma resposta expirar
+    """
+
+    def __init__(self, max_entries: int = 0, ttl: float = 300.0):
+        self.max_entries = max(0, int(max_entries))
+        self.ttl = max(0.0, float(ttl))
+        self._entries: "OrderedDict[tuple, _Entry]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions_lru = 0
+        self.evictions_ttl = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def key(query: str, model: str, language: str) -> tuple:
+        return (normalize_query(query), model, language)
+
+    def get(self, key: tuple, cc: CacheControl | None = None) -> CachedAnswer | None:
+        """Resposta guardada para a chave (None se ausente, expirada ou ignorada pelo Cache-Control)."""
+        if not self.enabled:
+            return None
+        if cc is not None and not cc.lookup:
+            self.bypassed += 1
+            return None
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        age = time.monotonic() - entry.stored_at
+        if self.ttl and age >= self.ttl:
+            # expiração preguiçosa: entradas vencidas nunca lidas saem pelo LRU
+            del self._entries[key]
+            self.evictions_ttl += 1
+            self.misses += 1
+            return None
+        if cc is not None and cc.max_age is not None and age > cc.max_age:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return CachedAnswer(entry.text, age)
+
+    def put(self, key: tuple, text: str, cc: CacheControl | None = None):
+        """Guarda a resposta (respostas vazias e no-store não são gravadas)."""
+        if not self.enabled or not text or (cc is not None and cc.no_store):
+            return
+        self._entries[key] = _Entry(text)
+        self._entries.move_to_end(key)
+        self.stores += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions_lru += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_s": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "evictions_lru": self.evictions_lru,
+            "evictions_ttl": self.evictions_ttl,
+        }
@@ -0,0 +1,201 @@
+# routine_context.py
+"""Prompt do assistente de rotina montado no servidor.
+
+O app Next.js (app/api/chat/route.js) remontava a cada mensagem um prompt de
+vários KB com as instruções, todas as tarefas e as estatísticas, e o enviava
+como ``input``. Numa conversa cujo contexto já está no upstream isso só
+aumenta o payload e a latência do modelo.
+
+Agora o app envia as tarefas estruturadas (``tasks``) junto da mensagem e o
+servidor decide o que mandar ao upstream em cada turno:
+
+    full      - instruções + contexto completo + pergunta (primeiro turno,
+                conversa sem thread no upstream ou diff maior que o contexto)
+    diff      - só as tarefas adicionadas/removidas/alteradas + pergunta
+    unchanged - só a pergunta
+
+O contexto enviado só é considerado registrado quando o upstream confirma o
+turno (o last_backend_uuid da conversa muda); se o turno falhar, o próximo
+compara de novo com o último contexto confirmado.
+"""
+import hashlib
+import json
+
+__all__ = ["render_prompt", "normalize_tasks", "RoutineContextState", "RoutineContextStats"]
+
+_INSTRUCTIONS = """INSTRUÇÕES DO SISTEMA:
+Você é um assistente especializado em produtividade pessoal e organização de rotinas. Sua função é ajudar o usuário com suas tarefas diárias de forma prática e objetiva.
+
+DIRETRIZES OBRIGATÓRIAS:
+1. SEMPRE responda em português brasileiro
+2. Seja direto, claro e conciso - evite textos longos
+3. Foque apenas em produtividade, organização e gestão de tarefas
+4. NUNCA faça pesquisas na internet - use APENAS o contexto fornecido
+5. NÃO acesse dados externos - trabalhe apenas com as informações das tarefas do usuário
+6. Se não souber algo específico, seja honesto e ofereça alternativas práticas
+7. Mantenha tom amigável mas profissional
+8. Dê respostas acionáveis - sempre inclua próximos passos ou sugestões práticas
+9. IMPORTANTE: Responda APENAS com base nas tarefas cadastradas pelo usuário"""
+
+_STRUCTURE = """ ESTRUTURA DA ROTINA:
+O usuário organiza suas tarefas em dois modelos:
+1. Rotina de dias úteis (segunda a sexta-feira)
+2. Rotina de fim de semana (sábado e domingo)"""
+
+_FOOTER = "Responda considerando EXCLUSIVAMENTE o contexto das tarefas acima. NÃO faça pesquisas externas."
+_FOLLOWUP_FOOTER = "Responda considerando EXCLUSIVAMENTE o contexto das tarefas já informado nesta conversa. NÃO faça pesquisas externas."
+
+
+def _str(value) -> str:
+    return value.strip() if isinstance(value, str) else ""
+
+
+def normalize_tasks(tasks) -> tuple:
+    """Tarefas como tuplas (fim_de_semana, texto, horário, descrição, concluída), na ordem recebida."""
+    out = []
+    for task in tasks or ():
+        if not isinstance(task, dict):
+            continue
+        out.append((
+            bool(task.get("isWeekend")),
+            _str(task.get("text")),
+            _str(task.get("time")),
+            _str(task.get("description")),
+            bool(task.get("completed")),
+        ))
+    return tuple(out)
+
+
+def _task_line(task: tuple) -> str:
+    _, text, time_, description, completed = task
+    line = f"- {text}"
+    if time_:
+        line += f" ({time_})"
+    if description:
+        line += f" - {description}"
+    return line + (" - Concluída" if completed else " - Pendente")
+
+
+def _stats_block(tasks: tuple) -> str:
+    return "\n".join([
+        " RESUMO ESTATÍSTICO:",
+        f"- Total de tarefas: {len(tasks)}",
+        f"- Tarefas concluídas: {sum(1 for t in tasks if t[4])}",
+        f"- Tarefas pendentes: {sum(1 for t in tasks if not t[4])}",
+        f"- Tarefas com horário: {sum(1 for t in tasks if t[2])}",
+    ])
+
+
+def render_prompt(tasks: tuple, question: str) -> str:
+    """Prompt completo (mesmo texto que o route.js montava)."""
+    weekday = [_task_line(t) for t in tasks if not t[0]]
+    weekend = [_task_line(t) for t in tasks if t[0]]
+    return "\n\n".join([
+        _INSTRUCTIONS,
+        "CONTEXTO COMPLETO DO USUÁRIO:",
+        " TAREFAS DOS DIAS DA SEMANA (Segunda a Sexta):\n"
+        + ("\n".join(weekday) if weekday else "Nenhuma tarefa cadastrada para dias da semana"),
+        " TAREFAS DO FIM DE SEMANA (Sábado e Domingo):\n"
+        + ("\n".join(weekend) if weekend else "Nenhuma tarefa cadastrada para fim de semana"),
+        _stats_block(tasks),
+        _STRUCTURE,
+        f"PERGUNTA DO USUÁRIO: {question}",
+        _FOOTER,
+    ])
+
+
+def _keyed(tasks: tuple) -> dict:
+    # identidade da tarefa: período + texto + horário (repetições numeradas pela ordem)
+    out = {}
+    seen: dict = {}
+    for t in tasks:
+        base = (t[0], t[1], t[2])
+        n = seen.get(base, 0)
+        seen[base] = n + 1
+        out[base + (n,)] = t
+    return out
+
+
+def _render_diff(old: tuple, new: tuple, question: str) -> str:
+    before = _keyed(old)
+    after = _keyed(new)
+    lines = ["ATUALIZAÇÃO DAS TAREFAS (desde a mensagem anterior):"]
+    for key, t in after.items():
+        period = "fim de semana" if t[0] else "dias da semana"
+        prev = before.get(key)
+        if prev is None:
+            lines.append(f"+ nova ({period}): {_task_line(t)[2:]}")
+        elif prev != t:
+            lines.append(f"~ alterada ({period}): {_task_line(prev)[2:]} -> {_task_line(t)[2:]}")
+    for key, t in before.items():
+        if key not in after:
+            period = "fim de semana" if t[0] else "dias da semana"
+            lines.append(f"- removida ({period}): {_task_line(t)[2:]}")
+    return "\n\n".join([
+        "\n".join(lines),
+        _stats_block(new),
+        f"PERGUNTA DO USUÁRIO: {question}",
+        _FOLLOWUP_FOOTER,
+    ])
+
+
+def _digest(tasks: tuple) -> str:
+    return hashlib.sha1(json.dumps(tasks, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class RoutineContextState:
+    """Contexto de rotina já registrado no upstream para uma conversa."""
+
+    __slots__ = ("digest", "tasks", "_pending", "_anchor")
+
+    def __init__(self):
+        self.digest = None
+        self.tasks: tuple = ()
+        self._pending = None
+        self._anchor = None
+
+    def prepare(self, question: str, tasks: tuple, anchor) -> tuple[str, str, str]:
+        """Monta a query do turno; anchor = last_backend_uuid da conversa antes do envio.
+
+        Retorna (query, tipo, prompt completo) com tipo 'full', 'diff' ou 'unchanged'.
+        """
+        # o turno anterior chegou ao upstream? então o contexto que ele levou está registrado
+        if self._pending is not None and anchor is not None and anchor != self._anchor:
+            self.tasks, self.digest = self._pending
+        self._pending = None
+
+        digest = _digest(tasks)
+        full = render_prompt(tasks, question)
+        if self.digest is None or anchor is None:
+            query, kind = full, "full"
+        elif digest == self.digest:
+            query, kind = question, "unchanged"
+        else:
+            query, kind = _render_diff(self.tasks, tasks, question), "diff"
+            if len(query) >= len(full):
+                query, kind = full, "full"
+        self._pending = (tasks, digest)
+        self._anchor = anchor
+        return query, kind, full
+
+
+class RoutineContextStats:
+    """Turnos por tipo e caracteres enviados x o que o prompt completo custaria."""
+
+    def __init__(self):
+        self.turns = {"full": 0, "diff": 0, "unchanged": 0}
+        self.chars_sent = 0
+        self.chars_full = 0
+
+    def record(self, kind: str, sent: int, full: int):
+        self.turns[kind] += 1
+        self.chars_sent += sent
+        self.chars_full += full
+
+    def stats(self) -> dict:
+        return {
+            **self.turns,
+            "chars_sent": self.chars_sent,
+            "chars_full": self.chars_full,
+            "chars_saved": self.chars_full - self.chars_sent,
+        }
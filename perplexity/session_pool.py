@@ -0,0 +1,258 @@
+# session_pool.py
+"""Pool de sessões curl_cffi já autenticadas, compartilhadas entre conversas.
+
+Criar um AsyncWorkingPerplexityClient por conversa custava, na primeira
+mensagem, um GET /api/auth/session e os handshakes TLS/Cloudflare de uma
+sessão nova. Aqui as sessões são aquecidas antecipadamente e emprestadas por
+requisição; o contexto da conversa (ids/tokens) continua no cliente.
+
+Uma AsyncSession multiplexa várias requisições, então o empréstimo escolhe a
+sessão menos ocupada em vez de reservar uma sessão exclusiva. Sessões que
+falham (ex.: 403 do Cloudflare) ou passam de ``max_age`` são descartadas e
+repostas em background.
+
+Sessões ociosas por mais de ``keepalive_interval`` recebem um ping leve (ex.:
+GET /api/auth/session) antes que o upstream feche a conexão por inatividade;
+assim a primeira requisição depois de um período parado não paga DNS/TLS/
+Cloudflare de novo. Se o ping falhar, a sessão é trocada por uma nova.
+"""
+import asyncio
+import time
+
+
+class _PooledSession:
+    __slots__ = ("session", "created_at", "last_used", "in_use", "borrows", "retired", "pinging")
+
+    def __init__(self, session):
+        self.session = session
+        self.created_at = self.last_used = time.monotonic()
+        self.in_use = 0
+        self.borrows = 0
+        self.retired = False
+        self.pinging = False
+
+
+class _SessionLease:
+    """Empréstimo de uma sessão do pool. release() é idempotente."""
+
+    __slots__ = ("_pool", "_entry", "_released")
+
+    def __init__(self, pool: "SessionPool", entry: _PooledSession):
+        self._pool = pool
+        self._entry = entry
+        self._released = False
+
+    @property
+    def session(self):
+        return self._entry.session
+
+    def release(self, healthy: bool = True):
+        if self._released:
+            return
+        self._released = True
+        self._pool._return(self._entry, healthy)
+
+
+class SessionPool:
+    """Mantém ``size`` sessões autenticadas prontas para uso.
+
+    Args:
+        factory: coroutine function que cria e autentica uma sessão
+        size: sessões mantidas aquecidas
+        max_age: segundos até uma sessão ser reciclada (0 desativa)
+        check_interval: período (s) da manutenção em background
+        ping: coroutine function(session) que mantém a conexão viva (levanta se a sessão não serve mais)
+        keepalive_interval: ociosidade (s) até o ping (0 desativa)
+    """
+
+    def __init__(self, factory, size: int = 4, max_age: float = 900.0, check_interval: float = 5.0,
+                 ping=None, keepalive_interval: float = 45.0):
+        self._factory = factory
+        self._ping = ping
+        self.keepalive_interval = max(0.0, float(keepalive_interval)) if ping is not None else 0.0
+        self.size = max(1, int(size))
+        self.max_age = max(0.0, float(max_age))
+        self.check_interval = check_interval
+        self._ready: list[_PooledSession] = []
+        self._warming: set = set()
+        self._maintainer: asyncio.Task | None = None
+        self._closing: set = set()
+        self._pinging: set = set()
+        self._closed = False
+        self._started_at: float | None = None
+        self.warmup_s: float | None = None
+        self.created = 0
+        self.create_failures = 0
+        self.discarded = 0
+        self.recycled = 0
+        self.borrows = 0
+        self.borrow_waits = 0
+        self.pings = 0
+        self.ping_failures = 0
+
+    @property
+    def ready(self) -> bool:
+        """Há ao menos uma sessão autenticada pronta para uso."""
+        return bool(self._ready)
+
+    async def start(self):
+        """Dispara o aquecimento inicial e a manutenção em background."""
+        self._started_at = time.monotonic()
+        self._fill()
+        self._maintainer = asyncio.get_running_loop().create_task(self._maintain())
+
+    async def wait_ready(self, timeout: float | None = None) -> bool:
+        """Aguarda o aquecimento em andamento; True se há ao menos uma sessão pronta."""
+        if self._warming:
+            await asyncio.wait(set(self._warming), timeout=timeout)
+        return bool(self._ready)
+
+    async def borrow(self) -> _SessionLease:
+        """Empresta a sessão pronta menos ocupada (cria/aguarda uma se o pool estiver vazio)."""
+        while True:
+            entry = self._pick()
+            if entry is not None:
+                break
+            if self._closed:
+                raise RuntimeError("pool de sessões encerrado")
+            self.borrow_waits += 1
+            if not self._warming:
+                self._spawn()
+            await asyncio.wait(set(self._warming), return_when=asyncio.FIRST_COMPLETED)
+            if not self._ready and not self._warming:
+                raise RuntimeError("não foi possível autenticar uma sessão no upstream")
+        entry.in_use += 1
+        entry.borrows += 1
+        self.borrows += 1
+        return _SessionLease(self, entry)
+
+    def _pick(self):
+        best = None
+        for entry in self._ready:
+            if best is None or entry.in_use < best.in_use:
+                best = entry
+        return best
+
+    def _return(self, entry: _PooledSession, healthy: bool):
+        entry.in_use -= 1
+        entry.last_used = time.monotonic()
+        if not healthy and not entry.retired:
+            self.discarded += 1
+            self._retire(entry)
+        elif entry.retired and entry.in_use == 0:
+            self._close_session(entry)
+
+    def _retire(self, entry: _PooledSession):
+        entry.retired = True
+        try:
+            self._ready.remove(entry)
+        except ValueError:
+            pass
+        if entry.in_use == 0:
+            self._close_session(entry)
+        self._fill()
+
+    def _close_session(self, entry: _PooledSession):
+        try:
+            task = asyncio.get_running_loop().create_task(entry.session.close())
+        except Exception:
+            return
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def _fill(self):
+        missing = self.size - len(self._ready) - len(self._warming)
+        for _ in range(max(0, missing)):
+            self._spawn()
+
+    def _spawn(self):
+        if self._closed:
+            return
+        task = asyncio.get_running_loop().create_task(self._create())
+        self._warming.add(task)
+        task.add_done_callback(self._warming.discard)
+
+    async def _create(self):
+        try:
+            session = await self._factory()
+        except Exception as e:
+            self.create_failures += 1
+            print(f"⚠️ Falha ao aquecer sessão do upstream: {e}")
+            return
+        if self._closed:
+            await session.close()
+            return
+        self.created += 1
+        self._ready.append(_PooledSession(session))
+        if self.warmup_s is None and self._started_at is not None:
+            self.warmup_s = time.monotonic() - self._started_at
+
+    async def _maintain(self):
+        while not self._closed:
+            await asyncio.sleep(self.check_interval)
+            if self.max_age:
+                now = time.monotonic()
+                for entry in [e for e in self._ready if now - e.created_at > self.max_age]:
+                    self.recycled += 1
+                    self._retire(entry)
+            if self.keepalive_interval:
+                self._keepalive(time.monotonic())
+            if self.create_failures and not self._ready and not self._warming:
+                # upstream recusando: evita laço apertado de recriação
+                await asyncio.sleep(self.check_interval)
+            self._fill()
+
+    def _keepalive(self, now: float):
+        for entry in self._ready:
+            if entry.in_use or entry.pinging or now - entry.last_used < self.keepalive_interval:
+                continue
+            entry.pinging = True
+            task = asyncio.get_running_loop().create_task(self._ping_entry(entry))
+            self._pinging.add(task)
+            task.add_done_callback(self._pinging.discard)
+
+    async def _ping_entry(self, entry: _PooledSession):
+        try:
+            await self._ping(entry.session)
+        except Exception as e:
+            self.ping_failures += 1
+            if not entry.retired:
+                print(f"⚠️ Sessão do upstream não respondeu ao keep-alive, trocando: {e}")
+                self.discarded += 1
+                self._retire(entry)
+        else:
+            self.pings += 1
+            entry.last_used = time.monotonic()
+        finally:
+            entry.pinging = False
+
+    async def close(self):
+        self._closed = True
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+        for task in list(self._warming) + list(self._pinging):
+            task.cancel()
+        for entry in self._ready:
+            try:
+                await entry.session.close()
+            except Exception:
+                pass
+        self._ready = []
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "ready": len(self._ready),
+            "warming": len(self._warming),
+            "in_use": sum(e.in_use for e in self._ready),
+            "created": self.created,
+            "create_failures": self.create_failures,
+            "discarded": self.discarded,
+            "recycled": self.recycled,
+            "borrows": self.borrows,
+            "borrow_waits": self.borrow_waits,
+            "keepalive_s": self.keepalive_interval,
+            "pings": self.pings,
+            "ping_failures": self.ping_failures,
+            "warmup_ms": round(1000 * self.warmup_s, 1) if self.warmup_s is not None else None,
+        }
@@ -0,0 +1,152 @@
+# single_flight.py
+"""Coalescência de requisições idênticas em andamento ("single-flight").
+
+Quando várias requisições sem estado com a mesma pergunta chegam juntas
+(ex.: vários painéis atualizando ao mesmo tempo), só a primeira abre um
+stream com o upstream. As demais se inscrevem no mesmo voo e recebem os
+mesmos itens a partir de um buffer compartilhado: quem chega atrasado
+recebe o que já passou e segue acompanhando o resto.
+
+O voo pertence ao conjunto de inscritos, não a quem o iniciou: se o
+primeiro cliente desconectar, o upstream continua para os demais. Quando o
+último inscrito sai antes do fim, a leitura do upstream é cancelada: o
+cancelamento cai dentro do ``source``, que fecha o stream cortando a
+transferência (sem baixar o resto da resposta). ``cancel_close_ms_max`` em
+stats() mede quanto o voo levou para terminar depois do cancelamento.
+"""
+import asyncio
+import time
+
+
+class _Flight:
+    __slots__ = ("key", "items", "done", "error", "subscribers", "task", "cancelled_at", "_changed")
+
+    def __init__(self, key):
+        self.key = key
+        self.items: list = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.task: asyncio.Task | None = None
+        self.cancelled_at: float | None = None
+        self._changed = asyncio.Event()
+
+    def notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+
+class Subscription:
+    """Inscrição em um voo: iterador assíncrono dos itens. aclose() é idempotente."""
+
+    __slots__ = ("_owner", "_flight", "_pos", "_closed", "leader")
+
+    def __init__(self, owner: "SingleFlight", flight: _Flight, leader: bool):
+        self._owner = owner
+        self._flight = flight
+        self._pos = 0
+        self._closed = False
+        self.leader = leader
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self._flight
+        while True:
+            if self._closed:
+                raise StopAsyncIteration
+            if self._pos < len(flight.items):
+                item = flight.items[self._pos]
+                self._pos += 1
+                return item
+            if flight.done:
+                self.close()
+                if flight.error is not None:
+                    raise flight.error
+                raise StopAsyncIteration
+            await flight._changed.wait()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._owner._unsubscribe(self._flight)
+
+    async def aclose(self):
+        self.close()
+
+
+class SingleFlight:
+    """Voos em andamento por chave."""
+
+    def __init__(self):
+        self._flights: dict = {}
+        self.flights = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.cancel_close_max = 0.0
+
+    def join(self, key) -> Subscription | None:
+        """Inscreve-se no voo em andamento da chave (None se não houver)."""
+        flight = self._flights.get(key)
+        if flight is None:
+            return None
+        flight.subscribers += 1
+        self.coalesced += 1
+        return Subscription(self, flight, leader=False)
+
+    def start(self, key, source, on_done=None) -> Subscription:
+        """Inicia um voo lendo o iterador assíncrono ``source``; on_done() roda ao terminar."""
+        flight = _Flight(key)
+        flight.subscribers = 1
+        self._flights[key] = flight
+        self.flights += 1
+        flight.task = asyncio.get_running_loop().create_task(self._produce(flight, source, on_done))
+        return Subscription(self, flight, leader=True)
+
+    async def _produce(self, flight: _Flight, source, on_done):
+        try:
+            async for item in source:
+                flight.items.append(item)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError("voo cancelado: nenhum inscrito restante")
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            try:
+                # o source já foi fechado se o cancelamento caiu dentro dele; aclose() é idempotente
+                await source.aclose()
+            except Exception:
+                pass
+            if flight.cancelled_at is not None:
+                self.cancel_close_max = max(self.cancel_close_max, time.monotonic() - flight.cancelled_at)
+            flight.notify()
+            if on_done is not None:
+                on_done()
+
+    def _unsubscribe(self, flight: _Flight):
+        flight.subscribers -= 1
+        if flight.subscribers > 0 or flight.done:
+            return
+        # último inscrito saiu no meio: ninguém mais quer este upstream
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        if flight.task is not None and not flight.task.done():
+            self.cancelled += 1
+            flight.cancelled_at = time.monotonic()
+            flight.task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "subscribers": sum(f.subscribers for f in self._flights.values()),
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+            "cancel_close_ms_max": round(1000 * self.cancel_close_max, 2),
+        }
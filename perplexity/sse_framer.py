@@ -0,0 +1,156 @@
+# sse_framer.py
+"""Enquadramento incremental de Server-Sent Events em tempo linear.
+
+Usado pelo servidor (gen_resp), pelos clientes WorkingPerplexityClient /
+AsyncWorkingPerplexityClient e pelo chat_client. Substitui os três
+enquadradores que existiam antes, um deles quadrático (``buf += chunk`` +
+``buf.split(b'\\n', 1)`` copiava o restante do buffer a cada linha, o que
+explodia nos snapshots FINAL grandes do Perplexity).
+
+O buffer é um bytearray com cursor: cada byte é examinado uma única vez, o
+prefixo já consumido é descartado uma vez por feed() e cada evento é copiado
+uma única vez (memoryview -> str). Aceita linhas terminadas em '\\n' ou
+'\\r\\n'.
+"""
+
+__all__ = ["SSEEvent", "SSEFramer", "iter_sse_events", "aiter_sse_events"]
+
+
+class SSEEvent:
+    """Evento SSE: nome (None se ausente), data (linhas unidas por '\\n') e id."""
+
+    __slots__ = ("event", "data", "id")
+
+    def __init__(self, event, data, id=None):
+        self.event = event
+        self.data = data
+        self.id = id
+
+    @property
+    def name(self):
+        """Nome efetivo do evento ('message' por padrão, como no EventSource)."""
+        return self.event or "message"
+
+    def encode(self) -> str:
+        """Serializa de volta para o formato SSE (terminado por linha em branco)."""
+        parts = []
+        if self.event is not None:
+            parts.append(f"event: {self.event}\n")
+        if self.id is not None:
+            parts.append(f"id: {self.id}\n")
+        for line in self.data.split("\n"):
+            parts.append(f"data: {line}\n")
+        parts.append("\n")
+        return "".join(parts)
+
+    def __repr__(self):
+        return f"SSEEvent(event={self.event!r}, data={self.data[:60]!r}{'...' if len(self.data) > 60 else ''})"
+
+
+def _parse_block(block: str):
+    event = None
+    ev_id = None
+    data_lines = []
+    for line in block.split("\n"):
+        if line.endswith("\r"):
+            line = line[:-1]
+        if not line or line[0] == ":":
+            continue
+        field, sep, value = line.partition(":")
+        if sep and value[:1] == " ":
+            value = value[1:]
+        if field == "data":
+            data_lines.append(value)
+        elif field == "event":
+            event = value
+        elif field == "id":
+            ev_id = value
+    if event is None and not data_lines:
+        return None
+    return SSEEvent(event, "\n".join(data_lines), ev_id)
+
+
+class SSEFramer:
+    """Enquadrador incremental: feed(bytes) -> lista de SSEEvent completos."""
+
+    __slots__ = ("_buf", "_ev_start", "_line_start", "_scan")
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._ev_start = 0     # início do evento em montagem
+        self._line_start = 0   # início da linha corrente (ainda sem '\n')
+        self._scan = 0         # até onde a linha corrente já foi examinada
+
+    def feed(self, chunk) -> list:
+        if not chunk:
+            return []
+        buf = self._buf
+        buf += chunk
+        events = []
+        ev_start = self._ev_start
+        pos = self._line_start
+        scan = self._scan
+        find = buf.find
+        while True:
+            nl = find(b"\n", scan)
+            if nl == -1:
+                # retoma a busca daqui no próximo feed (não reexamina a linha longa)
+                scan = len(buf)
+                break
+            # linha vazia ('\n' ou '\r\n') encerra o evento
+            if nl == pos or (nl == pos + 1 and buf[pos] == 13):
+                if pos > ev_start:
+                    with memoryview(buf) as mv:
+                        block = str(mv[ev_start:pos], "utf-8", "replace")
+                    ev = _parse_block(block)
+                    if ev is not None:
+                        events.append(ev)
+                ev_start = nl + 1
+            pos = scan = nl + 1
+        if ev_start:
+            # descarta o que já foi consumido (uma vez por feed, não por linha)
+            del buf[:ev_start]
+            pos -= ev_start
+            scan -= ev_start
+            ev_start = 0
+        self._ev_start = ev_start
+        self._line_start = pos
+        self._scan = scan
+        return events
+
+    def close(self) -> list:
+        """Entrega o evento final que terminou sem linha em branco (se houver)."""
+        buf = self._buf
+        events = []
+        if len(buf) > self._ev_start:
+            with memoryview(buf) as mv:
+                block = str(mv[self._ev_start:], "utf-8", "replace")
+            ev = _parse_block(block)
+            if ev is not None:
+                events.append(ev)
+        buf.clear()
+        self._ev_start = self._line_start = self._scan = 0
+        return events
+
+    def pending_bytes(self) -> int:
+        return len(self._buf) - self._ev_start
+
+
+def iter_sse_events(chunks):
+    """Itera SSEEvent a partir de um iterável de chunks de bytes."""
+    framer = SSEFramer()
+    for chunk in chunks:
+        if chunk:
+            yield from framer.feed(chunk)
+    yield from framer.close()
+
+
+async def aiter_sse_events(chunks):
+    """Versão assíncrona de iter_sse_events (ex.: resp.aiter_content())."""
+    framer = SSEFramer()
+    async for chunk in chunks:
+        if chunk:
+            for ev in framer.feed(chunk):
+                yield ev
+    for ev in framer.close():
+        yield ev
@@ -0,0 +1,333 @@
+# stream_capture.py
+"""Gravação e reprodução dos streams SSE do upstream (captura/replay).
+
+Com captura ligada (PPLX_CAPTURE_DIR), cada stream aberto com o Perplexity é
+gravado em um arquivo .sse.gz com os bytes exatamente como chegaram e o
+instante de cada pedaço. Com replay ligado (PPLX_REPLAY_DIR), o servidor não
+fala com o upstream: cada abertura de stream devolve uma captura (em rodízio)
+com o mesmo ritmo original, acelerado (PPLX_REPLAY_SPEED=10) ou sem espera
+(0). O resto do caminho (enquadramento SSE, decodificação, contexto da
+conversa, transcodificação) é o mesmo de produção.
+
+Formato do arquivo (gzip):
+
+    linha 1  cabeçalho JSON: versão, data, pergunta, idioma, status,
+             content-type e open_s (envio até o stream validado)
+    depois   registros <t: float64><n: uint32><n bytes>, com t em segundos
+             desde o envio da requisição
+
+Uso:
+    python stream_capture.py show captura.sse.gz          # cabeçalho e ritmo
+    python stream_capture.py cat captura.sse.gz           # bytes crus do stream
+    python stream_capture.py replay captura.sse.gz        # eventos decodificados e resposta final
+    python stream_capture.py replay --chat captura.sse.gz # mesmo caminho de impressão do chat_client
+"""
+import asyncio
+import gzip
+import json
+import os
+import struct
+import time
+from uuid import uuid4
+
+__all__ = ["FORMAT_VERSION", "Capture", "load_capture", "StreamRecorder", "ReplayResponse", "ReplaySource"]
+
+FORMAT_VERSION = 1
+SUFFIX = ".sse.gz"
+_RECORD = struct.Struct("<dI")
+
+
+class Capture:
+    """Captura carregada: cabeçalho e lista de (t, bytes)."""
+
+    __slots__ = ("path", "header", "records")
+
+    def __init__(self, path: str, header: dict, records: list):
+        self.path = path
+        self.header = header
+        self.records = records
+
+    @property
+    def duration(self) -> float:
+        return self.records[-1][0] if self.records else self.header.get("open_s", 0.0)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(data) for _, data in self.records)
+
+    def raw(self) -> bytes:
+        return b"".join(data for _, data in self.records)
+
+
+def load_capture(path: str) -> Capture:
+    with gzip.open(path, "rb") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != FORMAT_VERSION:
+            raise ValueError(f"{path}: versão de captura não suportada: {header.get('version')!r}")
+        records = []
+        while True:
+            head = f.read(_RECORD.size)
+            if len(head) < _RECORD.size:
+                break
+            t, n = _RECORD.unpack(head)
+            records.append((t, f.read(n)))
+    return Capture(path, header, records)
+
+
+def _write_capture(path: str, header: dict, records: list):
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wb", compresslevel=6) as f:
+        f.write(json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n")
+        for t, data in records:
+            f.write(_RECORD.pack(t, len(data)))
+            f.write(data)
+    # só aparece completo: quem lê o diretório (replay) nunca vê arquivo pela metade
+    os.replace(tmp, path)
+
+
+# ==========================
+# Captura
+# ==========================
+class _RecordingResponse:
+    """Resposta de stream que guarda cada pedaço lido; grava o arquivo no aclose()."""
+
+    def __init__(self, response, recorder: "StreamRecorder", header: dict, t0: float):
+        self._response = response
+        self._recorder = recorder
+        self._header = header
+        self._t0 = t0
+        self._records: list = []
+        self._closed = False
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    async def aiter_content(self, *args, **kwargs):
+        records = self._records
+        t0 = self._t0
+        async for chunk in self._response.aiter_content(*args, **kwargs):
+            records.append((time.perf_counter() - t0, bytes(chunk)))
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._response.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._recorder._finish(self._header, self._records)
+
+
+class StreamRecorder:
+    """Grava os streams do upstream em ``directory`` (um arquivo por stream).
+
+    Os pedaços ficam em memória durante o stream; o arquivo é comprimido e
+    escrito em uma thread ao fechar, fora do event loop.
+
+    Args:
+        directory: diretório das capturas (criado se não existir)
+        max_files: capturas gravadas por processo; depois disso a captura para
+    """
+
+    def __init__(self, directory: str, max_files: int = 1000):
+        self.directory = directory
+        self.max_files = max(0, int(max_files))
+        os.makedirs(directory, exist_ok=True)
+        self.captured = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.write_errors = 0
+
+    def wrap(self, response, body: bytes, t0: float, open_s: float):
+        """Envolve a resposta já validada; ``body`` é o corpo enviado (só pergunta/idioma são guardados)."""
+        if self.captured >= self.max_files:
+            self.skipped += 1
+            return response
+        self.captured += 1
+        try:
+            req = json.loads(body)
+            params = req.get("params") or {}
+        except (ValueError, TypeError, AttributeError):
+            req, params = {}, {}
+        header = {
+            "version": FORMAT_VERSION,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "query": req.get("query_str"),
+            "language": params.get("language"),
+            "query_source": params.get("query_source"),
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type"),
+            "open_s": round(open_s, 6),
+        }
+        return _RecordingResponse(response, self, header, t0)
+
+    def _finish(self, header: dict, records: list):
+        if not records:
+            return
+        self.bytes += sum(len(data) for _, data in records)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid4().hex[:8]}{SUFFIX}"
+        path = os.path.join(self.directory, name)
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._write, path, header, records)
+        except RuntimeError:
+            # sem event loop (cliente síncrono): grava aqui mesmo
+            self._write(path, header, records)
+
+    def _write(self, path: str, header: dict, records: list):
+        try:
+            _write_capture(path, header, records)
+        except OSError:
+            self.write_errors += 1
+
+    def stats(self) -> dict:
+        return {
+            "directory": self.directory,
+            "captured": self.captured,
+            "max_files": self.max_files,
+            "skipped": self.skipped,
+            "bytes": self.bytes,
+            "write_errors": self.write_errors,
+        }
+
+
+# ==========================
+# Replay
+# ==========================
+class ReplayResponse:
+    """Resposta de stream que reproduz uma captura (interface de curl_cffi usada pelos clientes).
+
+    Args:
+        capture: captura carregada
+        speed: 1 = ritmo original, 10 = dez vezes mais rápido, 0 = sem espera
+    """
+
+    def __init__(self, capture: Capture, speed: float = 1.0):
+        self.capture = capture
+        self.speed = speed
+        self.status_code = capture.header.get("status") or 200
+        self.headers = {"content-type": capture.header.get("content_type") or "text/event-stream"}
+
+    def _gaps(self):
+        # espera antes de cada pedaço, descontado o tempo de abertura (já esperado em ReplaySource.open)
+        prev = self.capture.header.get("open_s", 0.0)
+        for t, data in self.capture.records:
+            gap = (t - prev) / self.speed if self.speed > 0 else 0.0
+            prev = t
+            yield gap, data
+
+    async def aiter_content(self, chunk_size=None):
+        for gap, data in self._gaps():
+            if gap > 0:
+                await asyncio.sleep(gap)
+            yield data
+
+    def iter_content(self, chunk_size=None):
+        for gap, data in self._gaps():
+            if gap > 0:
+                time.sleep(gap)
+            yield data
+
+    async def aclose(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplaySource:
+    """Capturas de um diretório (ou lista de arquivos) servidas em rodízio no lugar do upstream."""
+
+    def __init__(self, source, speed: float = 1.0):
+        if isinstance(source, str):
+            if os.path.isdir(source):
+                paths = sorted(
+                    os.path.join(source, name) for name in os.listdir(source) if name.endswith(SUFFIX)
+                )
+            else:
+                paths = [source]
+        else:
+            paths = list(source)
+        self.captures = [load_capture(p) for p in paths]
+        if not self.captures:
+            raise ValueError(f"nenhuma captura ({SUFFIX}) em {source!r}")
+        self.speed = max(0.0, float(speed))
+        self._next = 0
+        self.replayed = 0
+
+    async def open(self) -> ReplayResponse:
+        capture = self.captures[self._next]
+        self._next = (self._next + 1) % len(self.captures)
+        self.replayed += 1
+        open_s = capture.header.get("open_s", 0.0)
+        if self.speed > 0 and open_s > 0:
+            await asyncio.sleep(open_s / self.speed)
+        return ReplayResponse(capture, self.speed)
+
+    def stats(self) -> dict:
+        return {
+            "captures": len(self.captures),
+            "speed": self.speed,
+            "replayed": self.replayed,
+        }
+
+
+# ==========================
+# Linha de comando
+# ==========================
+def _show(capture: Capture):
+    from sse_framer import iter_sse_events
+
+    print(json.dumps(capture.header, ensure_ascii=False, indent=2))
+    events = list(iter_sse_events(data for _, data in capture.records))
+    first = capture.records[0][0] if capture.records else None
+    print(f"pedaços: {len(capture.records)}  bytes: {capture.nbytes}  eventos SSE: {len(events)}")
+    if first is not None:
+        print(f"primeiro pedaço: {first * 1000:.1f} ms  último: {capture.duration * 1000:.1f} ms")
+
+
+def _replay(capture: Capture, speed: float, chat: bool):
+    response = ReplayResponse(capture, speed)
+    if chat:
+        # mesmo caminho de impressão do chat_client (fallbacks de parse incluídos)
+        import chat_client
+
+        chat_client.print_sse_stream(response.iter_content())
+        print()
+        return
+    from sse_framer import iter_sse_events
+    from event_decoder import decode_event
+
+    t0 = time.perf_counter()
+    last = None
+    n = 0
+    for ev in iter_sse_events(response.iter_content()):
+        n += 1
+        dec = decode_event(ev.data) if ev.data else None
+        if dec is not None and dec.answer_text:
+            last = dec.answer_text
+        print(f"[{(time.perf_counter() - t0) * 1000:8.1f} ms] {ev.name:<14} {len(ev.data):>7} bytes")
+    print(f"\n{n} eventos\n\n{last or '(sem resposta)'}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Capturas de streams do upstream (.sse.gz)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p_show = sub.add_parser("show", help="cabeçalho e ritmo da captura")
+    p_show.add_argument("path")
+    p_cat = sub.add_parser("cat", help="bytes crus do stream na saída padrão")
+    p_cat.add_argument("path")
+    p_replay = sub.add_parser("replay", help="reproduz a captura pelos decodificadores")
+    p_replay.add_argument("path")
+    p_replay.add_argument("--speed", type=float, default=0.0, help="1 = ritmo original, 0 = sem espera (padrão)")
+    p_replay.add_argument("--chat", action="store_true", help="imprime pelo caminho do chat_client")
+    args = parser.parse_args()
+    cap = load_capture(args.path)
+    if args.cmd == "show":
+        _show(cap)
+    elif args.cmd == "cat":
+        import sys
+
+        sys.stdout.buffer.write(cap.raw())
+    else:
+        _replay(cap, args.speed, args.chat)
@@ -0,0 +1,86 @@
+# stream_text.py
+"""Montagem incremental do texto impresso pelo chat_client.
+
+Cada evento do Perplexity traz a resposta acumulada até ali; o chat_client
+imprime só o sufixo novo. Antes isso comparava o snapshot inteiro com o texto
+já impresso caractere a caractere (O(n) por evento, O(n²) por resposta) e
+recompilava as regexes de normalização a cada chamada.
+
+StreamTextAssembler guarda quanto já foi emitido e confere apenas a fronteira
+(os últimos ``window`` caracteres emitidos) antes de fatiar o sufixo: custo
+proporcional ao texto novo. Se a fronteira não bate ou o snapshot encolheu, o
+upstream reescreveu texto já emitido; nesse caso raro o prefixo comum é
+recalculado por blocos e o sufixo divergente é emitido, como antes.
+"""
+import re
+
+__all__ = ["StreamTextAssembler", "normalize_piece"]
+
+_LINE_BREAKS = re.compile(r"[\r\n]+")
+_MULTI_SPACE = re.compile(r"\s{2,}")
+_SPACE_BEFORE_PUNCT = re.compile(r"\s+([,.;:!?%\)\]\}\»])")
+
+
+def normalize_piece(piece: str) -> str:
+    """Normaliza um trecho para impressão contínua (sem quebras de linha nem espaços duplos)."""
+    norm = _LINE_BREAKS.sub(" ", piece.lstrip())
+    norm = _MULTI_SPACE.sub(" ", norm)
+    norm = _SPACE_BEFORE_PUNCT.sub(r"\1", norm)
+    return norm.lstrip()
+
+
+def _common_prefix_len(a: str, b: str, block: int = 4096) -> int:
+    n = min(len(a), len(b))
+    i = 0
+    # compara blocos inteiros (em C) e só desce ao caractere no bloco divergente
+    while i < n:
+        j = min(i + block, n)
+        if a[i:j] == b[i:j]:
+            i = j
+            continue
+        while a[i] == b[i]:
+            i += 1
+        return i
+    return n
+
+
+class StreamTextAssembler:
+    """Converte snapshots cumulativos em trechos novos já normalizados.
+
+    Args:
+        window: caracteres finais do texto emitido conferidos a cada snapshot
+    """
+
+    __slots__ = ("window", "_text", "events", "rewrites")
+
+    def __init__(self, window: int = 64):
+        self.window = window
+        self._text = ""
+        self.events = 0
+        self.rewrites = 0
+
+    @property
+    def text(self) -> str:
+        """Último snapshot recebido."""
+        return self._text
+
+    def reset(self):
+        self._text = ""
+
+    def feed(self, full_text: str) -> str:
+        """Recebe o snapshot acumulado e devolve o trecho novo normalizado ('' se nada a imprimir)."""
+        self.events += 1
+        prev = self._text
+        n = len(prev)
+        start = max(0, n - self.window)
+        if len(full_text) >= n and full_text.startswith(prev[start:], start):
+            suffix = full_text[n:]
+        else:
+            # snapshot reescreveu texto já emitido: recalcula o prefixo comum
+            self.rewrites += 1
+            suffix = full_text[_common_prefix_len(prev, full_text):]
+        self._text = full_text
+        # Não imprimir sufixos que sejam apenas whitespace (inclui quebras de linha)
+        if not suffix or suffix.isspace():
+            return ""
+        return normalize_piece(suffix)
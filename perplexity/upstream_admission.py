@@ -0,0 +1,152 @@
+# upstream_admission.py
+"""Controle de admissão para chamadas ao upstream do Perplexity.
+
+Limita quantos streams do perplexity_ask ficam abertos ao mesmo tempo e
+mantém uma fila de espera limitada, com prazo máximo. Quem não cabe na fila
+(ou espera além do prazo) recebe AdmissionRejected com um Retry-After
+sugerido, para o servidor responder 429 na hora em vez de travar.
+
+O limite efetivo pode ser reduzido em tempo de execução (set_limit, usado
+pelo limite adaptativo de upstream_limiter) sem passar de max_concurrency.
+"""
+import asyncio
+import math
+import time
+from collections import deque
+
+
+class AdmissionRejected(Exception):
+    """Pedido recusado pela fila de admissão (fila cheia ou prazo estourado)."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Lease:
+    """Vaga ocupada no upstream. release() é idempotente."""
+
+    __slots__ = ("_owner", "_t0", "_released", "wait_s")
+
+    def __init__(self, owner: "UpstreamAdmission", wait_s: float):
+        self._owner = owner
+        self._t0 = time.monotonic()
+        self._released = False
+        self.wait_s = wait_s
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._owner._release(time.monotonic() - self._t0)
+
+
+class UpstreamAdmission:
+    """Pool de vagas para I/O com o upstream + fila de admissão limitada.
+
+    Args:
+        max_concurrency: streams simultâneos permitidos no upstream (teto de set_limit)
+        max_queue: pedidos que podem aguardar vaga (além disso -> recusa imediata)
+        max_wait: segundos máximos aguardando vaga antes de recusar
+    """
+
+    def __init__(self, max_concurrency: int = 32, max_queue: int = 64, max_wait: float = 10.0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.max_wait = max(0.0, float(max_wait))
+        self.limit = self.max_concurrency
+        self._in_flight = 0
+        self._waiters: deque = deque()
+        # métricas
+        self._admitted = 0
+        self._rejected_full = 0
+        self._rejected_timeout = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._hold_ewma = 1.0
+
+    async def acquire(self) -> _Lease:
+        """Aguarda uma vaga. Levanta AdmissionRejected se a fila estiver cheia ou o prazo estourar."""
+        if self._in_flight < self.limit and not self._waiters:
+            self._in_flight += 1
+            return self._admit(0.0)
+        if len(self._waiters) >= self.max_queue:
+            self._rejected_full += 1
+            raise AdmissionRejected("fila de admissão cheia", self._retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait((fut,), timeout=self.max_wait)
+        except asyncio.CancelledError:
+            # cliente desistiu: devolve a vaga se ela já tinha sido transferida
+            if fut.done() and not fut.cancelled():
+                self._release(0.0)
+            else:
+                fut.cancel()
+                self._discard(fut)
+            raise
+        if not fut.done():
+            fut.cancel()
+            self._discard(fut)
+            self._rejected_timeout += 1
+            raise AdmissionRejected("tempo máximo de espera na fila excedido", self._retry_after())
+        return self._admit(time.monotonic() - t0)
+
+    def _admit(self, wait_s: float) -> _Lease:
+        self._admitted += 1
+        self._wait_total += wait_s
+        if wait_s > self._wait_max:
+            self._wait_max = wait_s
+        return _Lease(self, wait_s)
+
+    def _discard(self, fut):
+        try:
+            self._waiters.remove(fut)
+        except ValueError:
+            pass
+
+    def set_limit(self, limit: int):
+        """Ajusta o limite efetivo (1..max_concurrency); vagas a mais são liberadas para a fila na hora."""
+        self.limit = max(1, min(self.max_concurrency, int(limit)))
+        while self._in_flight < self.limit and self._wake_next():
+            self._in_flight += 1
+
+    def _wake_next(self) -> bool:
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return True
+        return False
+
+    def _release(self, hold_s: float):
+        if hold_s > 0:
+            self._hold_ewma = 0.8 * self._hold_ewma + 0.2 * hold_s
+        # transfere a vaga diretamente para o próximo da fila (sem ultrapassagem),
+        # a menos que o limite tenha sido reduzido abaixo das vagas em uso
+        if self._in_flight <= self.limit and self._wake_next():
+            return
+        self._in_flight -= 1
+
+    def _retry_after(self) -> int:
+        # estimativa: tempo para a fila atual andar, dado o tempo médio de uso de uma vaga
+        rounds = (len(self._waiters) + 1) / self.limit
+        return int(min(60, max(1, math.ceil(self._hold_ewma * rounds))))
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight,
+            "queue_depth": len(self._waiters),
+            "max_concurrency": self.max_concurrency,
+            "limit": self.limit,
+            "max_queue": self.max_queue,
+            "max_wait_s": self.max_wait,
+            "admitted": self._admitted,
+            "rejected_queue_full": self._rejected_full,
+            "rejected_timeout": self._rejected_timeout,
+            "wait_ms_avg": round(1000 * self._wait_total / self._admitted, 2) if self._admitted else 0.0,
+            "wait_ms_max": round(1000 * self._wait_max, 2),
+        }
@@ -0,0 +1,176 @@
+# upstream_limiter.py
+"""Limite adaptativo (AIMD) de streams no upstream e circuit breaker.
+
+Sob carga o Cloudflare do Perplexity responde 403/429 (ou uma página HTML
+com status 200). Continuar mandando tráfego no mesmo ritmo só bloqueia mais
+requisições, e o erro vira indisponibilidade. Os dois mecanismos aqui
+recebem o resultado de cada abertura de stream (o mesmo rótulo das métricas:
+ok, http_403, http_429, content_type, http_5xx, transport...):
+
+    AIMDLimit       sucesso aumenta o limite de streams simultâneos em
+                    1/limite (cerca de +1 a cada "rodada"); bloqueio corta um
+                    quarto do limite, no máximo uma vez por ``cooldown``
+    CircuitBreaker  ``threshold`` bloqueios seguidos abrem o circuito: as
+                    requisições falham na hora (503) por ``open_s``; depois
+                    algumas requisições de teste (half-open) decidem entre
+                    fechar ou abrir de novo, com espera dobrada
+"""
+import time
+
+__all__ = ["THROTTLE_OUTCOMES", "CircuitOpenError", "AIMDLimit", "CircuitBreaker"]
+
+# resultados que indicam bloqueio/limitação pelo upstream
+THROTTLE_OUTCOMES = frozenset(("http_403", "http_429", "content_type"))
+
+
+class CircuitOpenError(Exception):
+    """Circuito aberto: o upstream está bloqueando e a requisição nem é enviada."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Upstream bloqueando requisições; circuito aberto (tente em {retry_after}s)")
+        self.retry_after = retry_after
+
+
+class AIMDLimit:
+    """Ajusta o limite de UpstreamAdmission: aumento aditivo no sucesso, corte multiplicativo no bloqueio.
+
+    Args:
+        admission: UpstreamAdmission cujo limite é ajustado (max_concurrency é o teto)
+        min_limit: limite mínimo
+        decrease: fator aplicado no bloqueio (0.75 = corta um quarto)
+        cooldown: segundos mínimos entre dois cortes (uma rajada de 403 conta uma vez)
+    """
+
+    def __init__(self, admission, min_limit: int = 1, decrease: float = 0.75, cooldown: float = 1.0):
+        self.admission = admission
+        self.max_limit = admission.max_concurrency
+        self.min_limit = max(1, min(int(min_limit), self.max_limit))
+        self.decrease = min(0.95, max(0.1, float(decrease)))
+        self.cooldown = max(0.0, float(cooldown))
+        self.limit = float(self.max_limit)
+        self._last_decrease = float("-inf")
+        self.increases = 0
+        self.decreases = 0
+
+    def record(self, outcome: str):
+        if outcome == "ok":
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.increases += 1
+                self._apply()
+        elif outcome in THROTTLE_OUTCOMES:
+            now = time.monotonic()
+            if now - self._last_decrease < self.cooldown:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.decrease)
+            self.decreases += 1
+            self._apply()
+
+    def _apply(self):
+        self.admission.set_limit(int(self.limit))
+
+    def stats(self) -> dict:
+        return {
+            "limit": int(self.limit),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+
+class CircuitBreaker:
+    """Circuit breaker sobre os bloqueios do upstream (closed -> open -> half_open -> closed).
+
+    Args:
+        threshold: bloqueios seguidos que abrem o circuito (0 desativa)
+        open_s: tempo aberto antes do primeiro teste; dobra a cada teste que falha
+        max_open_s: teto do tempo aberto
+        probes: requisições de teste liberadas no half-open
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+
+    def __init__(self, threshold: int = 5, open_s: float = 10.0, max_open_s: float = 120.0, probes: int = 1):
+        self.threshold = max(0, int(threshold))
+        self.base_open_s = max(0.1, float(open_s))
+        self.max_open_s = max(self.base_open_s, float(max_open_s))
+        self.probes = max(1, int(probes))
+        self.state = self.CLOSED
+        self.open_s = self.base_open_s
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes_left = 0
+        self.trips = 0
+        self.rejected = 0
+
+    def _retry_after(self, now: float) -> int:
+        return max(1, int(self._opened_at + self.open_s - now + 0.999))
+
+    def allow(self) -> bool:
+        """True se a requisição pode ir ao upstream (no half-open, consome uma das vagas de teste)."""
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self._opened_at < self.open_s:
+                self.rejected += 1
+                return False
+            self.state = self.HALF_OPEN
+            self._probes_left = self.probes
+        # half-open: testes sem resposta por open_s liberam outra rodada
+        if self._probes_left <= 0 and now - self._opened_at >= 2 * self.open_s:
+            self._opened_at = now - self.open_s
+            self._probes_left = self.probes
+        if self._probes_left > 0:
+            self._probes_left -= 1
+            return True
+        self.rejected += 1
+        return False
+
+    def check(self):
+        """Levanta CircuitOpenError se o circuito está aberto (não consome vaga de teste)."""
+        if self.state == self.OPEN:
+            now = time.monotonic()
+            if now - self._opened_at < self.open_s:
+                raise CircuitOpenError(self._retry_after(now))
+
+    def retry_after(self) -> int:
+        return self._retry_after(time.monotonic()) if self.state == self.OPEN else 1
+
+    def record(self, outcome: str):
+        if not self.threshold:
+            return
+        if outcome == "ok":
+            self._failures = 0
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                self.open_s = self.base_open_s
+            return
+        if outcome not in THROTTLE_OUTCOMES:
+            return
+        if self.state == self.HALF_OPEN:
+            # teste falhou: abre de novo por mais tempo
+            self.open_s = min(self.max_open_s, self.open_s * 2)
+            self._open()
+            return
+        self._failures += 1
+        if self.state == self.CLOSED and self._failures >= self.threshold:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._failures = 0
+        self.trips += 1
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "threshold": self.threshold,
+            "open_s": self.open_s,
+            "retry_after_s": self.retry_after() if self.state == self.OPEN else None,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
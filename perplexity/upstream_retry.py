@@ -0,0 +1,299 @@
+# upstream_retry.py
+"""Retry com orçamento, backoff com jitter, detecção de stall e hedge no perplexity_ask.
+
+Falhas transitórias do upstream (HTTP 429/5xx, queda de conexão, stream
+parado antes do primeiro evento) viravam um evento de erro para o usuário, que
+repetia a pergunta na mão. Aqui a abertura do stream é repetida
+automaticamente, mas só até o primeiro evento: depois disso o cliente já
+recebeu parte da resposta e repetir duplicaria o turno.
+
+Bloqueios (401/403 e o desafio do Cloudflare em HTML) não são repetidos: o
+retry sairia pelos mesmos cookies da conta bloqueada, e cada tentativa
+contaria de novo no circuit breaker, no limite AIMD e na quarentena da conta
+(upstream_limiter, account_pool), que são quem trata o bloqueio.
+
+    orçamento   retries (e hedges) limitados a uma fração das requisições da
+                janela recente, para que um upstream fora do ar não receba o
+                dobro de tráfego
+    backoff     espera aleatória entre 0 e base * 2^tentativa (full jitter)
+    stall       nenhum evento em ``stall_timeout`` desde o envio conta como
+                falha (e é repetido); o curl só entrega a resposta com o
+                primeiro byte do corpo, então o prazo cobre abertura e
+                primeiro evento juntos
+    follow-up   em turnos seguintes da conversa, stall e 5xx podem significar
+                que o upstream já aceitou a pergunta (repetir duplicaria o
+                turno ou bifurcaria a thread): só se repete o que não foi
+                entregue (falha de conexão, 429/503 com Retry-After)
+    hedge       em perguntas de primeiro turno, se o primeiro evento não chegou
+                em p95 da latência recente, uma segunda requisição é enviada e
+                vale a que responder primeiro; a outra é cancelada
+"""
+import asyncio
+import random
+import time
+from collections import deque
+
+__all__ = ["UpstreamStallError", "RetryBudget", "LatencyTracker", "RetryPolicy"]
+
+
+class UpstreamStallError(Exception):
+    """Nenhum evento do upstream dentro do prazo de stall."""
+
+
+class RetryBudget:
+    """Orçamento global de retries: ``ratio`` das requisições da janela, mais ``min_per_s`` por segundo.
+
+    Args:
+        ratio: retries permitidos por requisição (0.2 = até 20% a mais de tráfego)
+        min_per_s: retries sempre permitidos por segundo, mesmo com pouco tráfego
+        window: janela (s) usada na contagem
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_s: float = 1.0, window: float = 10.0):
+        self.ratio = max(0.0, float(ratio))
+        self.min_per_s = max(0.0, float(min_per_s))
+        self.window = max(1.0, float(window))
+        self._requests: deque = deque()
+        self._spent: deque = deque()
+        self.exhausted = 0
+
+    def _trim(self, now: float):
+        edge = now - self.window
+        for q in (self._requests, self._spent):
+            while q and q[0] < edge:
+                q.popleft()
+
+    def on_request(self):
+        now = time.monotonic()
+        self._trim(now)
+        self._requests.append(now)
+
+    def available(self) -> float:
+        self._trim(time.monotonic())
+        return self.min_per_s * self.window + self.ratio * len(self._requests) - len(self._spent)
+
+    def try_spend(self) -> bool:
+        """Consome um retry do orçamento; False (e conta) se esgotado."""
+        if self.available() < 1:
+            self.exhausted += 1
+            return False
+        self._spent.append(time.monotonic())
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "ratio": self.ratio,
+            "min_per_s": self.min_per_s,
+            "window_s": self.window,
+            "available": round(self.available(), 1),
+            "exhausted": self.exhausted,
+        }
+
+
+class LatencyTracker:
+    """Quantis das últimas ``size`` latências até o primeiro evento."""
+
+    def __init__(self, size: int = 256):
+        self._samples: deque = deque(maxlen=max(1, int(size)))
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class RetryPolicy:
+    """Executa a abertura do stream (até o primeiro evento) com retry, stall e hedge.
+
+    ``run(attempt)`` chama ``attempt()``, uma corrotina que abre o stream e
+    devolve o resultado já com o primeiro evento lido. Resultados de tentativas
+    perdedoras (hedge) são entregues a ``discard(result)`` para fechar a conexão.
+
+    Args:
+        attempts: tentativas no total (1 desativa o retry)
+        base_delay: base do backoff (s)
+        max_delay: teto do backoff (s)
+        stall_timeout: segundos do envio até o primeiro evento antes de desistir da tentativa (0 desativa)
+        hedge: envia uma segunda requisição em perguntas de primeiro turno lentas
+        hedge_quantile: quantil da latência até o primeiro evento usado como espera do hedge
+        hedge_min_samples: amostras necessárias antes do primeiro hedge
+        hedge_min_delay: espera mínima (s) antes do hedge
+        budget: orçamento compartilhado (RetryBudget); hedges também consomem
+        transport_errors: exceções de transporte tratadas como transitórias
+        not_sent: callable(exc) -> bool, True se a falha ocorreu antes de a pergunta chegar ao
+            upstream (ex.: conexão recusada); em follow-ups só essas falhas são repetidas
+    """
+
+    # respostas que garantem que a pergunta não foi processada, quando vêm com Retry-After
+    NOT_PROCESSED_STATUS = frozenset((429, 503))
+
+    # status HTTP transitórios; bloqueios (401/403, HTML do Cloudflare com 200) ficam com breaker/quarentena
+    RETRY_STATUS = frozenset((408, 425, 429, 500, 502, 503, 504))
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.1, max_delay: float = 2.0,
+                 stall_timeout: float = 15.0, hedge: bool = False, hedge_quantile: float = 0.95,
+                 hedge_min_samples: int = 20, hedge_min_delay: float = 0.05, budget: RetryBudget | None = None,
+                 transport_errors: tuple = (OSError,), not_sent=None):
+        self.attempts = max(1, int(attempts))
+        self.base_delay = max(0.0, float(base_delay))
+        self.max_delay = max(self.base_delay, float(max_delay))
+        self.stall_timeout = max(0.0, float(stall_timeout))
+        self.hedge = bool(hedge)
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = max(1, int(hedge_min_samples))
+        self.hedge_min_delay = max(0.0, float(hedge_min_delay))
+        self.budget = budget if budget is not None else RetryBudget()
+        self.transport_errors = transport_errors
+        self.not_sent = not_sent
+        self.latency = LatencyTracker()
+        self._rnd = random.Random()
+        # callbacks das métricas do servidor: on_retry(exc), on_hedge(won: bool)
+        self.on_retry = None
+        self.on_hedge = None
+        self.requests = 0
+        self.retries = 0
+        self.recovered = 0
+        self.stalls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.followup_refused = 0
+
+    def retryable(self, exc: BaseException) -> bool:
+        if isinstance(exc, asyncio.CancelledError):
+            return False
+        if isinstance(exc, UpstreamStallError):
+            return True
+        code = getattr(exc, "status_code", None)
+        if code is not None:
+            return code in self.RETRY_STATUS
+        return isinstance(exc, self.transport_errors)
+
+    def undelivered(self, exc: BaseException) -> bool:
+        """A pergunta comprovadamente não chegou ao upstream (seguro repetir num follow-up)."""
+        code = getattr(exc, "status_code", None)
+        if code in self.NOT_PROCESSED_STATUS and getattr(exc, "retry_after", None):
+            return True
+        return self.not_sent is not None and self.not_sent(exc)
+
+    def backoff(self, retry: int) -> float:
+        return self._rnd.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+    def hedge_delay(self) -> float | None:
+        """Espera antes do hedge (p95 da latência recente) ou None se ainda não há amostras suficientes."""
+        if len(self.latency) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, self.latency.quantile(self.hedge_quantile))
+
+    async def _timed(self, attempt):
+        # uma tentativa com o prazo de stall; a latência alimenta o atraso do hedge
+        t0 = time.perf_counter()
+        if self.stall_timeout:
+            try:
+                result = await asyncio.wait_for(attempt(), self.stall_timeout)
+            except asyncio.TimeoutError:
+                self.stalls += 1
+                raise UpstreamStallError(f"Upstream sem eventos por {self.stall_timeout:g}s") from None
+        else:
+            result = await attempt()
+        self.latency.observe(time.perf_counter() - t0)
+        return result
+
+    async def run(self, attempt, discard=None, hedge: bool = False, followup: bool = False):
+        """Resultado da primeira tentativa bem-sucedida; levanta a última falha se desistir.
+
+        ``followup``: turno seguinte da conversa; só falhas não entregues são repetidas.
+        """
+        self.requests += 1
+        self.budget.on_request()
+        retry = 0
+        while True:
+            try:
+                if hedge and self.hedge and retry == 0:
+                    result = await self._hedged(attempt, discard)
+                else:
+                    result = await self._timed(attempt)
+                if retry:
+                    self.recovered += 1
+                return result
+            except BaseException as e:
+                if retry + 1 >= self.attempts or not self.retryable(e):
+                    raise
+                if followup and not self.undelivered(e):
+                    self.followup_refused += 1
+                    raise
+                if not self.budget.try_spend():
+                    raise
+                self.retries += 1
+                if self.on_retry is not None:
+                    self.on_retry(e)
+            await asyncio.sleep(self.backoff(retry))
+            retry += 1
+
+    async def _hedged(self, attempt, discard):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await self._timed(attempt)
+        primary = asyncio.ensure_future(self._timed(attempt))
+        done, _ = await asyncio.wait((primary,), timeout=delay)
+        if done or not self.budget.try_spend():
+            return await primary
+        self.hedges += 1
+        secondary = asyncio.ensure_future(self._timed(attempt))
+        pending = {primary, secondary}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+                    error = task.exception()
+                else:
+                    continue
+                won = winner is secondary
+                if won:
+                    self.hedge_wins += 1
+                if self.on_hedge is not None:
+                    self.on_hedge(won)
+                # as duas terminaram juntas: a outra também precisa ser fechada
+                for task in done:
+                    if task is not winner and task.exception() is None and discard is not None:
+                        asyncio.ensure_future(discard(task.result()))
+                return winner.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                if discard is not None:
+                    task.add_done_callback(lambda t: _discard_done(t, discard))
+
+    def stats(self) -> dict:
+        p95 = self.latency.quantile(self.hedge_quantile)
+        return {
+            "attempts": self.attempts,
+            "stall_timeout_s": self.stall_timeout,
+            "requests": self.requests,
+            "retries": self.retries,
+            "recovered": self.recovered,
+            "stalls": self.stalls,
+            "hedge": self.hedge,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "followup_refused": self.followup_refused,
+            "first_event_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+            "budget": self.budget.stats(),
+        }
+
+
+def _discard_done(task, discard):
+    # tentativa cancelada que já tinha aberto o stream: fecha a conexão
+    if not task.cancelled() and task.exception() is None:
+        asyncio.ensure_future(discard(task.result()))
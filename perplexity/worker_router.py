@@ -0,0 +1,649 @@
+# worker_router.py
+"""Modo multiprocesso: N workers do servidor atrás de um roteador com afinidade por conversa.
+
+O estado de cada conversa (ids de contexto no cliente, fila de turnos,
+contexto de rotina) vive no processo que a atende; com vários workers
+independentes, o segundo turno cairia num processo que não conhece a
+conversa. Aqui um roteador leve (asyncio, HTTP/1.1) fica na porta pública e
+repassa cada requisição para um worker local:
+
+    com conversation_id  -> sempre o mesmo worker (crc32 do id % N)
+    sem conversation_id  -> o worker com menos requisições em andamento
+    /health, /ready, /metrics -> agregados de todos os workers
+    /v1/responses/batch  -> dividido por worker dono de cada conversa; os
+                            NDJSON dos sub-lotes são intercalados em um só
+
+O roteador não interpreta o SSE: só lê o JSON do corpo para achar o
+conversation_id e copia os bytes da resposta. Nos lotes ele lê as linhas
+NDJSON para devolver o índice original de cada item e montar o resumo. O banco de contexto
+(PPLX_CONTEXT_DB) é o mesmo arquivo SQLite para todos os workers (WAL), então
+qualquer worker reidrata uma conversa depois de um restart ou de uma mudança
+no número de workers.
+
+Workers que morrem são reiniciados na mesma porta.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import zlib
+
+from event_decoder import DECODE_ERRORS, json_loads
+
+__all__ = ["conversation_key", "pick_worker", "merge_metrics", "WorkerRouter", "serve_multiprocess"]
+
+# cabeçalhos por conexão: não atravessam o roteador
+_HOP_BY_HOP = frozenset((
+    "connection", "keep-alive", "proxy-connection", "transfer-encoding", "te", "trailer", "upgrade", "content-length",
+))
+
+
+def _object_key(obj) -> str | None:
+    if not isinstance(obj, dict):
+        return None
+    key = obj.get("conversation_id") or obj.get("thread_id") or obj.get("id_base")
+    return str(key) if key else None
+
+
+def conversation_key(body: bytes) -> str | None:
+    """conversation_id da requisição (mesma precedência do servidor) ou None."""
+    try:
+        obj = json_loads(body)
+    except DECODE_ERRORS:
+        return None
+    return _object_key(obj)
+
+
+def pick_worker(key: str, workers: int) -> int:
+    """Worker fixo da conversa (estável entre processos e restarts)."""
+    return zlib.crc32(key.encode("utf-8")) % workers
+
+
+def merge_metrics(texts: list) -> str:
+    """Junta as saídas de /metrics dos workers, com o rótulo worker="i" em cada amostra.
+
+    ``texts`` é uma lista de (índice do worker, texto). As amostras de uma mesma
+    métrica ficam juntas, sob um único HELP/TYPE, como o formato exige.
+    """
+    families: dict = {}
+    for index, text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"meta": {}, "samples": []})
+                    family["meta"].setdefault(parts[1], line)
+                continue
+            if family is None:
+                family = families.setdefault("", {"meta": {}, "samples": []})
+            name, sep, rest = line.partition("{")
+            if sep:
+                sample = f'{name}{{worker="{index}",{rest}'
+            else:
+                name, _, value = line.partition(" ")
+                sample = f'{name}{{worker="{index}"}} {value}'
+            family["samples"].append(sample)
+    lines = []
+    for family in families.values():
+        for kind in ("HELP", "TYPE"):
+            if kind in family["meta"]:
+                lines.append(family["meta"][kind])
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+def _free_port(host: str = "127.0.0.1") -> int:
+    with socket.socket() as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def _watch_parent(parent: int):
+    # roteador morto sem encerrar os workers (SIGKILL): o worker sai sozinho
+    while os.getppid() == parent:
+        time.sleep(1.0)
+    os._exit(0)
+
+
+def _worker_main(port: int, server_kwargs: dict, parent: int):
+    import threading
+
+    import perplexity_working
+
+    threading.Thread(target=_watch_parent, args=(parent,), name="parent-watch", daemon=True).start()
+    ok, _ = perplexity_working.start_openai_compat_api(host="127.0.0.1", port=port, threaded=False, **server_kwargs)
+    raise SystemExit(0 if ok else 1)
+
+
+async def _read_head(reader) -> tuple:
+    """Lê a linha inicial e os cabeçalhos: (linha inicial, [(nome, valor)], {nome minúsculo: valor})."""
+    head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+    items = []
+    for line in head[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            items.append((name.strip(), value.strip()))
+    return head[0], items, {k.lower(): v for k, v in items}
+
+
+async def _iter_body(reader, headers: dict):
+    """Corpo da resposta em pedaços, conforme chega (chunked, Content-Length ou até o EOF)."""
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                return
+            yield await reader.readexactly(size)
+            await reader.readexactly(2)
+    if "content-length" in headers:
+        length = int(headers["content-length"] or 0)
+        if length:
+            yield await reader.readexactly(length)
+        return
+    while True:
+        chunk = await reader.read(65536)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def _aiter_lines(chunks):
+    """Linhas (sem o '\n') de um corpo NDJSON em pedaços, em tempo linear.
+
+    Mesma ideia do SSEFramer: bytearray com cursor, cada byte examinado uma
+    vez e o prefixo consumido descartado uma vez por pedaço.
+    """
+    buf = bytearray()
+    scan = 0
+    async for chunk in chunks:
+        buf += chunk
+        pos = 0
+        while True:
+            nl = buf.find(b"\n", scan)
+            if nl == -1:
+                break
+            yield bytes(buf[pos:nl])
+            pos = scan = nl + 1
+        if pos:
+            del buf[:pos]
+        scan = len(buf)
+    if buf:
+        yield bytes(buf)
+
+
+async def _read_body(reader, headers: dict) -> bytes:
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        parts = []
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                # trailers até a linha vazia
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(parts)
+            parts.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+    length = int(headers.get("content-length") or 0)
+    return await reader.readexactly(length) if length else b""
+
+
+class _Worker:
+    __slots__ = ("index", "port", "process", "active", "requests", "restarts", "started_at")
+
+    def __init__(self, index: int, port: int):
+        self.index = index
+        self.port = port
+        self.process = None
+        self.active = 0
+        self.requests = 0
+        self.restarts = 0
+        self.started_at = 0.0
+
+
+class WorkerRouter:
+    """Sobe ``workers`` processos do servidor e roteia as requisições para eles.
+
+    Args:
+        workers: processos do servidor (cada um com seu event loop e pool de sessões)
+        host, port: endereço público do roteador
+        server_kwargs: argumentos repassados a start_openai_compat_api() em cada worker
+    """
+
+    def __init__(self, workers: int, host: str = "127.0.0.1", port: int = 8000, server_kwargs: dict | None = None):
+        self.host = host
+        self.port = port
+        self.server_kwargs = dict(server_kwargs or {})
+        self.workers = [_Worker(i, _free_port()) for i in range(max(1, int(workers)))]
+        self._ctx = multiprocessing.get_context("spawn")
+        self._server = None
+        self._supervisor = None
+        self._closing = False
+        self.sticky = 0
+        self.balanced = 0
+        self.unavailable = 0
+        self.batches_split = 0
+        # mesmo limite de itens por lote dos workers (o lote é validado antes de ser dividido)
+        self.batch_max_items = max(1, int(os.environ.get("PPLX_BATCH_MAX_ITEMS", "1000")))
+        self._rr = 0
+
+    # --- processos ---
+    def _spawn(self, worker: _Worker):
+        worker.process = self._ctx.Process(
+            target=_worker_main, args=(worker.port, self.server_kwargs, os.getpid()), name=f"pplx-worker-{worker.index}", daemon=True,
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+
+    async def _supervise(self):
+        while not self._closing:
+            await asyncio.sleep(1.0)
+            for worker in self.workers:
+                if self._closing or worker.process.is_alive():
+                    continue
+                # evita laço de restart se o worker morre logo ao subir
+                if time.monotonic() - worker.started_at < 2.0:
+                    continue
+                worker.restarts += 1
+                print(f"⚠️ Worker {worker.index} encerrou (código {worker.process.exitcode}); reiniciando")
+                self._spawn(worker)
+
+    async def start(self):
+        for worker in self.workers:
+            self._spawn(worker)
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self._supervisor = asyncio.get_running_loop().create_task(self._supervise())
+        return self
+
+    async def close(self):
+        self._closing = True
+        if self._supervisor is not None:
+            self._supervisor.cancel()
+        if self._server is not None:
+            self._server.close()
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                await asyncio.to_thread(worker.process.join, 5)
+
+    async def serve_forever(self):
+        """Roda até SIGTERM/SIGINT (ou cancelamento) e encerra os workers."""
+        await self.start()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C chega como KeyboardInterrupt
+        try:
+            await stop.wait()
+        finally:
+            await self.close()
+
+    # --- roteamento ---
+    def _least_active(self) -> _Worker:
+        # começa a busca em um worker diferente a cada vez: empates viram rodízio
+        n = len(self.workers)
+        self._rr = (self._rr + 1) % n
+        best = None
+        for i in range(n):
+            worker = self.workers[(self._rr + i) % n]
+            if best is None or worker.active < best.active:
+                best = worker
+        return best
+
+    def _route(self, method: str, path: str, body: bytes) -> _Worker:
+        key = None
+        if path.startswith("/v1/conversations/"):
+            key = path[len("/v1/conversations/"):].split("?", 1)[0] or None
+        elif method == "POST" and body:
+            key = conversation_key(body)
+        if key is not None:
+            self.sticky += 1
+            return self.workers[pick_worker(key, len(self.workers))]
+        self.balanced += 1
+        return self._least_active()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    start, items, headers = await _read_head(reader)
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+                method, path, _ = (start.split(" ", 2) + ["", ""])[:3]
+                body = await _read_body(reader, headers)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                route = path.split("?", 1)[0]
+                if method == "GET" and route in ("/health", "/ready", "/metrics"):
+                    await self._aggregate(route, writer, keep_alive)
+                elif method == "POST" and route == "/v1/responses/batch":
+                    keep_alive = await self._batch(start, items, body, writer, keep_alive)
+                else:
+                    keep_alive = await self._proxy(self._route(method, path, body), start, items, body, writer,
+                                                   keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def _proxy(self, worker: _Worker, start: str, items: list, body: bytes, writer, keep_alive: bool) -> bool:
+        """Repassa a requisição ao worker e copia a resposta; False se a conexão do cliente deve fechar."""
+        worker.active += 1
+        worker.requests += 1
+        upstream = None
+        try:
+            try:
+                w_reader, upstream = await asyncio.open_connection("127.0.0.1", worker.port)
+            except OSError:
+                self.unavailable += 1
+                await _send_json(writer, 503, {"error": {
+                    "message": f"Worker {worker.index} indisponível (reiniciando)", "type": "worker_unavailable",
+                }}, keep_alive, extra={"Retry-After": "1"})
+                return keep_alive
+            fwd = [start]
+            fwd += [f"{k}: {v}" for k, v in items if k.lower() not in _HOP_BY_HOP]
+            fwd += [f"Content-Length: {len(body)}", "Connection: close"]
+            upstream.write(("\r\n".join(fwd) + "\r\n\r\n").encode("latin-1") + body)
+            await upstream.drain()
+
+            status_line, r_items, r_headers = await _read_head(w_reader)
+            framed = "content-length" in r_headers or r_headers.get("transfer-encoding", "").lower() == "chunked"
+            # sem Content-Length nem chunked o fim da resposta é o fechamento: não dá para reaproveitar
+            keep_alive = keep_alive and framed
+            out = [status_line]
+            out += [f"{k}: {v}" for k, v in r_items if k.lower() not in ("connection", "keep-alive")]
+            out.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+            writer.write(("\r\n".join(out) + "\r\n\r\n").encode("latin-1"))
+            # o worker fecha a conexão ao fim da resposta (Connection: close): copia até o EOF
+            while True:
+                chunk = await w_reader.read(65536)
+                if not chunk:
+                    break
+                writer.write(chunk)
+                await writer.drain()
+            return keep_alive
+        finally:
+            worker.active -= 1
+            if upstream is not None:
+                # cliente que desconecta no meio do stream derruba a conexão com o worker (cancela o upstream lá)
+                upstream.close()
+
+    # --- lotes ---
+    def _split_batch(self, items: list) -> dict:
+        """Índices dos itens por worker: cada conversa no worker dono; avulsos juntos no menos ocupado."""
+        parts: dict = {}
+        loose = []
+        for index, item in enumerate(items):
+            key = _object_key(item)
+            if key is None:
+                loose.append(index)
+            else:
+                parts.setdefault(pick_worker(key, len(self.workers)), []).append(index)
+        if loose:
+            parts.setdefault(self._least_active().index, []).extend(loose)
+        return parts
+
+    async def _batch(self, start: str, items: list, body: bytes, writer, keep_alive: bool) -> bool:
+        """Divide o lote entre os workers donos das conversas e intercala os NDJSON na resposta.
+
+        Um item com conversation_id rodando fora do worker dono pularia a fila de
+        turnos e o contexto em memória da conversa (o SQLite é gravado com atraso)
+        e poderia bifurcar a thread no upstream.
+        """
+        try:
+            batch = json_loads(body)
+        except DECODE_ERRORS:
+            batch = None
+        batch_items = batch.get("items") if isinstance(batch, dict) else None
+        if not isinstance(batch_items, list) or not batch_items or not all(isinstance(it, dict) for it in batch_items):
+            # inválido: o worker responde o erro de validação
+            return await self._proxy(self._least_active(), start, items, body, writer, keep_alive)
+        if len(batch_items) > self.batch_max_items:
+            await _send_json(writer, 400, {"error": {
+                "message": f"Lote grande demais: {len(batch_items)} itens (máximo {self.batch_max_items})",
+            }}, keep_alive)
+            return keep_alive
+        parts = self._split_batch(batch_items)
+        if len(parts) == 1:
+            self.sticky += 1
+            return await self._proxy(self.workers[next(iter(parts))], start, items, body, writer, keep_alive)
+        self.batches_split += 1
+
+        # "concurrency" do lote dividido entre os sub-lotes, proporcional aos itens
+        concurrency = batch.get("concurrency")
+        headers = [(k, v) for k, v in items if k.lower() not in _HOP_BY_HOP]
+        subs = []
+        for index, indexes in parts.items():
+            sub = {**batch, "items": [batch_items[i] for i in indexes]}
+            if isinstance(concurrency, int) and concurrency > 0:
+                sub["concurrency"] = max(1, concurrency * len(indexes) // len(batch_items))
+            subs.append((self.workers[index], indexes, json.dumps(sub, ensure_ascii=False).encode("utf-8")))
+
+        t0 = time.monotonic()
+        opened = await asyncio.gather(*(self._open_sub(worker, start, headers, sub_body) for worker, _, sub_body in subs))
+        try:
+            # erro de validação em algum sub-lote (mesmo corpo para todos): devolve o primeiro
+            for status, r_headers, conn in opened:
+                if status is not None and status != 200:
+                    reader = conn[0]
+                    error = await _read_body(reader, r_headers)
+                    await _send(writer, status, r_headers.get("content-type", "application/json"), error, keep_alive)
+                    return keep_alive
+            writer.write((
+                "HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nCache-Control: no-cache\r\n"
+                f"Transfer-Encoding: chunked\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            ).encode("latin-1"))
+            out: asyncio.Queue = asyncio.Queue()
+            tasks = [
+                asyncio.ensure_future(self._relay_sub(worker, indexes, batch_items, status, r_headers, conn, out))
+                for (worker, indexes, _), (status, r_headers, conn) in zip(subs, opened)
+            ]
+            try:
+                summary = {"items": len(batch_items), "errors": {}, "concurrency": 0, "latencies": []}
+                for _ in range(len(batch_items) + len(subs)):
+                    kind, line = await out.get()
+                    if kind == "summary":
+                        summary["concurrency"] += line.get("concurrency") or 0
+                        continue
+                    summary["latencies"].append(line.get("elapsed_ms") or 0.0)
+                    if line.get("status") != "ok":
+                        error = (line.get("error") or {}).get("type", "error")
+                        summary["errors"][error] = summary["errors"].get(error, 0) + 1
+                    await _write_chunk(writer, json.dumps(line, ensure_ascii=False) + "\n")
+                await _write_chunk(writer, json.dumps(
+                    _batch_summary(summary, batch_items, len(subs), time.monotonic() - t0), ensure_ascii=False) + "\n")
+                writer.write(b"0\r\n\r\n")
+                await writer.drain()
+            finally:
+                for task in tasks:
+                    task.cancel()
+            return keep_alive
+        finally:
+            for status, _, conn in opened:
+                if conn is not None:
+                    conn[1].close()
+
+    async def _open_sub(self, worker: _Worker, start: str, headers: list, body: bytes) -> tuple:
+        """Envia um sub-lote ao worker: (status, cabeçalhos, (reader, writer)); status None se indisponível."""
+        worker.requests += 1
+        try:
+            reader, conn = await asyncio.open_connection("127.0.0.1", worker.port)
+        except OSError:
+            self.unavailable += 1
+            return None, {}, None
+        try:
+            fwd = [start, *(f"{k}: {v}" for k, v in headers), f"Content-Length: {len(body)}", "Connection: close"]
+            conn.write(("\r\n".join(fwd) + "\r\n\r\n").encode("latin-1") + body)
+            await conn.drain()
+            status_line, _, r_headers = await _read_head(reader)
+            return int(status_line.split(" ", 2)[1]), r_headers, (reader, conn)
+        except (OSError, ValueError, asyncio.IncompleteReadError):
+            conn.close()
+            self.unavailable += 1
+            return None, {}, None
+
+    async def _relay_sub(self, worker: _Worker, indexes: list, batch_items: list, status, r_headers: dict, conn,
+                         out: asyncio.Queue):
+        # linhas do sub-lote com o índice original; itens sem resultado (worker caiu) viram erro
+        done = set()
+        summary = {}
+        worker.active += 1
+        try:
+            if status == 200:
+                try:
+                    async for raw in _aiter_lines(_iter_body(conn[0], r_headers)):
+                        try:
+                            line = json_loads(raw)
+                        except DECODE_ERRORS:
+                            continue
+                        if not isinstance(line, dict):
+                            continue
+                        if line.get("type") == "batch.summary":
+                            summary = line
+                            continue
+                        local = line.get("index")
+                        if not isinstance(local, int) or not 0 <= local < len(indexes) or local in done:
+                            continue
+                        done.add(local)
+                        await out.put(("item", {**line, "index": indexes[local]}))
+                except (OSError, ValueError, asyncio.IncompleteReadError):
+                    pass
+            for local, index in enumerate(indexes):
+                if local not in done:
+                    item = batch_items[index]
+                    key = _object_key(item)
+                    await out.put(("item", {
+                        "index": index,
+                        **({"id": item["id"]} if "id" in item else {}),
+                        **({"conversation_id": key} if key else {}),
+                        "status": "error",
+                        "error": {"message": f"Worker {worker.index} indisponível", "type": "worker_unavailable"},
+                        "elapsed_ms": 0.0,
+                    }))
+            await out.put(("summary", summary))
+        finally:
+            worker.active -= 1
+
+    async def _fetch(self, worker: _Worker, path: str) -> tuple:
+        try:
+            reader, w = await asyncio.wait_for(asyncio.open_connection("127.0.0.1", worker.port), 2.0)
+        except (OSError, asyncio.TimeoutError):
+            return None, b""
+        try:
+            w.write(f"GET {path} HTTP/1.1\r\nHost: worker\r\nConnection: close\r\n\r\n".encode("latin-1"))
+            start, _, headers = await asyncio.wait_for(_read_head(reader), 5.0)
+            body = await asyncio.wait_for(_read_body(reader, headers), 5.0)
+            return int(start.split(" ", 2)[1]), body
+        except (OSError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+            return None, b""
+        finally:
+            w.close()
+
+    async def _aggregate(self, route: str, writer, keep_alive: bool):
+        results = await asyncio.gather(*(self._fetch(w, "/health" if route == "/ready" else route) for w in self.workers))
+        if route == "/metrics":
+            text = merge_metrics([(w.index, body.decode("utf-8")) for w, (status, body) in zip(self.workers, results)
+                                  if status == 200])
+            text += (
+                "# HELP pplx_router_requests_total Requisições repassadas pelo roteador, por worker\n"
+                "# TYPE pplx_router_requests_total counter\n"
+                + "".join(f'pplx_router_requests_total{{worker="{w.index}"}} {w.requests}\n' for w in self.workers)
+            )
+            await _send(writer, 200, "text/plain; version=0.0.4; charset=utf-8", text.encode("utf-8"), keep_alive)
+            return
+        workers = []
+        for worker, (status, body) in zip(self.workers, results):
+            try:
+                health = json.loads(body) if status == 200 else None
+            except ValueError:
+                health = None
+            workers.append({
+                "index": worker.index,
+                "port": worker.port,
+                "pid": worker.process.pid if worker.process is not None else None,
+                "alive": bool(worker.process is not None and worker.process.is_alive()),
+                "ready": bool(health and health.get("ready")),
+                "active": worker.active,
+                "requests": worker.requests,
+                "restarts": worker.restarts,
+                "health": health,
+            })
+        ready = all(w["ready"] for w in workers)
+        if route == "/ready":
+            await _send_json(writer, 200 if ready else 503, {"ready": ready}, keep_alive)
+            return
+        await _send_json(writer, 200, {
+            "status": "ok",
+            "ready": ready,
+            "router": {"workers": len(self.workers), "sticky": self.sticky, "balanced": self.balanced,
+                       "unavailable": self.unavailable, "batches_split": self.batches_split},
+            "workers": workers,
+        }, keep_alive)
+
+
+async def _send(writer, status: int, content_type: str, body: bytes, keep_alive: bool, extra: dict | None = None):
+    reason = {200: "OK", 503: "Service Unavailable"}.get(status, "Error")
+    head = [f"HTTP/1.1 {status} {reason}", f"Content-Type: {content_type}", f"Content-Length: {len(body)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    head += [f"{k}: {v}" for k, v in (extra or {}).items()]
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+
+
+async def _write_chunk(writer, text: str):
+    data = text.encode("utf-8")
+    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+    await writer.drain()
+
+
+def _batch_summary(summary: dict, batch_items: list, workers: int, elapsed: float) -> dict:
+    # mesmo formato do resumo de um lote num único worker
+    latencies = sorted(summary["latencies"])
+    errors = summary["errors"]
+    return {
+        "type": "batch.summary",
+        "items": summary["items"],
+        "ok": summary["items"] - sum(errors.values()),
+        "errors": errors,
+        "conversations": len({key for key in map(_object_key, batch_items) if key is not None}),
+        "concurrency": summary["concurrency"],
+        "workers": workers,
+        "elapsed_s": round(elapsed, 3),
+        "items_per_s": round(summary["items"] / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {
+            "p50": latencies[len(latencies) // 2],
+            "p95": latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))],
+            "max": latencies[-1],
+        },
+    }
+
+
+async def _send_json(writer, status: int, obj, keep_alive: bool, extra: dict | None = None):
+    await _send(writer, status, "application/json", json.dumps(obj, ensure_ascii=False).encode("utf-8"), keep_alive, extra)
+
+
+def serve_multiprocess(host: str = "0.0.0.0", port: int = 8000, workers: int | None = None, **server_kwargs):
+    """Sobe o roteador e ``workers`` processos do servidor (bloqueia até Ctrl+C).
+
+    ``server_kwargs`` vão para start_openai_compat_api() em cada worker.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    router = WorkerRouter(workers, host=host, port=port, server_kwargs=server_kwargs)
+    print(f"Roteador em http://{host}:{port}/v1 com {len(router.workers)} workers "
+          f"(portas {', '.join(str(w.port) for w in router.workers)})")
+    try:
+        asyncio.run(router.serve_forever())
+    except KeyboardInterrupt:
+        pass